@@ -1,11 +1,8 @@
-import random
-import match
-
 from logger import Logger, LogCodes
-from network import Network, Flags
+from flags import Flags
 from enum import IntEnum
 from chance import Chance, Chances
-from cat import Moves
+from cat import Moves, Phases
 
 
 class Abilities(IntEnum):
@@ -20,6 +17,10 @@ class Abilities(IntEnum):
     Critical = 7
 
 
+# Maps the rounds left on a cooldown to the rounds left one round later, stopping at zero
+cooldown_decrement = bytes([0]) + bytes(range(255))
+
+
 class Ability:
 
     # Returns true if the ability is an active ability
@@ -35,27 +36,19 @@ class Ability:
     # Checks if an ability is on cooldown
     @staticmethod
     def on_cooldown(player, ability_id):
-
-        cd = False
-        for cooldown in player.cooldowns:
-
-            if cooldown[0] == ability_id:
-                cd = True
-                break
-
-        return cd
+        return player.cooldowns[ability_id] != 0
 
     # Gives a random ability to the given player
     @staticmethod
-    def random_ability(player):
+    def random_ability(game, player):
 
-        ability_id = random.randrange(6, 8)
+        ability_id = game.rng.randrange(6, 8)
         player.rability = ability_id
 
-        Logger.log(player.username + " received random ability: " + str(ability_id), LogCodes.Ability)
+        game.note("{} received random ability: {}", LogCodes.Ability, player.username, ability_id)
 
     @staticmethod
-    def use_active_ability(player, opponent, phase, ability_id):
+    def use_active_ability(game, player, opponent, ability_id):
 
         ability_used = False
 
@@ -68,17 +61,16 @@ class Ability:
 
         if useable and Ability.is_active(ability_id):
 
-            Logger.log(player.username +
-                       " attempting to use active ability - id: " + str(ability_id), LogCodes.Ability)
+            game.note("{} attempting to use active ability - id: {}", LogCodes.Ability, player.username, ability_id)
 
-            ability_used = active_map[ability_id](phase, player)
+            ability_used = active_map[ability_id](game, player)
             if ability_used:
-                Ability.network_responses(ability_id, player, opponent)
+                Ability.responses(game, player, opponent, ability_id)
 
         return ability_used
 
     @staticmethod
-    def use_passive_ability(player, opponent, phase, ability_id=None):
+    def use_passive_ability(game, player, opponent, ability_id=None):
 
         if ability_id is None:
             ability_id = player.cat.ability_id
@@ -86,29 +78,18 @@ class Ability:
         useable = not Ability.on_cooldown(player, ability_id)
         if useable and Ability.is_passive(ability_id):
 
-            Logger.log(player.username +
-                       " using passive ability - id: " + str(ability_id), LogCodes.Ability)
+            game.note("{} using passive ability - id: {}", LogCodes.Ability, player.username, ability_id)
 
-            ability_used = passive_map[ability_id](phase, player)
+            ability_used = passive_map[ability_id](game, player)
             if ability_used:
-                Ability.network_responses(player, opponent, ability_id)
+                Ability.responses(game, player, opponent, ability_id)
 
     # Decreases all the abilities on cooldown for a player by one
     @staticmethod
     def decrease_cooldowns(player):
 
-        cooldowns = []
-        for cooldown in player.cooldowns:
-
-            time_remaining = cooldown[1] - 1
-            if time_remaining == 0:
-                continue
-
-            new_cooldown = (cooldown[0], time_remaining)
-            cooldowns.append(new_cooldown)
-
-        player.cooldowns = cooldowns
-        Logger.log(player.username + "'s current cooldowns: " + str(cooldowns), LogCodes.Ability)
+        player.cooldowns = player.cooldowns.translate(cooldown_decrement)
+        Logger.debug("{}'s current cooldowns by id: {}", LogCodes.Ability, player.username, bytes(player.cooldowns))
 
     # Active Abilities
     # ##################################################################################################################
@@ -116,90 +97,96 @@ class Ability:
     # Ability 00 - Rejuvenation
     # Gain 1 HP - POSTLUDE - Cooldown: 2
     @staticmethod
-    def a_ability00(phase, player):
+    def a_ability00(game, player):
 
         ability_used = False
-        if phase == match.Phases.POSTLUDE:
+        if game.phase == Phases.POSTLUDE:
 
             player.health += 1
             player.healed += 1
-            player.cooldowns.append((Abilities.Rejuvenation, 3))
+            player.cooldowns[Abilities.Rejuvenation] = 3
 
             ability_used = True
-            Logger.log(player.username + " used Rejuvenation +1 Health Point", LogCodes.Ability)
+            game.note("{} used Rejuvenation +1 Health Point", LogCodes.Ability, player.username)
 
         return ability_used
 
     # Ability 03 - Recycling
     # Random draw a chance card for used cards - POSTLUDE - Cooldown: 2
     @staticmethod
-    def a_ability03(phase, player):
+    def a_ability03(game, player):
 
         ability_used = False
-        used_count = len(player.used_cards)
+        used_count = sum(player.used)
 
-        if phase == match.Phases.POSTLUDE:
+        if game.phase == Phases.POSTLUDE:
             if used_count:
 
-                random_card = random.randrange(0, used_count)
-                player.chance_cards.append(random_card)
-                player.used_cards.remove(random_card)
+                # Used cards are counted by chance so the draw picks among them in Chances order
+                position = game.rng.randrange(0, used_count)
+                random_card = 0
+                while position >= player.used[random_card]:
+
+                    position -= player.used[random_card]
+                    random_card += 1
+
+                player.gain_chance(random_card)
+                player.used[random_card] -= 1
 
                 ability_used = True
-                Logger.log(player.username + "used recycling +1 used Chance Card", LogCodes.Ability)
+                game.note("{} used recycling +1 used Chance Card", LogCodes.Ability, player.username)
 
         return ability_used
 
     # Ability 04 - Loneliness
     # Skip turn and gain 2 chance cards - PRELUDE - Cooldown: 2
     @staticmethod
-    def a_ability04(phase, player):
+    def a_ability04(game, player):
 
         ability_used = False
-        if phase == match.Phases.PRELUDE:
+        if game.phase == Phases.PRELUDE:
 
             Moves.select_move(player, Moves.SKIP)
-            Logger.log(player.username + " has selected their move" +
-                       " - id: " + str(Moves.SKIP), LogCodes.Ability)
+            game.note("{} has selected their move - id: {}", LogCodes.Ability, player.username, Moves.SKIP)
 
-            Chance.random_chance(player)
-            Chance.random_chance(player)
-            player.cooldowns.append((Abilities.Loneliness, 3))
+            Chance.random_chance(game, player)
+            Chance.random_chance(game, player)
+            player.cooldowns[Abilities.Loneliness] = 3
 
             ability_used = True
-            Logger.log(player.username + " used loneliness Skipping turn & +2 Chance Cards", LogCodes.Ability)
+            game.note("{} used loneliness Skipping turn & +2 Chance Cards", LogCodes.Ability, player.username)
 
         return ability_used
 
     # Ability 05 - Spotlight
     # First in strategy settlement - PRELUDE - Cooldown: 2
     @staticmethod
-    def a_ability05(phase, player):
+    def a_ability05(game, player):
 
         ability_used = False
-        if phase == match.Phases.PRELUDE:
+        if game.phase == Phases.PRELUDE:
 
             player.spotlight = True
-            player.cooldowns.append((Abilities.Spotlight, 3))
+            player.cooldowns[Abilities.Spotlight] = 3
 
             ability_used = True
-            Logger.log(player.username + " used Spotlight", LogCodes.Ability)
+            game.note("{} used Spotlight", LogCodes.Ability, player.username)
 
         return ability_used
 
     # Ability 07 - Critical Hit
     # Modifier x2 - PRELUDE - Cooldown: 2
     @staticmethod
-    def a_ability07(phase, player):
+    def a_ability07(game, player):
 
         ability_used = False
-        if phase == match.Phases.PRELUDE:
+        if game.phase == Phases.PRELUDE:
 
             player.modifier *= 2
-            player.cooldowns.append((Abilities.Critical, 3))
+            player.cooldowns[Abilities.Critical] = 3
 
             ability_used = True
-            Logger.log(player.username + " used Critical Hit 2x Damage", LogCodes.Ability)
+            game.note("{} used Critical Hit 2x Damage", LogCodes.Ability, player.username)
 
         return ability_used
 
@@ -210,16 +197,16 @@ class Ability:
     # chance gained on condition - POSTLUDE
     # condition: damage dodged >= 2
     @staticmethod
-    def p_ability01(phase, player):
+    def p_ability01(game, player):
 
         ability_used = False
-        if phase == match.Phases.POSTLUDE:
+        if game.phase == Phases.POSTLUDE:
             if player.dmg_dodged >= 2:
 
-                Chance.random_chance(player)
+                Chance.random_chance(game, player)
 
                 ability_used = True
-                Logger.log(player.username + " used Gentleman +1 Chance Card", LogCodes.Ability)
+                game.note("{} used Gentleman +1 Chance Card", LogCodes.Ability, player.username)
 
         return ability_used
 
@@ -227,20 +214,20 @@ class Ability:
     # give player a "can't guard" or "can't reverse" card - POSTLUDE - Cooldown: 2
     # condition: does not have either cards in hand
     @staticmethod
-    def p_ability02(phase, player):
+    def p_ability02(game, player):
 
         ability_used = False
-        if phase == match.Phases.POSTLUDE:
+        if game.phase == Phases.POSTLUDE:
 
             if not Chance.has_chance(player, Chances.NO_GUARD) and\
                     not Chance.has_chance(player, Chances.NO_REVERSE):
 
-                random_card = random.randrange(6, 8)
-                player.chance_cards.append(random_card)
-                player.cooldowns.append((Abilities.Hunting, 3))
+                random_card = game.rng.randrange(6, 8)
+                player.gain_chance(random_card)
+                player.cooldowns[Abilities.Hunting] = 3
 
                 ability_used = True
-                Logger.log(player.username + " used Hunting +1 (Can't Guard/Can't Reverse)", LogCodes.Ability)
+                game.note("{} used Hunting +1 (Can't Guard/Can't Reverse)", LogCodes.Ability, player.username)
 
         return ability_used
 
@@ -248,42 +235,34 @@ class Ability:
     # chance gained on condition - POSTLUDE
     # condition: damage dealt >= 2
     @staticmethod
-    def p_ability06(phase, player):
+    def p_ability06(game, player):
 
         ability_used = False
-        if phase == match.Phases.POSTLUDE:
+        if game.phase == Phases.POSTLUDE:
             if player.dmg_dealt >= 2:
 
-                Chance.random_chance(player)
+                Chance.random_chance(game, player)
 
                 ability_used = True
-                Logger.log(player.username + " used Attacker +1 Chance Card", LogCodes.Ability)
+                game.note("{} used Attacker +1 Chance Card", LogCodes.Ability, player.username)
 
         return ability_used
 
+    # Queues the messages notifying player and opponent about an ability that was used
     @staticmethod
-    def network_responses(player, opponent, ability_id):
-
-        player_response = None
-        opponent_response = None
+    def responses(game, player, opponent, ability_id):
 
         # Notify player and opponent about 1 HP gain
         if ability_id == Abilities.Rejuvenation:
 
-            player_response = Network.generate_responseb(
-                Flags.GAIN_HP, Flags.ONE_BYTE, 1)
-
-            opponent_response = Network.generate_responseb(
-                Flags.OP_GAIN_HP, Flags.ONE_BYTE, 1)
+            game.send(player, Flags.GAIN_HP, 1)
+            game.send(opponent, Flags.OP_GAIN_HP, 1)
 
         # Notify player and opponent about new damage modifier
         elif ability_id == Abilities.Critical:
 
-            player_response = Network.generate_responseb(
-                Flags.DMG_MODIFIED, Flags.ONE_BYTE, player.modifier)
-
-            opponent_response = Network.generate_responseb(
-                Flags.OP_DMG_MODIFIED, Flags.ONE_BYTE, player.modifier)
+            game.send(player, Flags.DMG_MODIFIED, player.modifier)
+            game.send(opponent, Flags.OP_DMG_MODIFIED, player.modifier)
 
         # Notify player and opponent about 1 chance card gain
         elif ability_id == Abilities.Gentleman or \
@@ -291,41 +270,23 @@ class Ability:
                 ability_id == Abilities.Recycling or\
                 ability_id == Abilities.Hunting:
 
-            player_response = Network.generate_responseb(
-                Flags.GAIN_CHANCE, Flags.ONE_BYTE, player.chance_card)
-
-            opponent_response = Network.generate_responseh(
-                Flags.OP_GAIN_CHANCE, Flags.ZERO_BYTE)
+            game.send(player, Flags.GAIN_CHANCE, player.chance_card)
+            game.send(opponent, Flags.OP_GAIN_CHANCE)
 
         # Notify player and opponent about spotlight ability
         elif ability_id == Abilities.Spotlight:
 
-            player_response = Network.generate_responseh(
-                Flags.SPOTLIGHT, Flags.ZERO_BYTE)
-
-            opponent_response = Network.generate_responseh(
-                Flags.OP_SPOTLIGHT, Flags.ZERO_BYTE)
+            game.send(player, Flags.SPOTLIGHT)
+            game.send(opponent, Flags.OP_SPOTLIGHT)
 
         # Notify player and opponent about 2 chance card gain
         elif ability_id == Abilities.Loneliness:
 
-            player_response = Network.generate_responseb(
-                Flags.GAIN_CHANCE, Flags.ONE_BYTE, player.pchance_card)
-
-            player_response += Network.generate_responseb(
-                Flags.GAIN_CHANCE, Flags.ONE_BYTE, player.chance_card)
-
-            opponent_response = Network.generate_responseh(
-                Flags.OP_GAIN_CHANCE, Flags.ZERO_BYTE)
-
-            opponent_response += Network.generate_responseh(
-                Flags.OP_GAIN_CHANCE, Flags.ZERO_BYTE)
-
-        if player_response:
-            Network.send_data(player.username, player.socket, player_response)
+            game.send(player, Flags.GAIN_CHANCE, player.previous_chance)
+            game.send(player, Flags.GAIN_CHANCE, player.chance_card)
 
-        if opponent_response:
-            Network.send_data(opponent.username, opponent.socket, opponent_response)
+            game.send(opponent, Flags.OP_GAIN_CHANCE)
+            game.send(opponent, Flags.OP_GAIN_CHANCE)
 
 active_map = {
 
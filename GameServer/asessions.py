@@ -0,0 +1,462 @@
+import asyncio
+
+from collections import deque
+from network import Network, WNetwork, RequestDecoder
+from flags import Flags
+from sessions import Session, request_map
+from encoding import Encodings
+from logger import Logger, LogCodes
+from metrics import Metrics
+from profiler import Profiler
+from websocket import FrameDecoder
+from outbound import OutboundQueue
+from lobby import Transfer
+from time import perf_counter
+
+
+# Wraps an asyncio stream so it can stand in for a client socket
+# Network.send_data and Match only ever call sendall, shutdown and close on a client
+# Writes never block but the transport buffer is held to the same limits as OutboundQueue
+class StreamClient:
+
+    def __init__(self, reader, writer, loop):
+
+        self.reader = reader
+        self.writer = writer
+        self.loop = loop
+        self.full_since = None
+
+        self.corked = 0
+        self.held = []
+
+    # Returns true if called from the thread running the event loop
+    def on_loop(self):
+
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    # Queues data on the transport - never blocks the caller
+    def sendall(self, data):
+
+        # Handlers run in the executor must hand their writes back to the event loop
+        if self.on_loop():
+            self.write(data)
+        else:
+            self.loop.call_soon_threadsafe(self.write, bytes(data))
+
+    # Holds writes until the matching uncork - only called on the event loop
+    def cork(self):
+        self.corked += 1
+
+    def uncork(self):
+
+        self.corked -= 1
+        if not self.corked and self.held:
+
+            chunks = self.held
+            self.held = []
+            self.write_chunks(chunks)
+
+    def write(self, data):
+
+        if self.corked:
+            self.held.append(data)
+        else:
+            self.write_chunks([data])
+
+    def write_chunks(self, chunks):
+
+        if self.writer.is_closing():
+            return
+
+        self.writer.writelines(chunks)
+
+        size = self.writer.transport.get_write_buffer_size()
+        if size > OutboundQueue.peak_bytes:
+            OutboundQueue.peak_bytes = size
+
+        if size > OutboundQueue.hard_limit:
+            self.disconnect("outbound queue overflowed")
+
+        elif size <= OutboundQueue.max_buffer:
+            self.full_since = None
+
+        elif self.full_since is None:
+
+            self.full_since = self.loop.time()
+            self.loop.call_later(OutboundQueue.stall_timeout, self.check_stall, self.full_since)
+
+    # Disconnects the client if its buffer has been over the limit since full_since
+    def check_stall(self, full_since):
+
+        if self.full_since == full_since and not self.writer.is_closing():
+            if self.writer.transport.get_write_buffer_size() > OutboundQueue.max_buffer:
+                self.disconnect("outbound queue stalled for " + str(OutboundQueue.stall_timeout) + "s")
+
+    def disconnect(self, reason):
+
+        Logger.warning("Disconnecting client, " + reason, LogCodes.Network)
+        Metrics.count('outbound', 'disconnects')
+
+        self.full_since = None
+        self.writer.transport.abort()
+
+    # Returns true once nothing is left to write - the transport writes on its own so this never blocks
+    def flush(self):
+        return not self.held and self.writer.transport.get_write_buffer_size() == 0
+
+    # Stops reading so nothing meant for the worker the socket is moving to is consumed here
+    def pause(self):
+        self.writer.transport.pause_reading()
+
+    # Reads again once the socket stays with this worker after all
+    def resume(self):
+        self.writer.transport.resume_reading()
+
+    def fileno(self):
+        return self.writer.get_extra_info('socket').fileno()
+
+    def shutdown(self, how=None):
+
+        if self.on_loop():
+            self.writer.close()
+        else:
+            self.loop.call_soon_threadsafe(self.writer.close)
+
+    def close(self):
+        self.shutdown()
+
+
+# Coroutine based session - runs the same request handlers as Session on a single event loop
+class ASession:
+
+    # Variables used by all sessions that must be set for it to work
+    server_running = True
+
+    card_information = None
+    card_catalogue = None
+    matchmaker = None
+    profile_cache = None
+    result_writer = None
+    admin_token = None
+
+    # Handlers that query the database are run in the executor so they do not stall the loop
+    blocking_flags = {Flags.LOGIN, Flags.WEB_LOGIN, Flags.LOGOUT, Flags.USER_PROFILE}
+
+    # Session helpers the request handlers rely on
+    verified = Session.verified
+    admin_authorized = Session.admin_authorized
+    send_catalogue = Session.send_catalogue
+    logout = Session.logout
+    _user_profile = Session._user_profile
+    _load_profile = Session._load_profile
+    match_ended = Session.match_ended
+    transfer_state = Session.transfer_state
+    restore = Session.restore
+
+    def __init__(self, reader, writer):
+
+        self.loop = asyncio.get_running_loop()
+
+        self.network = Network
+        self.decoder = None
+
+        # Requests decoded but not processed yet
+        self.pending = deque()
+
+        self.authenticated = False
+        self.encoding = Encodings.REPR
+        self.userprofile = {'username': 'Anonymous'}
+        self.reader = reader
+        self.client = StreamClient(reader, writer, self.loop)
+        self.client_address = writer.get_extra_info('peername')
+        self.match = None
+
+        # Set when the session was moved here from another worker still waiting for its match,
+        # and once it has been moved to another worker itself
+        self.ticket = None
+        self.moved = False
+
+    # Builds a session for a socket moved from another worker, must be called on the event loop
+    # state - the moved session's transfer_state
+    @staticmethod
+    async def adopt(client, state):
+
+        reader, writer = await asyncio.open_connection(sock=client)
+
+        session = ASession(reader, writer)
+        session.client_address = state['address']
+        session.decoder = session.restore(state)
+        return session
+
+    # Session loop - runs until server is being shutdown or client disconnects
+    async def run(self):
+
+        Logger.log("New session started", LogCodes.Session)
+
+        # Moved sessions already know their protocol and still owe the client its FIND_MATCH response
+        if self.ticket is not None:
+            await self.await_match(self.ticket)
+
+        else:
+            await self.detect_protocol()
+
+        while self.server_running and self.decoder:
+
+            # Receive every complete request - clients may pipeline several in one segment
+            # Requests moved here with the session are processed before anything new is read
+            if not self.pending:
+
+                messages = await self.read_messages()
+                if messages is None:
+                    break
+
+                self.pending.extend(messages)
+
+            while self.pending and self.server_running:
+
+                # Process clients request and check if successful
+                request = self.network.parse_message(self.pending.popleft())
+
+                if request:
+                    await self.process_request(request)
+
+                else:
+
+                    Logger.warning(self.userprofile['username'] +
+                                   " request could not be parsed, closing connection", LogCodes.Session)
+                    self.kill()
+
+        # The connection lives on in another worker so it is only closed here
+        if self.moved:
+
+            self.client.close()
+            Logger.log(self.userprofile['username'] + " moved to another worker", LogCodes.Session)
+            return
+
+        # Start shutting down session
+        # If the user has disconnected during a match they incur a loss
+        if self.match:
+            self.match.post(self.match.disconnect, self.userprofile['username'])
+
+        await self.loop.run_in_executor(None, self.logout)
+        self.client.close()
+
+        Logger.log(self.userprofile['username'] + " disconnected", LogCodes.Session)
+        Logger.log(
+            "Session for " + self.userprofile['username'] + " ending", LogCodes.Session)
+
+    # Reads the first bytes to pick the decoder, answering a WebSocket upgrade
+    async def detect_protocol(self):
+
+        # Streams can not be peeked so read the first bytes to check for a WebSocket upgrade
+        data = await self.receive_data(3)
+        if data == b'GET':
+
+            handshake = await self.receive_handshake()
+            if handshake is not None:
+                handshake = WNetwork.handshake_response((data + handshake).decode('utf-8'))
+
+            if handshake is not None:
+
+                self.network = WNetwork
+                self.decoder = FrameDecoder()
+                self.client.sendall(handshake)
+
+        elif data is not None:
+
+            # The sniffed bytes are the start of the first request
+            self.decoder = RequestDecoder()
+            self.decoder.feed(data)
+
+    def shutdown(self):
+        self.client.shutdown()
+
+    def kill(self):
+
+        self.server_running = False
+        self.matchmaker.cancel(self)
+        self.shutdown()
+
+    # Receives a fixed amount of data from client or returns none if error receiving
+    async def receive_data(self, data_size):
+
+        try:
+            data = await self.reader.readexactly(data_size)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            return None
+
+        Metrics.count('bytes_in', self.network.protocol, data_size)
+        return data
+
+    # Receives the rest of the HTTP upgrade request
+    async def receive_handshake(self):
+
+        try:
+            return await self.reader.readuntil(b'\r\n\r\n')
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            return None
+
+    # Reads until at least one message is complete and returns all of them in order
+    # Returns None once the connection is closed
+    async def read_messages(self):
+
+        decoder = self.decoder
+        while True:
+
+            messages = decoder.drain()
+            if decoder.outgoing:
+                self.client.sendall(decoder.take_outgoing())
+
+            if messages:
+                return messages
+
+            if decoder.closed:
+                return None
+
+            try:
+                data = await self.reader.read(65536)
+            except ConnectionError:
+                return None
+
+            if not data:
+                return None
+
+            Metrics.count('bytes_in', decoder.protocol, len(data))
+            decoder.feed(data)
+
+    async def process_request(self, request):
+
+        flag = request.flag
+
+        Logger.debug("Request: {} {} {}", LogCodes.Session, flag, request.token, request.size)
+        Logger.debug("Body: {}", LogCodes.Session, request.body)
+
+        # Check if the flag is valid
+        if Flags.valid_flag(flag):
+
+            start = perf_counter()
+
+            if flag == Flags.FIND_MATCH:
+                await self.find_match(request)
+
+            # Check if the flag pertains to the session
+            elif flag in self.blocking_flags:
+
+                if Profiler.active:
+                    await self.loop.run_in_executor(None, Profiler.run, 'sessions', request_map[flag], self, request)
+                else:
+                    await self.loop.run_in_executor(None, request_map[flag], self, request)
+
+            elif flag in request_map:
+
+                if Profiler.active:
+                    Profiler.run('sessions', request_map[flag], self, request)
+                else:
+                    request_map[flag](self, request)
+
+            # Check if the flag pertains to a match
+            # Matches have no pool in async mode so the request runs here on the event loop
+            # The match times the request once it has run
+            elif self.match:
+
+                self.match.post(self.match.process_request, self.userprofile['username'], request,
+                                self.match_ended)
+                return
+
+            Metrics.observe('request', Flags.flag_name(flag), perf_counter() - start)
+
+        else:
+
+            Logger.warning(
+                "Server does not support flag " + str(flag)
+                + ", closing connection", LogCodes.Session)
+            self.kill()
+
+    # Finds a match without blocking the event loop
+    async def find_match(self, request):
+
+        # Before finding a match ensure the user has their latest profile loaded
+        # Only a cache miss needs to leave the event loop
+        records = self.profile_cache.get(self.userprofile['userid'])
+        if records is None:
+            records = await self.loop.run_in_executor(None, self._load_profile)
+
+        self.userprofile['records'] = records
+
+        Logger.log(self.userprofile['username'] + " is finding a match", LogCodes.Match)
+        await self.await_match(self.matchmaker.enqueue(self))
+
+    # Waits until the matchmaker pairs this session or it is cancelled
+    async def await_match(self, ticket):
+
+        match = await asyncio.wrap_future(ticket.future)
+        if isinstance(match, Transfer):
+
+            await self.transfer(match)
+            return
+
+        self.match = match
+        if self.match is None:
+            return
+
+        Logger.log("Match starting for " + self.userprofile['username'] +
+                   " after waiting {:.1f}ms".format(ticket.wait_time * 1000), LogCodes.Match)
+
+        # At this point a match has been found so notify client
+        response = self.network.generate_responseb(Flags.FIND_MATCH, Flags.ONE_BYTE, Flags.SUCCESS)
+        self.network.send_data(self.userprofile['username'], self.client, response)
+
+    # The match is hosted by another worker - the socket is handed over and the session ends
+    # without logging out
+    # A session that could not be moved waits here for another match
+    async def transfer(self, transfer):
+
+        self.client.pause()
+
+        # Bytes the stream has read ahead of the decoder move with the session too
+        data = await self.read_buffered()
+        Metrics.count('bytes_in', self.decoder.protocol, len(data))
+        self.decoder.feed(data)
+
+        ticket = self.matchmaker.transfer(self, transfer)
+        if ticket is not None:
+
+            self.client.resume()
+            await self.await_match(ticket)
+            return
+
+        self.moved = True
+        self.server_running = False
+
+    # Returns what the stream has already read from the socket without waiting for more
+    # A read is only left waiting if the stream's buffer is empty, so one that has not finished after
+    # yielding to the loop once is cancelled having taken nothing
+    async def read_buffered(self):
+
+        data = bytearray()
+        while True:
+
+            read = asyncio.ensure_future(self.reader.read(65536))
+            await asyncio.sleep(0)
+
+            if not read.done():
+
+                read.cancel()
+                return bytes(data)
+
+            try:
+                chunk = read.result()
+            except ConnectionError:
+                chunk = None
+
+            if not chunk:
+                return bytes(data)
+
+            data += chunk
+
+    # Requests received but not read yet
+    def unread(self):
+        return self.decoder.unread()
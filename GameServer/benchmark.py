@@ -0,0 +1,465 @@
+#!/usr/bin/python3
+# Kitty War server benchmarks
+# Usage: python3 benchmark.py [encoding] [websocket] [hotpaths] [matches] [--matches N]
+#                             [--output FILE] [--baseline FILE]
+# --output writes every timing as JSON, a file written this way can be passed as --baseline to a
+# later run which then exits with status 1 if any timing got slower than the tolerance allows
+
+import argparse
+import json
+import os
+import platform
+import random
+import struct
+import sys
+import timeit
+import tracemalloc
+
+from time import perf_counter
+
+from encoding import Encoder, Encodings
+from buffers import SocketReader
+from websocket import FrameDecoder
+from network import Network, WNetwork, RequestDecoder
+from flags import Flags
+from engine import MatchEngine, Player
+from cat import Cats, Moves, Phases
+from chance import Chance, Chances
+from ability import Ability, Abilities
+
+# Microseconds per call of everything timed in this run, keyed by the printed name
+results = {}
+
+
+# Card rows shaped like the DictCursor results pull_card_data receives
+def sample_cards():
+
+    random.seed(0)
+
+    def text(length):
+        return ''.join(random.choice('abcdefghijklmnopqrstuvwxyz ') for _ in range(length))
+
+    return {
+        'cats': [{'id': i, 'title': text(10), 'description': text(120), 'health': 10,
+                  'ability_id': i, 'cat_id': i} for i in range(6)],
+        'moves': [{'id': i, 'title': text(8), 'description': text(80)} for i in range(4)],
+        'chances': [{'id': i, 'title': text(14), 'description': text(100), 'chance_id': i,
+                     'move_id': i // 3} for i in range(9)],
+        'abilities': [{'id': i, 'title': text(12), 'description': text(110), 'ability_id': i,
+                       'phase': i % 2, 'cooldown': 2, 'passive': i in (1, 2, 6)} for i in range(8)]
+    }
+
+
+def sample_profile():
+    return {'draw': 3, 'loss': 41, 'wins': 57, 'matches': 101, 'cats': [0, 1, 2]}
+
+
+# Prints the time per call in microseconds and the size of one result in bytes
+def report(name, function, number):
+
+    seconds = min(timeit.repeat(function, number=number, repeat=5)) / number
+    size = len(function())
+
+    results[name] = seconds * 1e6
+    print("{:<36}{:>12.2f}us{:>10}B".format(name, seconds * 1e6, size))
+
+
+# Compares the negotiated encodings against the str(dict) path the server used to take
+def bench_encoding():
+
+    cards = sample_cards()
+    profile = sample_profile()
+
+    print("{:<36}{:>14}{:>11}".format("encoding", "time/call", "size"))
+
+    report("ALL_CARDS str(dict)", lambda: str(cards).encode('utf-8'), 2000)
+    for encoding in Encodings:
+        report("ALL_CARDS " + encoding.name, lambda: Encoder.encode_cards(cards, encoding, 1), 2000)
+
+    report("CAT_CARDS str(dict)", lambda: str(cards['cats']).encode('utf-8'), 5000)
+    for encoding in Encodings:
+        report("CAT_CARDS " + encoding.name, lambda: Encoder.encode_cards(cards['cats'], encoding, 1), 5000)
+
+    report("USER_PROFILE str(dict)", lambda: str(profile).encode('utf-8'), 50000)
+    for encoding in Encodings:
+        report("USER_PROFILE " + encoding.name, lambda: Encoder.encode_profile(profile, encoding), 50000)
+
+
+# Masked client frame as a browser would send it
+def client_frame(opcode, payload, fin=True):
+
+    first = (0x80 if fin else 0) | opcode
+    if len(payload) <= 125:
+        header = struct.pack('!BB', first, 0x80 | len(payload))
+    elif len(payload) <= 65535:
+        header = struct.pack('!BBH', first, 0x80 | 126, len(payload))
+    else:
+        header = struct.pack('!BBQ', first, 0x80 | 127, len(payload))
+
+    mask_key = os.urandom(4)
+    return header + mask_key + bytes(byte ^ mask_key[index % 4] for index, byte in enumerate(payload))
+
+
+# Socket stand-in that replays a recorded byte stream
+class StreamSocket:
+
+    def __init__(self, data):
+
+        self.data = memoryview(data)
+        self.position = 0
+
+    def recv(self, size):
+
+        chunk = self.data[self.position:self.position + size].tobytes()
+        self.position += len(chunk)
+        return chunk
+
+    def recv_into(self, buffer):
+
+        size = min(len(buffer), len(self.data) - self.position)
+        buffer[:size] = self.data[self.position:self.position + size]
+        self.position += size
+        return size
+
+    def sendall(self, data):
+        pass
+
+
+# The frame reader the server used before FrameDecoder, with the extended length converted to an int
+# so frames over 125 bytes can be compared
+def legacy_read_frame(client):
+
+    def receive_data(size):
+
+        data = b''
+        while len(data) < size:
+            data += client.recv(size - len(data))
+
+        return data
+
+    decoded_payload = bytearray()
+    while True:
+
+        data = receive_data(2)
+        fin = (data[0] & 0x80) >> 7
+        payload_len = data[1] & 0x7F
+
+        if payload_len == 126:
+            payload_len = int.from_bytes(receive_data(2), 'big')
+        elif payload_len == 127:
+            payload_len = int.from_bytes(receive_data(8), 'big')
+
+        mask_key = receive_data(4)
+        payload = receive_data(payload_len)
+
+        unmasked = bytearray()
+        for index in range(len(payload)):
+            unmasked.append(payload[index] ^ mask_key[index % 4])
+
+        decoded_payload += unmasked
+        if fin == 1:
+            return decoded_payload
+
+
+# Prints frames read per second by the legacy reader and FrameDecoder for a stream of messages
+def report_frames(name, frames, messages):
+
+    stream = b''.join(frames)
+
+    def legacy():
+
+        client = StreamSocket(stream)
+        for _ in range(messages):
+            legacy_read_frame(client)
+
+    def current():
+
+        reader = SocketReader(StreamSocket(stream), FrameDecoder())
+        received = 0
+        while received < messages:
+            received += len(reader.read())
+
+    for reader_name, function in (("legacy", legacy), ("FrameDecoder", current)):
+
+        seconds = min(timeit.repeat(function, number=1, repeat=5))
+        results[name + " " + reader_name] = seconds / len(frames) * 1e6
+        print("{:<40}{:>12.0f}{:>10.0f}".format(name + " " + reader_name, len(frames) / seconds,
+                                                 len(stream) / seconds / 1e6))
+
+
+def bench_websocket():
+
+    random.seed(0)
+    request = bytes([4]) + b't' * 24
+
+    print("{:<40}{:>12}{:>10}".format("websocket", "frames/s", "MB/s"))
+
+    report_frames("request 25B", [client_frame(2, request) for _ in range(20000)], 20000)
+    report_frames("request 1KB", [client_frame(2, request + os.urandom(1000)) for _ in range(5000)], 5000)
+    report_frames("request 64KB", [client_frame(2, request + os.urandom(65536)) for _ in range(100)], 100)
+
+    fragmented = []
+    for _ in range(5000):
+        fragmented += [client_frame(2, request[:10], False), client_frame(0, request[10:20], False),
+                       client_frame(0, request[20:])]
+
+    report_frames("request 25B in 3 fragments", fragmented, 5000)
+
+
+# Prints the time per call in microseconds of a function whose result is not sized
+# Each of the repeats runs for at least 0.2s so short calls are not lost in timer noise
+# calls - calls function makes each time it runs
+def report_call(name, function, calls=1):
+
+    timer = timeit.Timer(function)
+    number = timer.autorange()[0]
+    seconds = min(timer.repeat(repeat=7, number=number)) / number / calls
+
+    results[name] = seconds * 1e6
+    print("{:<40}{:>12.3f}us".format(name, seconds * 1e6))
+
+
+# Two players part way through a match on an engine that logs nothing
+def sample_match():
+
+    p1 = Player('p1', [0, 1, 2])
+    p2 = Player('p2', [0, 1, 2])
+    p1.cat = Cats.Ragdoll
+    p2.cat = Cats.Maine
+
+    game = MatchEngine(p1, p2, random.Random(0))
+    game.phase = Phases.POSTLUDE
+    return game, p1, p2
+
+
+# The game rule and protocol functions run for every request of a match
+def bench_hotpaths():
+
+    game, p1, p2 = sample_match()
+
+    print("{:<40}{:>14}".format("hotpaths", "time/call"))
+
+    # Every pairing of moves with the modifiers chances and abilities set
+    pairings = []
+    for move in (Moves.PURR, Moves.GUARD, Moves.SCRATCH, Moves.SKIP):
+        for opponent_move in (Moves.PURR, Moves.GUARD, Moves.SCRATCH, Moves.SKIP):
+            pairings.append((move, opponent_move))
+
+    def combat():
+
+        for move, opponent_move in pairings:
+
+            p1.move = move
+            p2.move = opponent_move
+            p1.pierce = move == Moves.SCRATCH
+            p2.reverse = opponent_move == Moves.GUARD
+            MatchEngine.handle_combat(p1, p2)
+
+    report_call("MatchEngine.handle_combat", combat, len(pairings))
+
+    def select_chance():
+
+        p1.move = Moves.SCRATCH
+        p1.selected_chance = False
+        p1.hand[Chances.NO_GUARD] = 1
+        p1.used[Chances.NO_GUARD] = 0
+        Chance.select_chance(p1, Chances.NO_GUARD)
+
+    report_call("Chance.select_chance", select_chance)
+
+    def use_chances():
+
+        p1.hand = bytearray(len(Chances))
+        for chance in Chances:
+            Chance.use_chance(game, chance, p1)
+
+    report_call("Chance.use_chance (chance_map)", use_chances, len(Chances))
+
+    def passive_abilities():
+
+        p1.hand = bytearray(len(Chances))
+        p1.cooldowns[Abilities.Hunting] = 0
+        p1.dmg_dodged = 2
+        p1.dmg_dealt = 2
+
+        for ability_id in (Abilities.Gentleman, Abilities.Hunting, Abilities.Attacker, Abilities.Rejuvenation):
+            Ability.use_passive_ability(game, p1, p2, ability_id)
+
+        game.take_messages()
+
+    report_call("Ability.use_passive_ability", passive_abilities, 4)
+
+    def decrease_cooldowns():
+
+        p1.cooldowns[Abilities.Rejuvenation] = 3
+        p1.cooldowns[Abilities.Spotlight] = 2
+        p1.cooldowns[Abilities.Critical] = 1
+        Ability.decrease_cooldowns(p1)
+
+    report_call("Ability.decrease_cooldowns", decrease_cooldowns)
+
+    # Replaces Network.parse_request, which read the header and body with separate recvs
+    request = bytes([Flags.SELECT_MOVE]) + b't' * 24 + (1).to_bytes(3, 'big') + b'2'
+    requests = request * 1000
+
+    def decode_requests():
+
+        decoder = RequestDecoder()
+        decoder.feed(requests)
+        decoder.drain()
+
+    report_call("RequestDecoder.decode", decode_requests, 1000)
+
+    report_call("Network.generate_responseb", lambda: Network.generate_responseb(
+        Flags.GAIN_HP, Flags.ONE_BYTE, 9))
+
+    # Replaces WNetwork.read_frame
+    frames = client_frame(2, bytes([Flags.SELECT_MOVE]) + b't' * 24 + b'\x02') * 1000
+
+    def decode_frames():
+
+        decoder = FrameDecoder()
+        decoder.feed(frames)
+        decoder.drain()
+
+    report_call("FrameDecoder.decode", decode_frames, 1000)
+
+    report_call("WNetwork.generate_responseb", lambda: WNetwork.generate_responseb(
+        Flags.GAIN_HP, Flags.ONE_BYTE, 9))
+    report_call("WNetwork.write_frame", lambda: WNetwork.write_frame(Flags.NEXT_PHASE, Flags.ZERO_BYTE))
+
+
+# Memory held by count matches waiting on their next round and the time to play a round of each
+# Every match is set up with both players at high health so none of them end during the round
+def bench_matches(count):
+
+    print("{:<40}{:>14}".format("matches", "per match"))
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+
+    games = []
+    for index in range(count):
+
+        p1 = Player('p1', [0, 1, 2])
+        p2 = Player('p2', [0, 1, 2])
+
+        game = MatchEngine(p1, p2, random.Random(index))
+        for player, cat in ((p1, Cats.Ragdoll), (p2, Cats.Maine)):
+
+            game.handle(player, Flags.SELECT_CAT, str(cat.id))
+            player.health = 100
+
+        for player in (p1, p2):
+            game.handle(player, Flags.READY, None)
+
+        games.append((game, p1, p2))
+
+    size = (tracemalloc.get_traced_memory()[0] - before) / count
+    tracemalloc.stop()
+
+    print("{:<40}{:>12.0f}B".format("memory at " + str(count) + " matches", size))
+
+    # Each player picks a move and plays a card suiting it if they hold one
+    suits = {Moves.PURR: (Chances.DOUBLE_PURR, Chances.GUARANTEED_PURR, Chances.PURR_DRAW),
+             Moves.GUARD: (Chances.REVERSE_SCRATCH, Chances.GUARD_HEAL, Chances.GUARD_DRAW),
+             Moves.SCRATCH: (Chances.NO_REVERSE, Chances.NO_GUARD, Chances.DOUBLE_SCRATCH)}
+    rng = random.Random(0)
+
+    start = perf_counter()
+    for game, p1, p2 in games:
+
+        for player in (p1, p2):
+            game.handle(player, Flags.READY, None)
+
+        for player in (p1, p2):
+
+            move = rng.choice(list(suits))
+            game.handle(player, Flags.SELECT_MOVE, str(int(move)))
+
+            for chance in suits[move]:
+                if Chance.has_chance(player, chance):
+
+                    game.handle(player, Flags.USE_CHANCE, str(int(chance)))
+                    break
+
+            game.handle(player, Flags.READY, None)
+
+        for _ in range(3):
+            for player in (p1, p2):
+                game.handle(player, Flags.READY, None)
+
+    seconds = (perf_counter() - start) / count
+
+    results["round at " + str(count) + " matches"] = seconds * 1e6
+    print("{:<40}{:>12.3f}us".format("round at " + str(count) + " matches", seconds * 1e6))
+
+
+# Prints how each timing changed against a baseline written by --output
+# Returns the names of the timings that got slower than tolerance allows
+def compare(baseline, tolerance):
+
+    regressions = []
+
+    print("{:<40}{:>12}{:>12}{:>9}".format("baseline", "before", "after", "change"))
+    for name in sorted(results):
+
+        before = baseline.get(name)
+        if before is None:
+            continue
+
+        change = results[name] / before - 1 if before else 0.0
+        regressed = change > tolerance
+        if regressed:
+            regressions.append(name)
+
+        print("{:<40}{:>10.3f}us{:>10.3f}us{:>+8.0%}{}".format(
+            name, before, results[name], change, "  REGRESSION" if regressed else ""))
+
+    return regressions
+
+
+benchmarks = {
+    'encoding': bench_encoding,
+    'websocket': bench_websocket,
+    'hotpaths': bench_hotpaths,
+    'matches': lambda: bench_matches(args.matches)
+}
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="KittyWar server benchmarks")
+    parser.add_argument('benchmarks', nargs='*', metavar='benchmark',
+                        help="any of " + ", ".join(benchmarks) + ", all of them by default")
+    parser.add_argument('--output', help="write the timings as JSON to this file")
+    parser.add_argument('--baseline', help="compare the timings with a file written by --output")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="fraction a timing may grow over the baseline before it is a regression")
+    parser.add_argument('--matches', type=int, default=100000, metavar='N',
+                        help="matches held at once by the matches benchmark")
+    args = parser.parse_args()
+
+    for bench_name in args.benchmarks:
+        if bench_name not in benchmarks:
+            parser.error("unknown benchmark " + bench_name)
+
+    for bench_name in args.benchmarks or list(benchmarks):
+
+        print("== " + bench_name + " ==")
+        benchmarks[bench_name]()
+
+    if args.output:
+
+        with open(args.output, 'w') as output:
+            json.dump({'python': platform.python_version(), 'machine': platform.machine(),
+                       'results': results}, output, indent=2, sort_keys=True)
+
+    if args.baseline:
+
+        with open(args.baseline) as baseline:
+            regressions = compare(json.load(baseline)['results'], args.tolerance)
+
+        if regressions:
+
+            print(str(len(regressions)) + " regressed: " + ", ".join(regressions))
+            sys.exit(1)
@@ -0,0 +1,142 @@
+from metrics import Metrics
+from logger import Logger, LogCodes
+
+
+# Reusable receive buffer shared by the protocol decoders
+# Bytes are written straight into the buffer (recv_into(writable()) then advance, or feed) and
+# decoders parse them through memoryview slices, so nothing is copied until a message is built
+# Subclasses implement decode, returning the next complete message or None
+class ReceiveBuffer:
+
+    # Name used when recording traffic metrics
+    protocol = None
+
+    def __init__(self, buffer_size=65536):
+
+        self.buffer = bytearray(buffer_size)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+
+        # Size of the message waiting on more bytes, the buffer is grown to fit it
+        self.needed = 0
+
+        # Replies the decoder has to send itself (e.g. WebSocket pongs), sent by the owner
+        self.outgoing = bytearray()
+        self.closed = False
+
+    # Returns the free space at the end of the buffer, making room for at least size bytes
+    def writable(self, size=4096):
+
+        size = max(size, self.needed - (self.end - self.start))
+
+        if self.start == self.end:
+            self.start = self.end = 0
+
+        if len(self.buffer) - self.end < size:
+
+            pending = self.end - self.start
+            if len(self.buffer) - pending >= size:
+                self.buffer[:pending] = self.view[self.start:self.end].tobytes()
+
+            else:
+
+                buffer = bytearray(max(len(self.buffer) * 2, pending + size))
+                buffer[:pending] = self.view[self.start:self.end]
+
+                self.buffer = buffer
+                self.view = memoryview(buffer)
+
+            self.start = 0
+            self.end = pending
+
+        return self.view[self.end:]
+
+    # Marks count bytes written into writable() as received
+    def advance(self, count):
+        self.end += count
+
+    def feed(self, data):
+
+        self.writable(len(data))[:len(data)] = data
+        self.end += len(data)
+
+    def decode(self):
+        raise NotImplementedError
+
+    # Returns every complete message in the buffer, in the order they were received
+    def drain(self):
+
+        messages = []
+        while not self.closed:
+
+            # A message the decoder can not make sense of ends the connection, the session
+            # then cleans up as if the client had disconnected
+            try:
+                message = self.decode()
+            except Exception as error:
+
+                Logger.warning("Could not decode " + str(self.protocol) + " message: " + str(error), LogCodes.Network)
+                self.closed = True
+                break
+
+            if message is None:
+                break
+
+            messages.append(message)
+
+        return messages
+
+    # Returns and clears the replies waiting to be sent
+    def take_outgoing(self):
+
+        outgoing = bytes(self.outgoing)
+        self.outgoing.clear()
+        return outgoing
+
+    # Bytes received but not decoded yet
+    def unread(self):
+        return bytes(self.view[self.start:self.end])
+
+
+# Reads messages from a blocking socket through a decoder
+class SocketReader:
+
+    def __init__(self, client, decoder):
+
+        self.client = client
+        self.decoder = decoder
+
+    # Blocks until at least one message is complete and returns all of them
+    # Clients may pipeline several requests in one segment, they are returned in order
+    # Returns None once the connection is closed
+    def read(self):
+
+        decoder = self.decoder
+        while True:
+
+            messages = decoder.drain()
+            if decoder.outgoing:
+
+                # noinspection PyBroadException
+                try:
+                    self.client.sendall(decoder.take_outgoing())
+                except:
+                    pass
+
+            if messages:
+                return messages
+
+            if decoder.closed:
+                return None
+
+            try:
+                received = self.client.recv_into(decoder.writable())
+            except OSError:
+                return None
+
+            if not received:
+                return None
+
+            Metrics.count('bytes_in', decoder.protocol, received)
+            decoder.advance(received)
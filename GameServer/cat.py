@@ -72,3 +72,13 @@ class Cats(Enum):
         self.id = id
         self.hp = hp
         self.ability_id = ability_id
+
+
+class Phases(IntEnum):
+
+    SETUP = 0
+    PRELUDE = 1
+    ENACT_STRATS = 2
+    SHOW_CARDS = 3
+    SETTLE_STRATS = 4
+    POSTLUDE = 5
@@ -0,0 +1,67 @@
+import zlib
+
+from network import Network, WNetwork
+from flags import Flags
+from encoding import Encoder, Encodings
+
+
+# One card catalogue response encoded once for every protocol and encoding
+# The version is the CRC32 of the repr body so legacy clients can compute it from a response they
+# already hold - JSON and binary bodies carry the version themselves
+class CatalogueEntry:
+
+    protocols = (Network, WNetwork)
+
+    def __init__(self, flag, cards):
+
+        self.flag = flag
+        self.body = Encoder.encode_cards(cards, Encodings.REPR)
+        self.version = zlib.crc32(self.body)
+
+        # Finished responses keyed by encoding and protocol
+        # A client already holding this version is sent an empty body instead
+        self.bodies = {}
+        self.responses = {}
+        self.not_modified = {}
+
+        for encoding in Encodings:
+
+            body = Encoder.encode_cards(cards, encoding, self.version)
+            self.bodies[encoding] = body
+
+            for network in self.protocols:
+                self.responses[(encoding, network)] = bytes(network.generate_responseh(flag, len(body)) + body)
+
+        for network in self.protocols:
+            self.not_modified[network] = bytes(network.generate_responseh(flag, Flags.ZERO_BYTE))
+
+    # Returns the cached response for the protocol and encoding
+    # version - the version the client sent in its request body, if any
+    def response(self, network, version=None, encoding=Encodings.REPR):
+
+        if version is not None and version == str(self.version):
+            return self.not_modified[network]
+
+        return self.responses[(encoding, network)]
+
+
+# All card catalogues the server hands out, built once when card data is pulled
+class CardCatalogue:
+
+    def __init__(self, card_information):
+
+        self.information = card_information
+        self.entries = {
+
+            Flags.ALL_CARDS:     CatalogueEntry(Flags.ALL_CARDS, card_information),
+            Flags.CAT_CARDS:     CatalogueEntry(Flags.CAT_CARDS, card_information['cats']),
+            Flags.BASIC_CARDS:   CatalogueEntry(Flags.BASIC_CARDS, card_information['moves']),
+            Flags.CHANCE_CARDS:  CatalogueEntry(Flags.CHANCE_CARDS, card_information['chances']),
+            Flags.ABILITY_CARDS: CatalogueEntry(Flags.ABILITY_CARDS, card_information['abilities'])
+        }
+
+    def version(self, flag):
+        return self.entries[flag].version
+
+    def response(self, flag, network, version=None, encoding=Encodings.REPR):
+        return self.entries[flag].response(network, version, encoding)
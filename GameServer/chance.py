@@ -1,7 +1,5 @@
-import random
-
 from logger import Logger, LogCodes
-from network import Network, Flags
+from flags import Flags
 from enum import IntEnum
 from cat import Moves
 
@@ -31,23 +29,24 @@ class Chance:
 
     # Assigns a random chance card to the specified player
     @staticmethod
-    def random_chance(player):
+    def random_chance(game, player):
 
-        chance_card = random.randrange(0, 9)
-        player.chance_cards.append(chance_card)
+        chance_card = game.rng.randrange(0, 9)
+        player.gain_chance(chance_card)
 
     # Checks if the player has the chance card they selected to use
     @staticmethod
     def has_chance(player, chance):
 
-        has = player.chance_cards.count(chance) != 0
+        has = player.hand[chance] != 0
 
         if has:
-            Logger.log(player.username + " has chance card: " + str(chance), LogCodes.Chance)
+            Logger.debug("{} has chance card: {}", LogCodes.Chance, player.username, chance)
         else:
-            Logger.log(player.username + " does not have chance card: " + str(chance), LogCodes.Chance)
+            Logger.debug("{} does not have chance card: {}", LogCodes.Chance, player.username, chance)
 
-        Logger.log(player.username + "'s currently owned chance cards: " + str(player.chance_cards), LogCodes.Chance)
+        Logger.debug("{}'s currently owned chance cards by id: {}", LogCodes.Chance,
+                     player.username, bytes(player.hand))
 
         return has
 
@@ -57,7 +56,7 @@ class Chance:
 
         valid_chance = Chance.valid_chance(chance)
         matches_move = Chance.matches_move(player, chance)
-        has_chance = Chance.has_chance(player, chance)
+        has_chance = valid_chance and Chance.has_chance(player, chance)
         selected_chance = player.selected_chance
         skipping = player.move == Moves.SKIP
 
@@ -66,16 +65,16 @@ class Chance:
 
         if valid:
 
-            player.used_cards.append(chance)
-            player.chance_cards.remove(chance)
+            player.use_chance(chance)
             player.selected_chance = True
 
         return valid
 
     # Handles the user using a chance they selected
+    # Returns whether chances that depend on the outcome of combat took effect
     @staticmethod
-    def use_chance(chance_card, player):
-        chance_map[chance_card](player)
+    def use_chance(game, chance_card, player):
+        return chance_map[chance_card](game, player)
 
     # Check if the chance corresponds with the selected move
     @staticmethod
@@ -93,9 +92,9 @@ class Chance:
             else:
                 matches = player.move == Moves.SCRATCH
 
-        Logger.log(player.username + "'s selected move: " + str(player.move), LogCodes.Chance)
-        Logger.log(player.username + "'s chance they want to use: " + str(chance), LogCodes.Chance)
-        Logger.log(player.username + " chance matches move: " + str(matches), LogCodes.Chance)
+        Logger.debug("{}'s selected move: {}", LogCodes.Chance, player.username, player.move)
+        Logger.debug("{}'s chance they want to use: {}", LogCodes.Chance, player.username, chance)
+        Logger.debug("{} chance matches move: {}", LogCodes.Chance, player.username, matches)
         return matches
 
     # Check if a particular chance should be used before settling the strategies
@@ -120,135 +119,133 @@ class Chance:
     # Chance 00 - Double Purring
     # Gain 2 HP if you don't get attacked
     @staticmethod
-    def chance_00(player):
+    def chance_00(game, player):
 
         chance_used = False
         if player.dmg_taken == 0:
 
             player.health += 2
             player.healed += 2
-            Logger.log(player.username + " using Purr Chance 00 Double Purring", LogCodes.Chance)
-            Logger.log(player.username + " gained two health points for not taking damage", LogCodes.Chance)
+            game.note("{} using Purr Chance 00 Double Purring", LogCodes.Chance, player.username)
+            game.note("{} gained two health points for not taking damage", LogCodes.Chance, player.username)
             chance_used = True
 
         else:
-            Logger.log(player.username + " could not use Purr Chance 00 Double Purring", LogCodes.Chance)
+            game.note("{} could not use Purr Chance 00 Double Purring", LogCodes.Chance, player.username)
 
         return chance_used
 
     # Chance 01 - Guaranteed Purring
     # Gain 1 HP no matter what
     @staticmethod
-    def chance_01(player):
+    def chance_01(game, player):
 
         player.health += 1
         player.healed += 1
         player.invulnerable = True
-        Logger.log(player.username + " using Purr Chance 01 Guaranteed Purring", LogCodes.Chance)
-        Logger.log(player.username + " gained one health point and is now invulnerable", LogCodes.Chance)
+        game.note("{} using Purr Chance 01 Guaranteed Purring", LogCodes.Chance, player.username)
+        game.note("{} gained one health point and is now invulnerable", LogCodes.Chance, player.username)
 
     # Chance 02 - Purr and Draw
     # Gain 1 chance card if you heal
     @staticmethod
-    def chance_02(player):
+    def chance_02(game, player):
 
         chance_used = False
         if player.healed > 0:
 
-            Chance.random_chance(player)
-            Logger.log(player.username + " using Purr Chance 02 Purr and Draw", LogCodes.Chance)
-            Logger.log(player.username + " gained one chance card for healing", LogCodes.Chance)
+            Chance.random_chance(game, player)
+            game.note("{} using Purr Chance 02 Purr and Draw", LogCodes.Chance, player.username)
+            game.note("{} gained one chance card for healing", LogCodes.Chance, player.username)
             chance_used = True
 
         else:
-            Logger.log(player.username + " could not use Purr Chance 02 Purr and Draw", LogCodes.Chance)
+            game.note("{} could not use Purr Chance 02 Purr and Draw", LogCodes.Chance, player.username)
 
         return chance_used
 
     # Chance 03 - Reverse Scratch
     # Reverse the damage
     @staticmethod
-    def chance_03(player):
+    def chance_03(game, player):
 
         player.reverse = True
-        Logger.log(player.username + " using Guard Chance 03 Reverse Scratch", LogCodes.Chance)
-        Logger.log(player.username + "'is reversing incoming damage", LogCodes.Chance)
+        game.note("{} using Guard Chance 03 Reverse Scratch", LogCodes.Chance, player.username)
+        game.note("{}'is reversing incoming damage", LogCodes.Chance, player.username)
 
     # Chance 04 - Guard and Heal
     # Gain 1 HP if you dodge
     @staticmethod
-    def chance_04(player):
+    def chance_04(game, player):
 
         chance_used = False
         if player.dmg_dodged > 0:
 
             player.health += 1
             player.healed += 1
-            Logger.log(player.username + " using Guard Chance 04 Guard and Heal", LogCodes.Chance)
-            Logger.log(player.username + " gained one health point for dodging", LogCodes.Chance)
+            game.note("{} using Guard Chance 04 Guard and Heal", LogCodes.Chance, player.username)
+            game.note("{} gained one health point for dodging", LogCodes.Chance, player.username)
             chance_used = True
 
         else:
-            Logger.log(player.username + " could not use Guard Chance 04 Guard and Heal", LogCodes.Chance)
+            game.note("{} could not use Guard Chance 04 Guard and Heal", LogCodes.Chance, player.username)
 
         return chance_used
 
     # Chance 05 - Guard and Draw
     # Gain 1 chance card if you dodge
     @staticmethod
-    def chance_05(player):
+    def chance_05(game, player):
 
         chance_used = False
         if player.dmg_dodged > 0:
 
-            Chance.random_chance(player)
-            Logger.log(player.username + " using Guard Chance 05 Guard and Draw", LogCodes.Chance)
-            Logger.log(player.username + " gained one chance card for dodging", LogCodes.Chance)
+            Chance.random_chance(game, player)
+            game.note("{} using Guard Chance 05 Guard and Draw", LogCodes.Chance, player.username)
+            game.note("{} gained one chance card for dodging", LogCodes.Chance, player.username)
             chance_used = True
 
         else:
-            Logger.log(player.username + " could not use Guard Chance 05 Guard and Draw", LogCodes.Chance)
+            game.note("{} could not use Guard Chance 05 Guard and Draw", LogCodes.Chance, player.username)
 
         return chance_used
 
     # Chance 06 - Cant't reverse
     # Can't reverse the damage
     @staticmethod
-    def chance_06(player):
+    def chance_06(game, player):
 
         player.irreversible = True
-        Logger.log(player.username + " using Scratch Chance 06 Can't Reverse", LogCodes.Chance)
-        Logger.log(player.username + "'s attack can't be reversed", LogCodes.Chance)
+        game.note("{} using Scratch Chance 06 Can't Reverse", LogCodes.Chance, player.username)
+        game.note("{}'s attack can't be reversed", LogCodes.Chance, player.username)
 
     # Chance 07 - Can't Guard
     # Scratch can't be dodged
     @staticmethod
-    def chance_07(player):
+    def chance_07(game, player):
 
         player.pierce = True
-        Logger.log(player.username + " using Scratch Chance 07 Can't Guard", LogCodes.Chance)
-        Logger.log(player.username + "'s attack can't be dodged", LogCodes.Chance)
+        game.note("{} using Scratch Chance 07 Can't Guard", LogCodes.Chance, player.username)
+        game.note("{}'s attack can't be dodged", LogCodes.Chance, player.username)
 
     # Chance 08 - Double Scratch
     # Scratch twice - x2 Damage
     @staticmethod
-    def chance_08(player):
+    def chance_08(game, player):
 
         player.modifier *= 2
-        Logger.log(player.username + " using Scratch Chance 08 Double Scratch", LogCodes.Chance)
-        Logger.log(player.username + "'s Attack Modifier: " + str(player.modifier), LogCodes.Chance)
+        game.note("{} using Scratch Chance 08 Double Scratch", LogCodes.Chance, player.username)
+        game.note("{}'s Attack Modifier: {}", LogCodes.Chance, player.username, player.modifier)
 
+    # Queues the messages notifying player and opponent about a chance card drawn by a chance
     @staticmethod
-    def chance_responses(chance_id, player, opponent):
+    def chance_responses(game, chance_id, player, opponent):
 
         if chance_id == Chances.GUARD_DRAW or \
                 chance_id == Chances.PURR_DRAW:
 
-            response = Network.generate_responseb(Flags.GAIN_CHANCE, Flags.ONE_BYTE, player.chance_card)
-            Network.send_data(player.username, player.connection, response)
-
-            response = Network.generate_responseh(Flags.OP_GAIN_CHANCE, Flags.ZERO_BYTE)
-            Network.send_data(opponent.username, opponent.connection, response)
+            game.send(player, Flags.GAIN_CHANCE, player.chance_card)
+            game.send(opponent, Flags.OP_GAIN_CHANCE)
 
 chance_map = {
 
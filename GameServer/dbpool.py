@@ -0,0 +1,261 @@
+from collections import deque
+from contextlib import contextmanager
+from threading import Condition
+from time import monotonic
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+# An idle connection along with when it was opened and last returned to the pool
+class PooledConnection:
+
+    def __init__(self, connection, created):
+
+        self.connection = connection
+        self.created = created
+        self.last_used = created
+
+
+# Bounded thread safe pool of database connections
+# Connections are health checked before reuse, evicted when idle too long
+# and retired once they pass their maximum lifetime
+class ConnectionPool:
+
+    def __init__(self, connect, max_size=10, idle_timeout=300, max_lifetime=3600,
+                 check_interval=30, wait_timeout=10):
+
+        # connect - callable that opens a new connection
+        # idle_timeout - seconds an unused connection is kept around
+        # max_lifetime - seconds before a connection is closed regardless of use
+        # check_interval - connections idle longer than this are pinged before reuse
+        # wait_timeout - seconds to wait for a free connection before giving up
+        self.connect = connect
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.check_interval = check_interval
+        self.wait_timeout = wait_timeout
+
+        self._available = Condition()
+        self._idle = deque()
+        self._in_use = {}
+        self._size = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.timeouts = 0
+        self.evictions = 0
+        self.failed_checks = 0
+
+    # Borrows a connection from the pool, opening a new one if none are idle
+    def acquire(self):
+
+        start = monotonic()
+        deadline = start + self.wait_timeout
+        waited = False
+
+        while True:
+
+            with self._available:
+
+                stale = self._evict(monotonic())
+                entry = None
+
+                while not self._idle and self._size >= self.max_size:
+
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+
+                        self.timeouts += 1
+                        self._close_all(stale)
+                        raise PoolTimeout("No database connection available after " +
+                                          str(self.wait_timeout) + "s")
+
+                    waited = True
+                    self._available.wait(remaining)
+
+                if self._idle:
+                    entry = self._idle.pop()
+
+                else:
+
+                    # Reserve a slot so the connection can be opened outside the lock
+                    self._size += 1
+                    self.misses += 1
+
+                if waited:
+
+                    self.waits += 1
+                    self.wait_time += monotonic() - start
+                    waited = False
+
+            self._close_all(stale)
+
+            if entry is None:
+                return self._open()
+
+            # Connections that sat idle for a while may have been dropped by the server
+            if monotonic() - entry.last_used < self.check_interval or self._healthy(entry.connection):
+
+                with self._available:
+
+                    self.hits += 1
+                    self._in_use[id(entry.connection)] = entry
+
+                return entry.connection
+
+            self.failed_checks += 1
+            self._discard(entry.connection)
+
+    # Returns a borrowed connection - broken connections are closed instead of reused
+    def release(self, connection, broken=False):
+
+        now = monotonic()
+        with self._available:
+
+            entry = self._in_use.pop(id(connection), None)
+            expired = entry is None or now - entry.created >= self.max_lifetime
+
+            if broken or expired:
+
+                self._size -= 1
+                self._available.notify()
+
+            else:
+
+                entry.last_used = now
+                self._idle.append(entry)
+                self._available.notify()
+                connection = None
+
+        if connection is not None:
+            self._close(connection)
+
+    # Borrow a connection for the duration of a with block
+    @contextmanager
+    def connection(self):
+
+        connection = self.acquire()
+        broken = False
+
+        try:
+            yield connection
+        except Exception:
+            broken = True
+            raise
+        finally:
+            self.release(connection, broken)
+
+    # Closes every idle connection, borrowed connections are closed when released
+    def close(self):
+
+        with self._available:
+
+            stale = [entry.connection for entry in self._idle]
+            self._size -= len(self._idle)
+            self._idle.clear()
+            self._available.notify_all()
+
+        self._close_all(stale)
+
+    def stats(self):
+
+        with self._available:
+
+            requests = self.hits + self.misses
+            return {
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': len(self._in_use),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / requests if requests else 0.0,
+                'waits': self.waits,
+                'wait_time': self.wait_time,
+                'avg_wait': self.wait_time / self.waits if self.waits else 0.0,
+                'timeouts': self.timeouts,
+                'evictions': self.evictions,
+                'failed_checks': self.failed_checks
+            }
+
+    # Opens a connection for a slot that was already reserved
+    def _open(self):
+
+        try:
+            connection = self.connect()
+        except Exception:
+
+            with self._available:
+
+                self._size -= 1
+                self._available.notify()
+
+            raise
+
+        with self._available:
+            self._in_use[id(connection)] = PooledConnection(connection, monotonic())
+
+        return connection
+
+    # Removes idle connections past their idle timeout or lifetime - lock must be held
+    # Returns the removed connections so they can be closed after the lock is released
+    def _evict(self, now):
+
+        stale = []
+        kept = deque()
+
+        # Oldest returned connections sit at the left of the deque
+        while self._idle:
+
+            entry = self._idle.popleft()
+            if now - entry.last_used >= self.idle_timeout or now - entry.created >= self.max_lifetime:
+                stale.append(entry.connection)
+            else:
+                kept.append(entry)
+
+        self._idle = kept
+        self._size -= len(stale)
+        self.evictions += len(stale)
+
+        if stale:
+            self._available.notify(len(stale))
+
+        return stale
+
+    def _discard(self, connection):
+
+        with self._available:
+
+            self._size -= 1
+            self._available.notify()
+
+        self._close(connection)
+
+    @staticmethod
+    def _healthy(connection):
+
+        # noinspection PyBroadException
+        try:
+            connection.ping(reconnect=False)
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def _close(connection):
+
+        # noinspection PyBroadException
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    @staticmethod
+    def _close_all(connections):
+
+        for connection in connections:
+            ConnectionPool._close(connection)
@@ -0,0 +1,175 @@
+import json
+import struct
+
+from enum import IntEnum
+
+
+# Payload encodings a client can negotiate with SET_ENCODING
+class Encodings(IntEnum):
+
+    @staticmethod
+    def valid_encoding(encoding):
+        return encoding in list(map(int, Encodings))
+
+    REPR = 0
+    JSON = 1
+    BINARY = 2
+
+
+# Column types used by binary record layouts
+class ColumnTypes(IntEnum):
+
+    BOOL = 0
+    INT32 = 1
+    INT64 = 2
+    DOUBLE = 3
+    STRING = 4
+
+
+# Encodes card catalogues and user profiles for each negotiated encoding
+#
+# Binary catalogue layout (big endian):
+#   u8 format version | u32 catalogue version | table(s)
+#   ALL_CARDS holds u8 table count followed by (u8 name length, name, table) for each table
+#   table: u16 record count | u8 column count | (u8 type, u8 name length, name) per column | records
+#   record: fixed width numeric columns packed in column order, then (u16 length, utf-8) per string
+#   A string length of 0xFFFF marks a null value
+#
+# Binary profile layout: u32 wins | u32 loss | u32 draw | u32 matches | u8 cat count | u8 per cat id
+class Encoder:
+
+    format_version = 1
+    null_string = 0xFFFF
+
+    numeric_formats = {
+        ColumnTypes.BOOL: '?',
+        ColumnTypes.INT32: 'i',
+        ColumnTypes.INT64: 'q',
+        ColumnTypes.DOUBLE: 'd'
+    }
+
+    header = struct.Struct('>BI')
+    table_header = struct.Struct('>HB')
+    profile = struct.Struct('>IIIIB')
+    length = struct.Struct('>H')
+
+    # Encodes a card catalogue - a list of rows or a dict of named lists of rows
+    @staticmethod
+    def encode_cards(cards, encoding, version=0):
+
+        if encoding == Encodings.JSON:
+            return Encoder.to_json({'version': version, 'cards': cards})
+
+        if encoding == Encodings.BINARY:
+
+            body = bytearray(Encoder.header.pack(Encoder.format_version, version))
+
+            if isinstance(cards, dict):
+
+                body.append(len(cards))
+                for name, rows in cards.items():
+
+                    Encoder.append_name(body, name)
+                    Encoder.append_table(body, rows)
+
+            else:
+                Encoder.append_table(body, cards)
+
+            return bytes(body)
+
+        return str(cards).encode('utf-8')
+
+    # Encodes the wins/loss/draw/matches record and owned cats of a user
+    @staticmethod
+    def encode_profile(records, encoding):
+
+        if encoding == Encodings.JSON:
+            return Encoder.to_json(records)
+
+        if encoding == Encodings.BINARY:
+
+            cats = records['cats']
+            return Encoder.profile.pack(records['wins'], records['loss'], records['draw'],
+                                        records['matches'], len(cats)) + bytes(cats)
+
+        return str(records).encode('utf-8')
+
+    @staticmethod
+    def to_json(data):
+        return json.dumps(data, default=str, separators=(',', ':')).encode('utf-8')
+
+    # Appends a table of rows with a layout shared by every record
+    @staticmethod
+    def append_table(body, rows):
+
+        rows = rows or []
+        columns = Encoder.layout(rows)
+
+        body += Encoder.table_header.pack(len(rows), len(columns))
+        for name, column_type in columns:
+
+            body.append(column_type)
+            Encoder.append_name(body, name)
+
+        numeric = [name for name, column_type in columns if column_type != ColumnTypes.STRING]
+        strings = [name for name, column_type in columns if column_type == ColumnTypes.STRING]
+        record = struct.Struct('>' + ''.join(Encoder.numeric_formats[column_type]
+                                             for name, column_type in columns
+                                             if column_type != ColumnTypes.STRING))
+
+        for row in rows:
+
+            body += record.pack(*[row[name] for name in numeric])
+            for name in strings:
+
+                value = row[name]
+                if value is None:
+                    body += Encoder.length.pack(Encoder.null_string)
+
+                else:
+
+                    value = str(value).encode('utf-8')
+                    body += Encoder.length.pack(len(value))
+                    body += value
+
+    @staticmethod
+    def append_name(body, name):
+
+        name = name.encode('utf-8')
+        body.append(len(name))
+        body += name
+
+    # Determines the column types for a table from its rows
+    # Numeric columns come first so each record starts with a fixed width block
+    @staticmethod
+    def layout(rows):
+
+        if not rows:
+            return []
+
+        columns = []
+        for name in rows[0]:
+
+            values = [row[name] for row in rows]
+            columns.append((name, Encoder.column_type(values)))
+
+        columns.sort(key=lambda column: column[1] == ColumnTypes.STRING)
+        return columns
+
+    @staticmethod
+    def column_type(values):
+
+        if all(isinstance(value, bool) for value in values):
+            return ColumnTypes.BOOL
+
+        if all(isinstance(value, int) and not isinstance(value, bool) for value in values):
+
+            if all(-2 ** 31 <= value < 2 ** 31 for value in values):
+                return ColumnTypes.INT32
+
+            return ColumnTypes.INT64
+
+        if all(isinstance(value, float) for value in values):
+            return ColumnTypes.DOUBLE
+
+        return ColumnTypes.STRING
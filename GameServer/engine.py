@@ -0,0 +1,691 @@
+import random
+
+from collections import namedtuple
+
+from flags import Flags
+from logger import LogCodes, LogLevels
+from cat import Moves, Cats, Phases
+from ability import Ability, Abilities
+from chance import Chance, Chances
+
+
+# A player's state in a match
+# Slots keep each player small when many matches run at once - the hand and used cards are counts
+# indexed by Chances and cooldowns the rounds left indexed by Abilities, so checking for a card or
+# a cooldown is a single lookup
+class Player:
+
+    __slots__ = ('username', 'userid', 'cats', 'socket', 'network',
+                 '__cat', 'rability', 'health', 'healed',
+                 'base_damage', 'dmg_dealt', 'dmg_taken', 'dmg_dodged', 'modifier',
+                 'pierce', 'reverse', 'irreversible', 'invulnerable', 'spotlight',
+                 'hand', 'used', 'cooldowns', 'chance_card', 'previous_chance', 'used_card',
+                 'move', 'selected_chance', 'ready', 'winner')
+
+    def __init__(self, username, cats, network=None, socket=None, userid=None):
+
+        self.username = username
+        self.userid = userid
+        self.cats = cats
+        self.socket = socket
+        self.network = network
+
+        self.__cat = None
+        self.rability = 0
+        self.health = 0
+        self.healed = 0
+
+        self.base_damage = 1
+        self.dmg_dealt = 0
+        self.dmg_taken = 0
+        self.dmg_dodged = 0
+        self.modifier = 1
+        self.pierce = False
+        self.reverse = False
+        self.irreversible = False
+        self.invulnerable = False
+        self.spotlight = False
+
+        self.hand = bytearray(len(Chances))
+        self.used = bytearray(len(Chances))
+        self.cooldowns = bytearray(len(Abilities))
+
+        # The two most recently gained chance cards and the card last selected
+        self.chance_card = None
+        self.previous_chance = None
+        self.used_card = None
+
+        self.move = None
+        self.selected_chance = False
+        self.ready = False
+
+        self.winner = False
+
+    @property
+    def cat(self):
+        return self.__cat
+
+    @cat.setter
+    def cat(self, cat):
+
+        self.__cat = cat
+        self.health = cat.hp
+
+    def gain_chance(self, chance):
+
+        self.hand[chance] += 1
+        self.previous_chance = self.chance_card
+        self.chance_card = chance
+
+    # Moves a chance card from the hand to the used cards
+    def use_chance(self, chance):
+
+        self.hand[chance] -= 1
+        self.used[chance] += 1
+        self.used_card = chance
+
+    # Every chance card in the hand, in Chances order
+    def chance_cards(self):
+        return [chance for chance, count in enumerate(self.hand) for _ in range(count)]
+
+
+# A message the engine wants delivered - body is the raw response body, empty for header only responses
+Message = namedtuple('Message', ['player', 'flag', 'body'])
+
+
+# The rules of a match as a deterministic state machine
+# Each event (a player sending a flag and body, disconnecting or running out of time) updates the
+# state and returns the messages to deliver in order - the engine never touches a socket, a clock or the database
+# rng - random.Random used for every draw, seed it to replay a match
+# log - optional Logger.log compatible callable, nothing is logged without one
+class MatchEngine:
+
+    def __init__(self, p1, p2, rng=None, log=None):
+
+        self.p1 = p1
+        self.p2 = p2
+        self.rng = rng if rng is not None else random.Random()
+        self.log = log
+
+        self.phase = Phases.SETUP
+        self.valid = True
+        self.result = None
+        self.winner = None
+
+        # Player to 'wins', 'loss' or 'draw' once the match has been decided
+        self.results = None
+        self.outbox = []
+
+    # Applies a request from player and returns the messages it produced
+    def handle(self, player, flag, body):
+
+        if self.valid:
+            phase_map[self.phase](self, player, flag, body)
+
+        return self.take_messages()
+
+    # The player left the match, the opponent wins if it was still in progress
+    def disconnect(self, player):
+
+        self.note("{} has disconnected from their match", LogCodes.Match, player.username)
+        self.note("{} will be assessed with a loss", LogCodes.Match, player.username)
+
+        opponent = self.get_opponent(player.username)
+
+        # Only a match still in progress is decided by the disconnect
+        # The opponent of a finished match may already be queued for their next one
+        if self.valid:
+
+            self.winner = opponent
+            self.results = {opponent: 'wins', player: 'loss'}
+
+            # The disconnected player gets a loss - notify the winning player
+            self.send(opponent, Flags.END_MATCH, Flags.SUCCESS)
+
+        self.valid = False
+        return self.take_messages()
+
+    # The current phase ran out of time
+    # Players who still owe the choice the phase needs (a cat in setup, a move when enacting
+    # strategies) forfeit, if both do the match ends in an error
+    # Any other player still waiting is readied as if they had sent READY
+    def timeout(self):
+
+        if self.valid:
+
+            self.note("{} phase timed out for {}, {}", LogCodes.Match, self.phase.name,
+                      self.p1.username, self.p2.username)
+
+            waiting = [player for player in (self.p1, self.p2) if not player.ready]
+            idle = [player for player in waiting if self.missing_choice(player)]
+
+            if len(idle) == 2:
+
+                self.note("Neither player made a choice in time - Killing the match", LogCodes.Match)
+                self.kill_match()
+
+            elif idle:
+                self.forfeit(idle[0])
+
+            else:
+                for player in waiting:
+                    phase_map[self.phase](self, player, Flags.READY, None)
+
+        return self.take_messages()
+
+    # Whether a player has yet to make the choice the current phase needs
+    def missing_choice(self, player):
+
+        if self.phase == Phases.SETUP:
+            return player.cat is None
+
+        if self.phase == Phases.ENACT_STRATS:
+            return player.move is None
+
+        return False
+
+    # An idle player loses the match, both players are told it is over
+    def forfeit(self, player):
+
+        opponent = self.get_opponent(player.username)
+        self.note("{} forfeits the match for not playing in time", LogCodes.Match, player.username)
+
+        self.valid = False
+        self.result = Flags.SUCCESS
+        self.winner = opponent
+        self.results = {opponent: 'wins', player: 'loss'}
+
+        self.send(opponent, Flags.END_MATCH, Flags.SUCCESS)
+        self.send(player, Flags.END_MATCH, Flags.FAILURE)
+
+    # Queues a response for player, body is any number of single byte values
+    def send(self, player, flag, *body):
+        self.outbox.append(Message(player, flag, bytes(body)))
+
+    # Sends a message to both players with or without a body
+    def alert_players(self, flag, *body):
+
+        self.send(self.p1, flag, *body)
+        self.send(self.p2, flag, *body)
+
+    def take_messages(self):
+
+        messages = self.outbox
+        self.outbox = []
+        return messages
+
+    def note(self, message, code, *args):
+
+        if self.log is not None:
+            self.log(message, code, LogLevels.INFO, *args)
+
+    # Ends the match in an error
+    def kill_match(self):
+
+        self.valid = False
+        self.result = Flags.ERROR
+        self.alert_players(Flags.END_MATCH, Flags.ERROR)
+
+    # A win condition has been met stopping the match
+    def end_match(self):
+
+        self.note("Match ending for {} & {}", LogCodes.Match, self.p1.username, self.p2.username)
+
+        self.valid = False
+
+        self.result = Flags.SUCCESS
+        if self.p1.winner and self.p2.winner:
+
+            self.note("The match is a draw", LogCodes.Match)
+            self.result = Flags.DRAW
+            self.results = {self.p1: 'draw', self.p2: 'draw'}
+            self.alert_players(Flags.END_MATCH, Flags.DRAW)
+            return
+
+        self.winner = self.p1 if self.p1.winner else self.p2
+        loser = self.get_opponent(self.winner.username)
+
+        self.note("{} has won the match", LogCodes.Match, self.winner.username)
+        self.results = {self.winner: 'wins', loser: 'loss'}
+
+        self.send(self.p1, Flags.END_MATCH, Flags.SUCCESS if self.winner is self.p1 else Flags.FAILURE)
+        self.send(self.p2, Flags.END_MATCH, Flags.SUCCESS if self.winner is self.p2 else Flags.FAILURE)
+
+    # Phase before prelude for handling match preparation
+    def setup(self, player, flag, body):
+
+        if flag == Flags.SELECT_CAT:
+            self.select_cat(player, body)
+
+        elif flag == Flags.READY:
+
+            # Set the player to ready and assign random ability and two random chance cards
+            players_ready = self.player_ready(player)
+
+            Ability.random_ability(self, player)
+            Chance.random_chance(self, player)
+            Chance.random_chance(self, player)
+
+            # If both players are ready proceed to the next phase
+            if players_ready:
+
+                # Set and alert players of next phase
+                self.next_phase(Phases.PRELUDE)
+
+                # Do not proceed if someone did not select a cat but readied up
+                if self.p1.cat is not None and \
+                        self.p2.cat is not None:
+
+                    self.post_setup()
+                    self.gloria_prelude()
+
+                else:
+
+                    self.note("One of the players did not select a cat - Killing the match", LogCodes.Match)
+                    self.kill_match()
+
+    # Notifies players about cats abilities and chances before game moves on
+    def post_setup(self):
+
+        self.note("Post setup running for {}, {}", LogCodes.Match, self.p1.username, self.p2.username)
+
+        for player, opponent in ((self.p1, self.p2), (self.p2, self.p1)):
+
+            # Send each player their opponent's cat, their random ability and their two random chance cards
+            self.send(player, Flags.OP_CAT, opponent.cat.id)
+            self.send(player, Flags.GAIN_ABILITY, player.rability)
+            self.send(player, Flags.GAIN_CHANCES, player.previous_chance, player.chance_card)
+
+    # Activates any prelude passive abilities the players have
+    def gloria_prelude(self):
+
+        self.note("Prelude phase starting for {}, {}", LogCodes.Match, self.p1.username, self.p2.username)
+
+        # Reset players per round stats
+        self.reset_attributes(self.p1)
+        self.reset_attributes(self.p2)
+
+        # Decrease any abilities on cooldown
+        Ability.decrease_cooldowns(self.p1)
+        Ability.decrease_cooldowns(self.p2)
+
+        # Check passive abilities
+        self.use_passive_abilities()
+
+    def prelude(self, player, flag, body):
+
+        if flag == Flags.USE_ABILITY:
+            self.select_ability(player, body)
+
+        elif flag == Flags.READY:
+
+            players_ready = self.player_ready(player)
+            if players_ready:
+
+                # Set and alert players of next phase
+                self.next_phase(Phases.ENACT_STRATS)
+                self.gloria_enact_strats()
+
+    # Log the enact strats phase starting
+    def gloria_enact_strats(self):
+        self.note("Enact Strategies phase starting for {}, {}", LogCodes.Match, self.p1.username, self.p2.username)
+
+    def enact_strats(self, player, flag, body):
+
+        if flag == Flags.SELECT_MOVE:
+            self.select_move(player, body)
+
+        elif flag == Flags.USE_CHANCE:
+            self.select_chance(player, body)
+
+        elif flag == Flags.READY:
+
+            players_ready = self.player_ready(player)
+            if players_ready:
+
+                # Notify player of next round
+                self.next_phase(Phases.SHOW_CARDS)
+
+                # Before moving on check both players selected a move
+                if self.p1.move is not None and \
+                        self.p2.move is not None:
+
+                    self.gloria_show_cards()
+
+                else:
+
+                    self.note("One of the players did not select a move - Killing match", LogCodes.Match)
+                    self.kill_match()
+
+    def gloria_show_cards(self):
+
+        self.note("Show Cards phase starting for {}, {}", LogCodes.Match, self.p1.username, self.p2.username)
+
+        for player, opponent in ((self.p1, self.p2), (self.p2, self.p1)):
+
+            # Show each player their opponent's move and chance card if they selected one
+            self.send(player, Flags.REVEAL_MOVE, opponent.move)
+
+            if opponent.selected_chance:
+                self.send(player, Flags.REVEAL_CHANCE, opponent.used_card)
+            else:
+                self.send(player, Flags.REVEAL_CHANCE)
+
+    def show_cards(self, player, flag, body):
+
+        if flag == Flags.READY:
+
+            players_ready = self.player_ready(player)
+            if players_ready:
+
+                self.next_phase(Phases.SETTLE_STRATS)
+                self.gloria_settle_strats()
+
+    def gloria_settle_strats(self):
+
+        self.note("Settle Strategies phase starting for {}, {}", LogCodes.Match, self.p1.username, self.p2.username)
+
+        # Use each player's chance card if pre settle
+        for player in (self.p1, self.p2):
+
+            if player.selected_chance and Chance.pre_settle(player.used_card):
+                Chance.use_chance(self, player.used_card, player)
+
+        # Determine combat order
+        # Player1 goes first if they have spotlight and player2 does not
+        if self.p1.spotlight and not self.p2.spotlight:
+
+            player = self.p1
+            opponent = self.p2
+
+        # Player2 goes first if they have spotlight and player2 does not
+        elif self.p2.spotlight and not self.p1.spotlight:
+
+            player = self.p2
+            opponent = self.p1
+
+        # Randomly choose order if neither or both players have spotlight
+        else:
+
+            player = self.get_random_player()
+            opponent = self.get_opponent(player.username)
+
+        # var player is the designated variable for who does first
+        self.handle_combat(player, opponent)
+        self.handle_combat(opponent, player)
+
+        # Use each player's chance card if post settle
+        for player, opponent in ((self.p1, self.p2), (self.p2, self.p1)):
+
+            if player.selected_chance and Chance.post_settle(player.used_card):
+
+                chance_used = Chance.use_chance(self, player.used_card, player)
+                if chance_used:
+                    Chance.chance_responses(self, player.used_card, player, opponent)
+
+        # Send each player their new HP and notify their opponent as well
+        # Damage multiplied by modifiers can take a player below zero, they are sent as zero
+        for player, opponent in ((self.p1, self.p2), (self.p2, self.p1)):
+
+            health = max(player.health, 0)
+            self.send(player, Flags.GAIN_HP, health)
+            self.send(opponent, Flags.OP_GAIN_HP, health)
+
+        # Send all chance cards each player has
+        for player in (self.p1, self.p2):
+            self.send(player, Flags.GAIN_CHANCES, *player.chance_cards())
+
+        self.check_winner()
+
+    def settle_strats(self, player, flag, body):
+
+        if flag == Flags.READY:
+
+            players_ready = self.player_ready(player)
+            if players_ready:
+
+                self.next_phase(Phases.POSTLUDE)
+                self.gloria_postlude()
+
+    def gloria_postlude(self):
+
+        self.note("Postlude phase starting for {}, {}", LogCodes.Match, self.p1.username, self.p2.username)
+        self.use_passive_abilities()
+
+    def postlude(self, player, flag, body):
+
+        if flag == Flags.USE_ABILITY:
+            self.select_ability(player, body)
+
+        elif flag == Flags.READY:
+
+            players_ready = self.player_ready(player)
+            if players_ready:
+
+                self.check_winner()
+                self.next_phase(Phases.PRELUDE)
+                self.gloria_prelude()
+
+    # Checks both players' cat and random passive abilities for the current phase
+    def use_passive_abilities(self):
+
+        Ability.use_passive_ability(self, self.p1, self.p2)
+        Ability.use_passive_ability(self, self.p1, self.p2, self.p1.rability)
+
+        Ability.use_passive_ability(self, self.p2, self.p1)
+        Ability.use_passive_ability(self, self.p2, self.p1, self.p2.rability)
+
+    # Returns player one or two based on username
+    def get_player(self, username):
+
+        if self.p1.username == username:
+            return self.p1
+        else:
+            return self.p2
+
+    # Returns one of the two players randomly
+    def get_random_player(self):
+
+        randnum = self.rng.randrange(0, 2)
+        if randnum == 0:
+            return self.p1
+        else:
+            return self.p2
+
+    # Returns the player that does not have the specified username
+    def get_opponent(self, username):
+
+        if self.p1.username == username:
+            return self.p2
+        else:
+            return self.p1
+
+    # Move onto the next phase specified and alert the players
+    def next_phase(self, phase):
+
+        self.reset_ready()
+        self.phase = phase
+        self.alert_players(Flags.NEXT_PHASE)
+
+    # Set a player to ready and return whether both are ready or not
+    def player_ready(self, player):
+
+        player.ready = True
+        return self.p1.ready and self.p2.ready
+
+    # Sets both players to not ready
+    def reset_ready(self):
+
+        self.p1.ready = False
+        self.p2.ready = False
+
+    # Handles the user attempting to select a cat
+    def select_cat(self, player, body):
+
+        cat_id = -1
+        if body:
+            cat_id = int(body)
+
+        cat_selected = Cats.select_cat(player, cat_id)
+
+        if cat_selected:
+            self.note("{} has selected their cat - id: {}", LogCodes.Match, player.username, cat_id)
+        else:
+            self.note("{} could not select their cat - id: {}", LogCodes.Match, player.username, cat_id)
+
+        self.send(player, Flags.SELECT_CAT, int(cat_selected))
+
+    # Handles the user attempting to select a move
+    def select_move(self, player, body):
+
+        move = -1
+        if body:
+            move = int(body)
+
+        move_selected = Moves.select_move(player, move)
+
+        if move_selected:
+            self.note("{} has selected their move - id: {}", LogCodes.Match, player.username, move)
+        else:
+            self.note("{} could not select their move - id: {}", LogCodes.Match, player.username, move)
+
+        self.send(player, Flags.SELECT_MOVE, int(move_selected))
+
+    # Handles the user attempting to select a chance card
+    def select_chance(self, player, body):
+
+        chance = -1
+        if body:
+            chance = int(body)
+
+        chance_selected = Chance.select_chance(player, chance)
+
+        if chance_selected:
+            self.note("{} has selected their chance - id: {}", LogCodes.Match, player.username, chance)
+        else:
+            self.note("{} could not select their chance - id: {}", LogCodes.Match, player.username, chance)
+
+        self.send(player, Flags.USE_CHANCE, int(chance_selected))
+
+    # Handles the user attempting to use an active ability
+    def select_ability(self, player, body):
+
+        ability_id = -1
+        if body:
+            ability_id = int(body)
+
+        opponent = self.get_opponent(player.username)
+        ability_used = Ability.use_active_ability(self, player, opponent, ability_id)
+
+        self.send(player, Flags.USE_ABILITY, int(ability_used))
+
+    # Determine if a win condition has been met
+    def check_winner(self):
+
+        winner = False
+        if self.p1.health >= 20 or \
+                self.p2.health <= 0:
+
+            self.p1.winner = True
+            winner = True
+
+        if self.p2.health >= 20 or \
+                self.p1.health <= 0:
+
+            self.p2.winner = True
+            winner = True
+
+        if winner:
+            self.end_match()
+
+    # Reset per round game stats for a player
+    @staticmethod
+    def reset_attributes(player):
+
+        player.healed = 0
+        player.dmg_dealt = 0
+        player.dmg_taken = 0
+        player.dmg_dodged = 0
+        player.modifier = 1
+        player.pierce = False
+        player.reverse = False
+        player.irreversible = False
+        player.invulnerable = False
+        player.spotlight = False
+
+        player.move = None
+        player.selected_chance = False
+
+    @staticmethod
+    def handle_combat(player, opponent):
+
+        # Handle combat scenarios for players
+
+        # If the player scratches
+        if player.move == Moves.SCRATCH:
+
+            damage = player.base_damage * player.modifier
+
+            # opponent guards
+            if opponent.move == Moves.GUARD:
+
+                # Player does not have pierce
+                if opponent.reverse and player.irreversible \
+                        or not player.pierce:
+
+                    opponent.dmg_dodged += damage
+
+                # Damage is reversed
+                elif opponent.reverse:
+
+                    player.health -= damage
+                    player.dmg_dealt += damage
+                    player.dmg_taken += damage
+
+                # Damage goes through
+                elif player.pierce:
+
+                    opponent.health -= damage
+                    opponent.dmg_taken += damage
+                    player.dmg_dealt += damage
+
+            # opponent purrs scenarios
+            elif opponent.move == Moves.PURR:
+
+                # Opponent is not invulnerable otherwise nothing happens
+                if not opponent.invulnerable:
+
+                    opponent.health -= 1
+                    opponent.dmg_taken += 1
+                    player.dmg_dealt += 1
+
+            # If the opponent is scratching or skipping
+            else:
+
+                opponent.health -= damage
+                opponent.dmg_taken += damage
+                player.dmg_dealt += damage
+
+        # If the player purrs and is invulnerable while the opponent is scratching
+        elif player.move == Moves.PURR and opponent.move == Moves.SCRATCH:
+
+            if player.invulnerable:
+
+                player.health += 1
+                player.healed += 1
+
+        # If the player purrs while the opponent does not scratch
+        elif player.move == Moves.PURR and not opponent.move == Moves.SCRATCH:
+
+            player.health += 1
+            player.healed += 1
+
+phase_map = {
+
+    Phases.SETUP: MatchEngine.setup,
+    Phases.PRELUDE: MatchEngine.prelude,
+    Phases.ENACT_STRATS: MatchEngine.enact_strats,
+    Phases.SHOW_CARDS: MatchEngine.show_cards,
+    Phases.SETTLE_STRATS: MatchEngine.settle_strats,
+    Phases.POSTLUDE: MatchEngine.postlude
+}
@@ -0,0 +1,63 @@
+from enum import IntEnum
+
+
+# Enum to map flag literals to a name
+class Flags(IntEnum):
+
+    @staticmethod
+    def valid_flag(flag):
+        return flag in list(map(int, Flags))
+
+    # Request name of a flag literal - several names share a value so the last one defined wins
+    @staticmethod
+    def flag_name(flag):
+        return flag_names.get(flag, str(flag))
+
+    FAILURE = 0
+    SUCCESS = 1
+    DRAW = 2
+    ERROR = 3
+    CLOSE = 8
+
+    ZERO_BYTE = 0
+    ONE_BYTE = 1
+    TWO_BYTE = 2
+
+    LOGIN = 0
+    LOGOUT = 1
+    FIND_MATCH = 2
+    USER_PROFILE = 3
+    ALL_CARDS = 4
+    CAT_CARDS = 5
+    BASIC_CARDS = 6
+    CHANCE_CARDS = 7
+    ABILITY_CARDS = 8
+    END_MATCH = 9
+    WEB_LOGIN = 10
+    SET_ENCODING = 11
+    ADMIN_METRICS = 12
+    ADMIN_PROFILE = 13
+
+    OP_CAT = 49
+    GAIN_HP = 50
+    OP_GAIN_HP = 51
+    DMG_MODIFIED = 52
+    OP_DMG_MODIFIED = 53
+    GAIN_CHANCE = 54
+    OP_GAIN_CHANCE = 55
+    GAIN_ABILITY = 56
+    GAIN_CHANCES = 57
+    REVEAL_MOVE = 58
+    REVEAL_CHANCE = 59
+    SPOTLIGHT = 60
+    OP_SPOTLIGHT = 61
+
+    NEXT_PHASE = 98
+    READY = 99
+    SELECT_CAT = 100
+    USE_ABILITY = 101
+    SELECT_MOVE = 102
+    USE_CHANCE = 103
+
+
+flag_names = {int(value): name for name, value in Flags.__members__.items()}
@@ -2,24 +2,97 @@
 # Kitty War game server
 # TCP Port 2056
 
+import argparse
+import asyncio
+import os
+import signal
 import socket as sock
+import sys
 import threading
-import tkinter
-import tkinter.scrolledtext
-import tkinter.ttk as ttk
 
+from time import sleep
 from network import Network
+from dbpool import ConnectionPool
+from standin import StandinDatabase
 from sessions import Session
-from match import Match, Player
-from queue import Queue
-from logger import Logger
+from asessions import ASession
+from matchmaker import MatchMaker
+from lobby import LobbyService, LobbyClient
+from catalogue import CardCatalogue
+from profilecache import ProfileCache
+from resultwriter import ResultWriter
+from match import Match
+from matchpool import MatchPool
+from timingwheel import TimingWheel
+from metrics import Metrics
+from profiler import Profiler
+from outbound import OutboundQueue, OutboundFlusher
+from logger import Logger, LogCodes, LogLevels
 
 server_port = 2056
 server_running = True
 
+# Most lines kept in each GUI log window so inserting stays constant time
+display_lines = 1000
+
 
 def main():
 
+    # Command line options
+    parser = argparse.ArgumentParser(description="KittyWar game server")
+    parser.add_argument('--mode', choices=['thread', 'async'], default='thread',
+                        help="thread: one thread per session, async: all sessions on one asyncio event loop")
+    parser.add_argument('--log-level', choices=[level.name for level in LogLevels], default='INFO',
+                        help="lowest severity recorded, DEBUG includes packet dumps")
+    parser.add_argument('--headless', action='store_true',
+                        help="run without the tkinter GUI, logs go to stdout and SIGINT/SIGTERM stop the server")
+    parser.add_argument('--admin-token',
+                        help="token that must accompany ADMIN_METRICS requests, admin requests are refused without it")
+    parser.add_argument('--no-metrics', action='store_true',
+                        help="disable request, phase and database timing")
+    parser.add_argument('--profile-dir', default=Profiler.directory,
+                        help="directory ADMIN_PROFILE windows are written to")
+    parser.add_argument('--standin-db', type=int, metavar='USERS',
+                        help="serve logins, profiles and cards from memory for USERS generated players "
+                             "instead of the database, used by loadtest.py")
+    parser.add_argument('--match-threads', type=int, default=4, metavar='N',
+                        help="threads running match requests in thread mode, each match runs on one at a time")
+    parser.add_argument('--workers', type=int, default=0, metavar='N',
+                        help="fork N worker processes that all accept on the server port, players are paired "
+                             "across workers by a lobby in this process (headless only)")
+    parser.add_argument('--lobby', metavar='PATH',
+                        help="Unix socket path of a lobby shared by every server on the host - with --workers the "
+                             "lobby listens there, otherwise this server joins the lobby listening there")
+    args = parser.parse_args()
+
+    if args.workers and not args.headless:
+        parser.error("--workers requires --headless")
+
+    Logger.set_level(LogLevels[args.log_level])
+    Metrics.enabled = not args.no_metrics
+    Profiler.directory = args.profile_dir
+
+    # Load tests run against an in memory database so they need no database server
+    if args.standin_db:
+        Network.db_pool = ConnectionPool(StandinDatabase(args.standin_db).connect)
+
+    # Grab all basic game information(cards) and encode the responses once to prevent
+    # repeatedly pulling and encoding this information for each session on request
+    card_catalogue = pull_card_data()
+
+    if args.workers:
+        run_supervisor(args, card_catalogue)
+    elif args.lobby:
+        run_server(args, card_catalogue, LobbyClient.connect(args.lobby), reuse_port=True)
+    else:
+        run_server(args, card_catalogue, MatchMaker())
+
+
+# Runs the game server in this process
+# matchmaker - MatchMaker, or a LobbyClient in a worker process or a server sharing a lobby
+# reuse_port - bind with SO_REUSEPORT so every server in the lobby can accept on the server port
+def run_server(args, card_catalogue, matchmaker, reuse_port=False):
+
     # Server networking setup
     # ##################################################################################################################
 
@@ -27,35 +100,225 @@ def main():
     server = sock.socket(sock.AF_INET, sock.SOCK_STREAM)
     server_address = ('localhost', server_port)
 
-    # Prepare lobby and match making thread
-    match_event = threading.Event()
-    lobby = Queue()
-
-    # Start match making thread
-    matchmaker_thread = threading.Thread(target=match_maker, args=(match_event, lobby))
-    matchmaker_thread.daemon = True
-    matchmaker_thread.start()
+    # Prepare lobby - sessions are paired as soon as a closely rated player queues
+    # and the sweep thread widens the rating window for players left waiting
+    matchmaker.start()
 
     # Bind server and listen for clients
     server.setsockopt(sock.SOL_SOCKET, sock.SO_REUSEADDR, 1)
+    if reuse_port:
+        server.setsockopt(sock.SOL_SOCKET, sock.SO_REUSEPORT, 1)
+
     server.bind(server_address)
     server.settimeout(1)
-    server.listen(5)
-
-    # Grab all basic game information(cards) and store in GameThread to prevent
-    # repeatedly pulling this information for each session on request
-    card_information = pull_card_data()
+    server.listen(128)
+
+    # Profile records shared by sessions and kept current by finished matches
+    profile_cache = ProfileCache()
+    Match.profile_cache = profile_cache
+
+    # Match results are written to the database in batches off the match thread
+    result_writer = ResultWriter()
+    result_writer.start()
+    Match.result_writer = result_writer
+
+    # Responses a client can not take straight away are written from this thread
+    # so a slow client never blocks the match sending to it
+    outbound_flusher = OutboundFlusher()
+    outbound_flusher.start()
+    OutboundQueue.flusher = outbound_flusher
+
+    # Thread sessions post match requests to the match's mailbox and a fixed pool of threads runs them
+    # Async sessions run them on the event loop
+    if args.mode == 'thread':
+
+        match_pool = MatchPool(args.match_threads)
+        match_pool.start()
+        Match.pool = match_pool
+        Metrics.register_gauge('match_pool', match_pool.stats)
+
+    # Phase deadlines of every match are kept on one timing wheel
+    timing_wheel = TimingWheel()
+    timing_wheel.start()
+    Match.timers = timing_wheel
+    Metrics.register_gauge('timers', timing_wheel.stats)
 
     # Set global Session variables for debugging/matchmaking/information to apply to all sessions
-    Session.card_information = card_information
-    Session.lobby = lobby
-    Session.match_event = match_event
+    Session.card_information = card_catalogue.information
+    Session.card_catalogue = card_catalogue
+    Session.matchmaker = matchmaker
+    Session.profile_cache = profile_cache
+    Session.result_writer = result_writer
+
+    ASession.card_information = card_catalogue.information
+    ASession.card_catalogue = card_catalogue
+    ASession.matchmaker = matchmaker
+    ASession.profile_cache = profile_cache
+    ASession.result_writer = result_writer
+
+    Session.admin_token = args.admin_token
+    ASession.admin_token = args.admin_token
+
+    # Component stats included in every metrics snapshot
+    Metrics.register_gauge('db_pool', Network.db_pool.stats)
+    Metrics.register_gauge('matchmaker', matchmaker.stats)
+    Metrics.register_gauge('profile_cache', profile_cache.stats)
+    Metrics.register_gauge('result_writer', result_writer.stats)
+    Metrics.register_gauge('logger', Logger.stats)
+    Metrics.register_gauge('outbound', outbound_flusher.stats)
+
+    # Sockets moved here by the lobby are picked up by a session of the same kind
+    # Async sessions are built on the event loop once it is running
+    if isinstance(matchmaker, LobbyClient) and args.mode == 'thread':
+
+        matchmaker.adopt_session = Session.adopt
+        matchmaker.start_session = Session.start
 
     # Create thread dedicated to listening for clients
-    polling_thread = threading.Thread(target=poll_connections, args=(server,))
+    if args.mode == 'async':
+        polling_thread = threading.Thread(target=async_poll_connections, args=(server,))
+    else:
+        polling_thread = threading.Thread(target=poll_connections, args=(server,))
     polling_thread.daemon = True
     polling_thread.start()
 
+    if args.headless:
+        run_headless(polling_thread)
+    else:
+        run_gui()
+
+
+# Forks the worker processes and pairs their players through the lobby until they have all exited
+# Card data is pulled before forking so every worker starts with the same catalogue
+def run_supervisor(args, card_catalogue):
+
+    # Database connections opened so far must not be shared by the workers
+    Network.db_pool.close()
+
+    lobby = LobbyService()
+    channels = []
+    workers = {}
+
+    for index in range(args.workers):
+
+        channel, worker_channel = sock.socketpair(sock.AF_UNIX, sock.SOCK_SEQPACKET)
+
+        # Messages still buffered would be written again by the worker
+        write_logs(sys.stdout)
+
+        pid = os.fork()
+        if pid == 0:
+
+            for other in channels + [channel]:
+                other.close()
+
+            run_worker(args, card_catalogue, index, worker_channel)
+
+        worker_channel.close()
+        channels.append(channel)
+        lobby.add_worker(channel)
+        workers[pid] = index
+
+    # Other servers on the host join once the workers are in
+    if args.lobby:
+
+        lobby.listen(args.lobby)
+        Logger.log("Lobby listening on " + args.lobby)
+
+    lobby.start()
+    Logger.log("Supervisor started " + str(args.workers) + " workers on port " + str(server_port))
+
+    # Workers are stopped the same way they would be without a supervisor
+    def stop_workers(signum, frame):
+
+        Logger.log("Stopping workers")
+        for pid in workers:
+
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    signal.signal(signal.SIGINT, stop_workers)
+    signal.signal(signal.SIGTERM, stop_workers)
+
+    while workers:
+
+        sleep(Logger.log_interval / 1000)
+        write_logs(sys.stdout)
+
+        pid, status = os.waitpid(-1, os.WNOHANG)
+        if pid:
+            Logger.log("Worker " + str(workers.pop(pid)) + " exited with status " +
+                       str(os.waitstatus_to_exitcode(status)))
+
+    lobby.close()
+    Logger.log("Lobby: " + str(lobby.stats()))
+    Logger.log("Supervisor stopped")
+    write_logs(sys.stdout)
+
+
+# Runs a worker process to completion, it never returns to the supervisor's code
+def run_worker(args, card_catalogue, index, channel):
+
+    Logger.log("Worker " + str(index) + " started, pid " + str(os.getpid()))
+
+    # noinspection PyBroadException
+    try:
+        run_server(args, card_catalogue, LobbyClient(channel), reuse_port=True)
+    except:
+        Logger.error("Worker " + str(index) + " failed")
+        write_logs(sys.stdout)
+        os._exit(1)
+
+    sys.stdout.flush()
+    os._exit(0)
+
+
+# Runs the server without a display - logs are written to stdout in batches
+def run_headless(polling_thread):
+
+    # Signals are delivered to the main thread, which is only waiting on the polling thread
+    signal.signal(signal.SIGINT, lambda signum, frame: shutdown_server())
+    signal.signal(signal.SIGTERM, lambda signum, frame: shutdown_server())
+    signal.signal(signal.SIGUSR1, lambda signum, frame: write_metrics(sys.stdout))
+
+    while polling_thread.is_alive():
+
+        polling_thread.join(Logger.log_interval / 1000)
+        write_logs(sys.stdout)
+
+    write_logs(sys.stdout)
+
+
+# Writes every buffered log message to a stream with a single write
+def write_logs(stream):
+
+    lines = []
+    for code in LogCodes:
+        for message in Logger.retrieve_all(code):
+            lines.append("[{}] {}\n".format(code.name, message))
+
+    if lines:
+
+        stream.write(''.join(lines))
+        stream.flush()
+
+
+# Writes a metrics snapshot to a stream
+def write_metrics(stream):
+
+    stream.write("[Metrics]\n" + Metrics.snapshot())
+    stream.flush()
+
+
+def run_gui():
+
+    # Only GUI mode needs a display so tkinter is imported here
+    import tkinter
+    import tkinter.scrolledtext
+    import tkinter.ttk as ttk
+
     # Server GUI code
     # ##################################################################################################################
     root = tkinter.Tk()
@@ -100,20 +363,29 @@ def main():
 
 
 # Updates the server GUI based on log interval
+# Each window gets at most one insert per update and is trimmed to display_lines
 def update_display(root_pkg):
 
+    import tkinter
+
     root = root_pkg[0]
     windows = root_pkg[1]
 
     window_index = 0
     for window in windows:
 
-        log_count = Logger.log_count(window_index)
-        for log_index in range(0, log_count):
+        # Messages beyond what the window keeps would be trimmed straight away
+        messages = Logger.retrieve_all(window_index)[-display_lines:]
+        if messages:
 
             window.config(state=tkinter.NORMAL)
-            window.insert(tkinter.END, "{}\n".format(Logger.retrieve(window_index)))
-            window.pack()
+            window.insert(tkinter.END, "\n".join(str(message) for message in messages) + "\n")
+
+            # The text always ends with an empty line after the last newline
+            excess = int(window.index('end-1c').split('.')[0]) - 1 - display_lines
+            if excess > 0:
+                window.delete('1.0', '{}.0'.format(excess + 1))
+
             window.config(state=tkinter.DISABLED)
 
         window_index += 1
@@ -121,7 +393,7 @@ def update_display(root_pkg):
     root.after(Logger.log_interval, update_display, (root, windows))
 
 
-# Grab latest card data from the database
+# Grab latest card data from the database and build the catalogue responses
 def pull_card_data():
 
     card_information = {}
@@ -144,7 +416,12 @@ def pull_card_data():
     card_information['abilities'] = Network.sql_query(sql_stmts[3])
     # print(card_information['abilities'])
 
-    return card_information
+    card_catalogue = CardCatalogue(card_information)
+    for flag, entry in card_catalogue.entries.items():
+        Logger.log("Card catalogue " + str(flag) + " version " + str(entry.version) +
+                   " (" + str(len(entry.body)) + " bytes)")
+
+    return card_catalogue
 
 
 def poll_connections(server):
@@ -160,24 +437,30 @@ def poll_connections(server):
         except sock.timeout:
             continue
 
+        # Responses are coalesced per request so Nagle would only delay them
+        client.setsockopt(sock.IPPROTO_TCP, sock.TCP_NODELAY, 1)
+
         Logger.log("Anonymous user connected from address: " + client_address[0] + "\n")
         new_session = Session((client, client_address))
         new_session.start()
 
     Logger.log("Closing all sessions")
-    for live_thread in threading.enumerate():
-        if live_thread.name == 'session':
-            live_thread.kill()
+    for live_thread in live_sessions():
+        live_thread.kill()
 
-    active_count = threading.active_count()
-    while active_count >= 4:
+    # Service threads (matchmaker, result writer) run for the life of the process
+    # so only session threads are waited on
+    active_count = len(live_sessions())
+    while active_count > 0:
 
-        update_count = threading.active_count()
+        sleep(0.1)
+        update_count = len(live_sessions())
         if active_count > update_count:
 
             active_count = update_count
-            Logger.log("Sessions remaining: " + str(active_count - 3))
+            Logger.log("Sessions remaining: " + str(active_count))
 
+    shutdown_services()
     Logger.log("*Safe to close server application*")
 
     server.shutdown(sock.SHUT_RDWR)
@@ -185,46 +468,119 @@ def poll_connections(server):
     Logger.log("Server stopped")
 
 
-def match_maker(match_event, lobby):
+def live_sessions():
+    return [live_thread for live_thread in threading.enumerate() if live_thread.name == 'session']
+
 
-    while True:
+# Runs every session as a coroutine on a single event loop instead of a thread per session
+def async_poll_connections(server):
+    asyncio.run(serve_connections(server))
 
-        # Wait until someone queues for a match
-        match_event.wait()
 
-        # Check if an opponent is available
-        if lobby.qsize() >= 2:
+async def serve_connections(server):
+
+    Logger.log("Server started in async mode")
+    Logger.log(server.getsockname())
+
+    sessions = set()
+    tasks = set()
+
+    # Phase timeouts run on this loop with the matches' requests
+    if Match.timers is not None:
+        Match.timers.dispatch = asyncio.get_running_loop().call_soon_threadsafe
+
+    async def run_session(new_session):
+
+        sessions.add(new_session)
+        try:
+            await new_session.run()
+        finally:
+            sessions.discard(new_session)
+
+    async def start_session(reader, writer):
+
+        client_address = writer.get_extra_info('peername')
+        Logger.log("Anonymous user connected from address: " + client_address[0] + "\n")
+
+        await run_session(ASession(reader, writer))
+
+    # Sessions moved here by the lobby are built and started on this loop
+    matchmaker = ASession.matchmaker
+    if isinstance(matchmaker, LobbyClient):
+
+        loop = asyncio.get_running_loop()
+
+        def adopt_session(client, state):
+            return asyncio.run_coroutine_threadsafe(ASession.adopt(client, state), loop).result()
+
+        def spawn_session(new_session):
+
+            task = loop.create_task(run_session(new_session))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+        matchmaker.adopt_session = adopt_session
+        matchmaker.start_session = lambda new_session: loop.call_soon_threadsafe(spawn_session, new_session)
+
+    aserver = await asyncio.start_server(start_session, sock=server)
+
+    # Occasionally wake up to check if the server is still running
+    while server_running:
+        await asyncio.sleep(1)
+
+    Logger.log("Closing all sessions")
+    aserver.close()
+
+    for live_session in list(sessions):
+        live_session.kill()
+
+    active_count = len(sessions)
+    while sessions:
+
+        await asyncio.sleep(0.1)
+        if active_count > len(sessions):
+
+            active_count = len(sessions)
+            Logger.log("Sessions remaining: " + str(active_count))
+
+    await aserver.wait_closed()
+    shutdown_services()
+    Logger.log("*Safe to close server application*")
+    Logger.log("Server stopped")
+
 
-            # Grab two ready clients and pass them to a match process
-            session1 = lobby.get()
-            session2 = lobby.get()
+# Reports matchmaking, cache and pool usage so they can be sized, writes any pending
+# match results and closes any idle database connections
+def shutdown_services():
 
-            create_match(session1, session2)
+    Logger.log("Matchmaker: " + str(Session.matchmaker.stats()))
+    Logger.log("Profile cache: " + str(Session.profile_cache.stats()))
 
+    # No phase times out once the server is stopping
+    if Match.timers is not None:
 
-def create_match(session1, session2):
+        Match.timers.close()
+        Logger.log("Timers: " + str(Match.timers.stats()))
 
-    p1_name = session1.userprofile['username']
-    p1_cats = session1.userprofile['records']['cats']
-    p1_network = session1.network
-    p1_socket = session1.client
-    player1 = Player(p1_name, p1_cats, p1_network, p1_socket)
+    # Requests still in mailboxes (disconnects at shutdown) may finish matches
+    if Match.pool is not None:
 
-    p2_name = session2.userprofile['username']
-    p2_cats = session2.userprofile['records']['cats']
-    p2_network = session2.network
-    p2_socket = session2.client
-    player2 = Player(p2_name, p2_cats, p2_network, p2_socket)
+        Match.pool.close()
+        Logger.log("Match pool: " + str(Match.pool.stats()))
 
-    Logger.log("Creating match for " + p1_name +
-               " & " + p2_name)
+    # Flush results still waiting to be written before the pool closes
+    Session.result_writer.close()
+    Logger.log("Result writer: " + str(Session.result_writer.stats()))
+    Logger.log("Database pool: " + str(Network.db_pool.stats()))
+    Logger.log("Logger: " + str(Logger.stats()))
+    Logger.log("Metrics:\n" + Metrics.snapshot())
 
-    match = Match()
-    match.p1 = player1
-    match.p2 = player2
+    # Write a profiling window still open
+    Profiler.stop()
 
-    session1.match = match
-    session2.match = match
+    if OutboundQueue.flusher is not None:
+        OutboundQueue.flusher.close()
+    Network.db_pool.close()
 
 
 def shutdown_server():
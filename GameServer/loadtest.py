@@ -0,0 +1,396 @@
+#!/usr/bin/python3
+# Kitty War load generator
+# Simulated players connect over TCP or WebSockets, log in, queue for matches and play them to
+# the end with random legal moves, chances and abilities
+# The server has to run with --standin-db so the simulated players can log in, or pass --spawn
+# to start one
+# Usage: python3 loadtest.py [--clients 100] [--matches 1] [--protocol tcp|websocket|mixed]
+#                            [--spawn thread|async] [--workers N]
+
+import argparse
+import asyncio
+import base64
+import os
+import random
+import signal
+import socket as sock
+import subprocess
+import sys
+
+from time import perf_counter, sleep
+
+from flags import Flags
+from cat import Moves
+from chance import Chances
+from standin import StandinDatabase
+
+
+class MatchOver(Exception):
+    pass
+
+
+# Latency samples per label and counters shared by every simulated player
+class LoadStats:
+
+    def __init__(self):
+
+        self.samples = {}
+        self.counters = {}
+
+    def observe(self, label, seconds):
+        self.samples.setdefault(label, []).append(seconds)
+
+    def count(self, name, amount=1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+    @staticmethod
+    def percentile(samples, percent):
+        return samples[min(len(samples) - 1, int(len(samples) * percent / 100))]
+
+    def report(self, elapsed, connect_time):
+
+        connections = self.counters.get('connections', 0)
+        # Both players are told when a match ends
+        matches = self.counters.get('match_ends', 0) / 2
+
+        print("elapsed {:.2f}s".format(elapsed))
+        print("connections {} ({:.1f}/s), failed {}".format(
+            connections, connections / connect_time if connect_time else 0.0, self.counters.get('failures', 0)))
+        print("matches {:.0f} ({:.2f}/s), rounds {:.0f}, timeouts {}".format(
+            matches, matches / elapsed if elapsed else 0.0, self.counters.get('rounds', 0) / 2,
+            self.counters.get('timeouts', 0)))
+
+        print("{:<14} {:>8} {:>10} {:>10} {:>10} {:>10}".format('latency', 'count', 'p50 ms', 'p95 ms', 'p99 ms',
+                                                              'max ms'))
+        for label in sorted(self.samples):
+
+            samples = sorted(self.samples[label])
+            print("{:<14} {:>8} {:>10.3f} {:>10.3f} {:>10.3f} {:>10.3f}".format(
+                label, len(samples), self.percentile(samples, 50) * 1000, self.percentile(samples, 95) * 1000,
+                self.percentile(samples, 99) * 1000, samples[-1] * 1000))
+
+
+# One simulated player
+# Requests are timed until the response with the same flag arrives, READY until the next phase
+# starts, so READY includes waiting for the opponent and FIND_MATCH the time spent queued
+class SimulatedPlayer:
+
+    def __init__(self, user_id, protocol, stats, rng, timeout):
+
+        self.user_id = user_id
+        self.username = StandinDatabase.player_name(user_id)
+        self.token = StandinDatabase.token(user_id).encode('utf-8')
+        self.protocol = protocol
+        self.stats = stats
+        self.rng = rng
+        self.timeout = timeout
+
+        self.reader = None
+        self.writer = None
+
+        self.cat = None
+        self.rability = None
+        self.chance_cards = []
+
+    async def connect(self, host, port):
+
+        start = perf_counter()
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+
+        if self.protocol == 'websocket':
+
+            key = base64.b64encode(os.urandom(16))
+            self.writer.write(b'GET / HTTP/1.1\r\nHost: ' + host.encode('utf-8') + b'\r\n'
+                              b'Upgrade: websocket\r\nConnection: Upgrade\r\n'
+                              b'Sec-WebSocket-Key: ' + key + b'\r\nSec-WebSocket-Version: 13\r\n\r\n')
+            await self.within(self.reader.readuntil(b'\r\n\r\n'))
+
+        self.stats.observe('CONNECT', perf_counter() - start)
+        self.stats.count('connections')
+
+    def close(self):
+
+        if self.writer is not None:
+            self.writer.close()
+
+    async def within(self, awaitable):
+        return await asyncio.wait_for(awaitable, self.timeout)
+
+    # Bodies are decimal text over TCP and a big endian integer over WebSockets
+    def send(self, flag, body=None):
+
+        if self.protocol == 'websocket':
+
+            if isinstance(body, int):
+                body = body.to_bytes(max(1, (body.bit_length() + 7) // 8), 'big')
+
+            payload = bytes((flag,)) + self.token + (body or b'')
+            mask = os.urandom(4)
+            masked = (int.from_bytes(payload, 'big') ^
+                      int.from_bytes((mask * (len(payload) // 4 + 1))[:len(payload)], 'big'))
+
+            if len(payload) <= 125:
+                header = bytes((0x82, 0x80 | len(payload)))
+            else:
+                header = bytes((0x82, 0x80 | 126)) + len(payload).to_bytes(2, 'big')
+
+            self.writer.write(header + mask + masked.to_bytes(len(payload), 'big'))
+
+        else:
+
+            body = str(body).encode('utf-8') if body is not None else b''
+            self.writer.write(bytes((flag,)) + self.token + len(body).to_bytes(3, 'big') + body)
+
+    # Returns the flag and body of the next response and tracks what it tells the player
+    async def receive(self):
+
+        if self.protocol == 'websocket':
+
+            header = await self.within(self.reader.readexactly(2))
+            size = header[1] & 0x7F
+            if size == 126:
+                size = int.from_bytes(await self.within(self.reader.readexactly(2)), 'big')
+            elif size == 127:
+                size = int.from_bytes(await self.within(self.reader.readexactly(8)), 'big')
+
+            payload = await self.within(self.reader.readexactly(size))
+            flag, body = payload[0], payload[1:]
+
+        else:
+
+            header = await self.within(self.reader.readexactly(4))
+            flag = header[0]
+            body = await self.within(self.reader.readexactly(int.from_bytes(header[1:], 'big')))
+
+        if flag == Flags.GAIN_ABILITY:
+            self.rability = body[0]
+        elif flag == Flags.GAIN_CHANCES:
+            self.chance_cards = list(body)
+        elif flag == Flags.GAIN_CHANCE:
+            self.chance_cards.append(body[0])
+        elif flag == Flags.END_MATCH:
+            self.stats.count('match_ends')
+
+        return flag, body
+
+    # Sends a request and waits for its response, raising MatchOver if the match ends first
+    async def request(self, flag, body=None):
+
+        start = perf_counter()
+        self.send(flag, body)
+
+        while True:
+
+            response_flag, response = await self.receive()
+            if response_flag == flag:
+
+                self.stats.observe(Flags.flag_name(flag), perf_counter() - start)
+                return response
+
+            if response_flag == Flags.END_MATCH:
+                raise MatchOver()
+
+    async def ready(self):
+
+        start = perf_counter()
+        self.send(Flags.READY)
+
+        while True:
+
+            flag, body = await self.receive()
+            if flag == Flags.NEXT_PHASE:
+
+                self.stats.observe('READY', perf_counter() - start)
+                return
+
+            if flag == Flags.END_MATCH:
+                raise MatchOver()
+
+    async def login(self):
+
+        if self.protocol == 'websocket':
+
+            # Web logins are not answered
+            self.send(Flags.WEB_LOGIN, self.user_id)
+
+        else:
+
+            response = await self.request(Flags.LOGIN, self.username)
+            if response != bytes((Flags.SUCCESS,)):
+                raise ConnectionError(self.username + " could not log in")
+
+    async def find_match(self):
+
+        response = await self.request(Flags.FIND_MATCH)
+        return response == bytes((Flags.SUCCESS,))
+
+    # Plays a match through every phase until the server ends it
+    async def play_match(self):
+
+        self.rability = None
+        self.chance_cards = []
+
+        self.cat = self.rng.choice((0, 1, 2))
+
+        try:
+
+            await self.request(Flags.SELECT_CAT, self.cat)
+            await self.ready()
+            while True:
+
+                # Prelude
+                await self.use_ability()
+                await self.ready()
+
+                # Enact strategies
+                move = self.rng.choice((Moves.PURR, Moves.GUARD, Moves.SCRATCH))
+                selected = await self.request(Flags.SELECT_MOVE, int(move))
+                if selected == bytes((1,)):
+                    await self.use_chance(move)
+
+                await self.ready()
+
+                # Show cards, settle strategies
+                await self.ready()
+                await self.ready()
+
+                # Postlude
+                await self.use_ability()
+                await self.ready()
+
+                self.stats.count('rounds')
+
+        except MatchOver:
+            pass
+
+    # Half the time tries the cat's ability or the random one, the server decides if it can be used
+    async def use_ability(self):
+
+        if self.rng.random() < 0.5:
+
+            # The cats a player can pick have the ability with the same id
+            ability_id = self.rng.choice((self.cat, self.rability if self.rability is not None else self.cat))
+            await self.request(Flags.USE_ABILITY, ability_id)
+
+    # Half the time plays a chance card that suits the move
+    async def use_chance(self, move):
+
+        if move == Moves.PURR:
+            suitable = range(Chances.DOUBLE_PURR, Chances.PURR_DRAW + 1)
+        elif move == Moves.GUARD:
+            suitable = range(Chances.REVERSE_SCRATCH, Chances.GUARD_DRAW + 1)
+        else:
+            suitable = range(Chances.NO_REVERSE, Chances.DOUBLE_SCRATCH + 1)
+
+        cards = [card for card in self.chance_cards if card in suitable]
+        if cards and self.rng.random() < 0.5:
+
+            card = self.rng.choice(cards)
+            if await self.request(Flags.USE_CHANCE, card) == bytes((1,)):
+                self.chance_cards.remove(card)
+
+    async def run(self, host, port, matches, connected):
+
+        try:
+
+            try:
+                await self.connect(host, port)
+            finally:
+                connected()
+
+            await self.login()
+            for _ in range(matches):
+
+                if not await self.find_match():
+                    break
+
+                await self.play_match()
+
+        except asyncio.TimeoutError:
+            self.stats.count('timeouts')
+        except (OSError, EOFError, asyncio.IncompleteReadError, ConnectionError):
+            self.stats.count('failures')
+        finally:
+            self.close()
+
+
+async def run_load(args, stats):
+
+    rng = random.Random(args.seed)
+    players = []
+
+    for index in range(args.clients):
+
+        if args.protocol == 'mixed':
+            protocol = ('tcp', 'websocket')[index % 2]
+        else:
+            protocol = args.protocol
+
+        players.append(SimulatedPlayer(index + 1, protocol, stats, random.Random(rng.random()), args.timeout))
+
+    start = perf_counter()
+    connect_times = []
+
+    def connected():
+        connect_times.append(perf_counter() - start)
+
+    await asyncio.gather(*(player.run(args.host, args.port, args.matches, connected) for player in players))
+    return perf_counter() - start, max(connect_times) if connect_times else 0.0
+
+
+# Starts a headless server on the stand-in database and waits for it to accept connections
+def spawn_server(args):
+
+    server = subprocess.Popen([sys.executable, 'gameserver.py', '--headless', '--mode', args.spawn,
+                               '--log-level', 'WARNING', '--standin-db', str(args.clients),
+                               '--workers', str(args.workers)],
+                              cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    for _ in range(100):
+
+        try:
+
+            sock.create_connection((args.host, args.port), 1).close()
+            return server
+
+        except OSError:
+            sleep(0.1)
+
+    server.kill()
+    raise RuntimeError("Server did not start")
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="KittyWar load generator")
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=2056)
+    parser.add_argument('--clients', type=int, default=100, help="simulated players, ids 1 to clients")
+    parser.add_argument('--matches', type=int, default=1, help="matches each player queues for")
+    parser.add_argument('--protocol', choices=['tcp', 'websocket', 'mixed'], default='tcp')
+    parser.add_argument('--timeout', type=float, default=30, help="seconds to wait on any response")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--spawn', choices=['thread', 'async'],
+                        help="start a server in this mode on the stand-in database for the run")
+    parser.add_argument('--workers', type=int, default=0,
+                        help="worker processes the spawned server forks, 0 runs it in one process")
+    args = parser.parse_args()
+
+    server = spawn_server(args) if args.spawn else None
+    stats = LoadStats()
+
+    try:
+        elapsed, connect_time = asyncio.run(run_load(args, stats))
+    finally:
+
+        if server is not None:
+
+            server.send_signal(signal.SIGINT)
+            server.wait()
+
+    print("{} clients over {}".format(args.clients, args.protocol))
+    stats.report(elapsed, connect_time)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,614 @@
+import json
+import os
+import selectors
+import socket as sock
+
+from itertools import count
+from threading import Lock, Thread
+from time import monotonic
+
+from matchmaker import MatchMaker, MatchTicket
+from logger import Logger, LogCodes
+
+
+# Resolves the ticket of a session that has to move to another worker to join its match
+class Transfer:
+
+    def __init__(self, pair_id, waited):
+
+        self.pair_id = pair_id
+        self.waited = waited
+
+
+# One end of the Unix socket between a worker and the lobby
+# Each packet is one message, a JSON array of a message name and its arguments - any server on the
+# host may connect, so packets are plain data rather than pickles
+# A socket being moved rides along with SCM_RIGHTS
+class LobbyChannel:
+
+    # Largest packet sent - a SEQPACKET packet has to fit in the socket's send buffer
+    max_message = 131072
+
+    # Largest session state handed off, leaving room for the message it travels in
+    max_state = 65536
+
+    def __init__(self, channel):
+
+        self.channel = channel
+        self.lock = Lock()
+        self.peek = bytearray(1)
+
+    def fileno(self):
+        return self.channel.fileno()
+
+    @staticmethod
+    def encode(message):
+        return json.dumps(message, separators=(',', ':')).encode()
+
+    # Raises ValueError for a message over max_message, OSError if the socket fails
+    def send(self, message, fd=None):
+
+        data = self.encode(message)
+        if len(data) > self.max_message:
+            raise ValueError("Lobby message of " + str(len(data)) + " bytes is too big")
+
+        with self.lock:
+
+            if fd is None:
+                self.channel.send(data)
+            else:
+                sock.send_fds(self.channel, [data], [fd])
+
+    # Returns the next message and the descriptor sent with it
+    # The message is None once the other end has closed
+    # Raises ValueError for a packet that is not a message
+    def receive(self):
+
+        # The packet is measured first so a message of any size is received whole
+        try:
+
+            size = self.channel.recv_into(self.peek, 1, sock.MSG_PEEK | sock.MSG_TRUNC)
+            if not size:
+                return None, None
+
+            data, fds, flags, address = sock.recv_fds(self.channel, size, 1)
+
+        except OSError:
+            return None, None
+
+        if not data:
+            return None, None
+
+        fd = fds[0] if fds else None
+        try:
+            message = json.loads(data)
+        except ValueError:
+            message = None
+
+        if not isinstance(message, list) or not message:
+
+            if fd is not None:
+                os.close(fd)
+
+            raise ValueError("Malformed lobby message")
+
+        return message, fd
+
+    def close(self):
+        self.channel.close()
+
+
+# A session waiting in the lobby on behalf of a worker
+# Only carries what MatchMaker needs to rate and log it, and whether it can be moved to another worker
+class RemoteSession:
+
+    def __init__(self, worker, key, username, records, movable):
+
+        self.worker = worker
+        self.key = key
+        self.userprofile = {'username': username, 'records': records}
+        self.movable = movable
+
+
+# Pairs players queued by every worker process
+# Runs the MatchMaker rating lobby in the supervisor - players on the same worker are paired there,
+# otherwise the second player's worker is asked to release it and its socket is passed to the first's
+# Workers are the supervisor's forked children, plus any server on the host that connects to the
+# lobby's Unix socket path
+class LobbyService(MatchMaker):
+
+    def __init__(self):
+
+        MatchMaker.__init__(self)
+
+        self.channels = {}
+        self.selector = selectors.DefaultSelector()
+        self.worker_ids = count()
+
+        # Unix socket other servers join through, if listening
+        self.path = None
+        self.listener = None
+
+        # Waiting sessions by worker and key, and pairs waiting on a socket to be moved
+        self.routes_lock = Lock()
+        self.sessions = {}
+        self.transfers = {}
+        self.pair_ids = count(1)
+
+        self.moved = 0
+
+    # Adds a worker connected through channel, returns its index
+    def add_worker(self, channel):
+
+        index = next(self.worker_ids)
+        self.channels[index] = LobbyChannel(channel)
+        self.selector.register(self.channels[index], selectors.EVENT_READ, index)
+        return index
+
+    # Accepts servers at path - any stale socket file left there is replaced
+    def listen(self, path):
+
+        if os.path.exists(path):
+            os.unlink(path)
+
+        self.path = path
+        self.listener = sock.socket(sock.AF_UNIX, sock.SOCK_SEQPACKET)
+        self.listener.bind(path)
+        self.listener.listen(16)
+        self.selector.register(self.listener, selectors.EVENT_READ)
+
+    # Stops accepting servers and removes the socket file
+    def close(self):
+
+        if self.listener is not None:
+
+            self.selector.unregister(self.listener)
+            self.listener.close()
+            self.listener = None
+            os.unlink(self.path)
+
+    # Starts the sweeps and the thread serving the workers
+    def start(self):
+
+        MatchMaker.start(self)
+
+        channel_thread = Thread(target=self.run_channels)
+        channel_thread.daemon = True
+        channel_thread.start()
+
+    def run_channels(self):
+
+        while self.channels or self.listener is not None:
+            for key, events in self.selector.select(1):
+
+                if key.fileobj is self.listener:
+
+                    channel, address = self.listener.accept()
+                    index = self.add_worker(channel)
+                    Logger.log("Server joined the lobby as worker " + str(index), LogCodes.Match)
+                    continue
+
+                index = key.data
+                if index not in self.channels:
+                    continue
+
+                # A message the lobby can not handle only costs the worker that sent it its channel
+                # noinspection PyBroadException
+                try:
+
+                    message, fd = self.channels[index].receive()
+                    if message is None:
+                        self.remove_worker(index)
+                    else:
+                        lobby_message_map[message[0]](self, index, fd, *message[1:])
+
+                except:
+
+                    Logger.error("Worker " + str(index) + " sent a message the lobby could not handle",
+                                 LogCodes.Match)
+                    self.remove_worker(index)
+
+    # A worker exited - its waiting players are dropped and pairs waiting on it are requeued
+    def remove_worker(self, index):
+
+        channel = self.channels.pop(index, None)
+        if channel is None:
+            return
+
+        Logger.log("Worker " + str(index) + " left the lobby", LogCodes.Match)
+
+        self.selector.unregister(channel)
+        channel.close()
+
+        with self.routes_lock:
+
+            waiting = [session for session in self.sessions.values() if session.worker == index]
+            for session in waiting:
+                del self.sessions[(session.worker, session.key)]
+
+            stranded = [pair_id for pair_id, (host, moving) in self.transfers.items() if moving.worker == index]
+
+        for session in waiting:
+            self.cancel(session)
+
+        for pair_id in stranded:
+            self.release_failed(index, None, pair_id)
+
+    def send(self, worker, message, fd=None):
+
+        channel = self.channels.get(worker)
+        if channel is None:
+            return False
+
+        try:
+            channel.send(message, fd)
+        except (OSError, ValueError):
+            return False
+
+        return True
+
+    # message - ('enqueue', key, username, records, movable)
+    def queue_player(self, worker, fd, key, username, records, movable):
+
+        session = RemoteSession(worker, key, username, records, movable)
+        with self.routes_lock:
+            self.sessions[(worker, key)] = session
+
+        self.enqueue(session)
+
+    # message - ('cancel', key)
+    def cancel_player(self, worker, fd, key):
+
+        with self.routes_lock:
+            session = self.sessions.pop((worker, key), None)
+
+        if session is not None:
+            self.cancel(session)
+
+    # message - ('handoff', pair_id, state) with the moving player's socket
+    # The socket and session state are passed on to the host's worker
+    # Pairs the lobby does not know about are ignored
+    def hand_off(self, worker, fd, pair_id, state):
+
+        with self.routes_lock:
+            transfer = self.transfers.pop(pair_id, None)
+
+        if transfer is None:
+
+            if fd is not None:
+                os.close(fd)
+            return
+
+        host, moving = transfer
+        if fd is not None and self.send(host.worker, ('adopt', host.key, state), fd):
+
+            os.close(fd)
+            self.moved += 1
+            return
+
+        # The moving player's worker has already let it go, so it is dropped - closing the last
+        # copy of its socket disconnects it
+        # The host is still waiting on its worker and goes back in the lobby if the worker is there
+        Logger.warning("Could not move " + moving.userprofile['username'] + " to worker " +
+                       str(host.worker) + ", dropping it", LogCodes.Match)
+
+        if fd is not None:
+            os.close(fd)
+
+        self.requeue(host)
+
+    # message - ('gone', pair_id), the moving player left before it could be released
+    # The host player goes back in the lobby
+    def release_failed(self, worker, fd, pair_id):
+
+        with self.routes_lock:
+            transfer = self.transfers.pop(pair_id, None)
+
+        if transfer is not None:
+            self.requeue(transfer[0])
+
+    # Puts a paired session whose opponent could not join it back in the lobby, unless its worker left
+    def requeue(self, session):
+
+        with self.routes_lock:
+
+            if session.worker in self.channels:
+                self.sessions[(session.worker, session.key)] = session
+
+        if session.worker in self.channels:
+            self.enqueue(session)
+
+    # Two sessions on different workers are only paired if one of them can be moved
+    # Lock must be held
+    def _find_opponent(self, ticket, now):
+
+        opponent = MatchMaker._find_opponent(self, ticket, now)
+        if opponent is None or opponent.session.worker == ticket.session.worker:
+            return opponent
+
+        if ticket.session.movable or opponent.session.movable:
+            return opponent
+
+        return None
+
+    # Called by MatchMaker.pair once two waiting sessions are paired
+    def create_match(self, session1, session2):
+
+        with self.routes_lock:
+
+            self.sessions.pop((session1.worker, session1.key), None)
+            self.sessions.pop((session2.worker, session2.key), None)
+
+            if session1.worker != session2.worker:
+
+                # The second session is the one moved, so a session that can not move hosts
+                if not session2.movable:
+                    session1, session2 = session2, session1
+
+                pair_id = next(self.pair_ids)
+                self.transfers[pair_id] = (session1, session2)
+
+        if session1.worker == session2.worker:
+            self.send(session1.worker, ('pair', session1.key, session2.key))
+
+        elif not self.send(session2.worker, ('release', session2.key, pair_id)):
+            self.release_failed(session2.worker, None, pair_id)
+
+    def stats(self):
+
+        stats = MatchMaker.stats(self)
+        with self.routes_lock:
+
+            stats['workers'] = len(self.channels)
+            stats['moving'] = len(self.transfers)
+            stats['moved'] = self.moved
+
+        return stats
+
+lobby_message_map = {
+
+    'enqueue': LobbyService.queue_player,
+    'cancel':  LobbyService.cancel_player,
+    'handoff': LobbyService.hand_off,
+    'gone':    LobbyService.release_failed
+}
+
+
+# Takes the place of MatchMaker in a worker process
+# Sessions are queued with the supervisor's LobbyService, which pairs them with players on any worker
+# A session paired with a player on another worker either receives that player's socket and
+# session here or is moved there itself
+class LobbyClient(MatchMaker):
+
+    def __init__(self, channel):
+
+        MatchMaker.__init__(self)
+
+        self.channel = LobbyChannel(channel)
+        self.keys = {}
+        self.next_key = count(1)
+
+        # Set by the server for the session type it runs
+        # adopt_session(client, state) - builds a session around a socket moved to this worker
+        # start_session(session) - starts running it
+        self.adopt_session = None
+        self.start_session = None
+
+        self.moved_in = 0
+        self.moved_out = 0
+
+    # Joins the lobby listening at path
+    @staticmethod
+    def connect(path):
+
+        channel = sock.socket(sock.AF_UNIX, sock.SOCK_SEQPACKET)
+        channel.connect(path)
+        return LobbyClient(channel)
+
+    # Starts the thread receiving pairs from the lobby, the lobby runs the sweeps
+    def start(self):
+
+        channel_thread = Thread(target=self.run_channel)
+        channel_thread.daemon = True
+        channel_thread.start()
+
+    def run_channel(self):
+
+        while True:
+
+            # noinspection PyBroadException
+            try:
+
+                message, fd = self.channel.receive()
+                if message is None:
+                    break
+
+                worker_message_map[message[0]](self, fd, *message[1:])
+
+            except:
+                Logger.error("Could not handle a message from the lobby", LogCodes.Match)
+
+        # Without the lobby no one can be paired
+        Logger.error("Lost the connection to the lobby", LogCodes.Match)
+        with self.lock:
+            tickets = list(self.tickets.values())
+
+        for ticket in tickets:
+            self.cancel(ticket.session)
+
+    # movable - False once the session could not be moved, the lobby then moves its opponent instead
+    def enqueue(self, session, movable=True):
+
+        with self.lock:
+
+            ticket = self.tickets.get(session)
+            if ticket is not None:
+                return ticket
+
+            ticket = MatchTicket(session, self.rating(session.userprofile['records']))
+            ticket.movable = movable
+            self._add(ticket)
+
+        self.queue(ticket)
+        return ticket
+
+    def cancel(self, session):
+
+        with self.lock:
+
+            ticket = self.tickets.get(session)
+            if ticket is not None:
+                self._remove(ticket)
+
+        if ticket is not None:
+
+            self.send(('cancel', ticket.key))
+            ticket.future.set_result(None)
+
+    # The lobby pairs players as they queue
+    def sweep(self):
+        pass
+
+    # Sends the socket and state of a session released by the lobby, called by the session
+    # once it has stopped reading
+    # Returns None once the session has moved. A session that can not be moved stays here - the lobby
+    # is told so it can requeue the other player, and the returned ticket waits for another match
+    def transfer(self, session, transfer):
+
+        state = session.transfer_state()
+        state['waited'] = transfer.waited
+
+        # The host is only committed once the lobby has the socket, so refusing here costs it nothing
+        # Responses still queued here would be cut off by the new worker writing to the same socket
+        if not session.client.flush():
+            reason = "it still has responses queued"
+
+        elif len(LobbyChannel.encode(state)) > LobbyChannel.max_state:
+            reason = "its session state is too big"
+
+        else:
+
+            try:
+
+                self.channel.send(('handoff', transfer.pair_id, state), session.client.fileno())
+                with self.lock:
+                    self.moved_out += 1
+
+                return None
+
+            except (OSError, ValueError) as error:
+                reason = str(error)
+
+        Logger.warning("Could not move " + session.userprofile['username'] + " to another worker, " + reason,
+                       LogCodes.Match)
+        self.send(('gone', transfer.pair_id))
+
+        ticket = self.enqueue(session, movable=False)
+        ticket.queued -= transfer.waited
+        return ticket
+
+    def stats(self):
+
+        stats = MatchMaker.stats(self)
+        with self.lock:
+
+            stats['moved_in'] = self.moved_in
+            stats['moved_out'] = self.moved_out
+
+        return stats
+
+    def send(self, message):
+
+        try:
+            self.channel.send(message)
+        except OSError:
+            Logger.error("Could not reach the lobby", LogCodes.Match)
+
+    def queue(self, ticket):
+
+        records = ticket.session.userprofile['records']
+        self.send(('enqueue', ticket.key, ticket.session.userprofile['username'],
+                   {'wins': records['wins'], 'loss': records['loss'], 'draw': records['draw']}, ticket.movable))
+
+    # message - ('pair', key1, key2), both players are on this worker
+    def pair_local(self, fd, key1, key2):
+
+        with self.lock:
+
+            ticket1 = self.keys.get(key1)
+            ticket2 = self.keys.get(key2)
+
+            if ticket1 is not None and ticket2 is not None:
+
+                self._remove(ticket1)
+                self._remove(ticket2)
+
+        if ticket1 is not None and ticket2 is not None:
+            self.pair(ticket1, ticket2)
+
+        # One of them stopped waiting, the other goes back in the lobby
+        elif ticket1 is not None or ticket2 is not None:
+            self.queue(ticket1 or ticket2)
+
+    # message - ('release', key, pair_id)
+    # The lobby paired a session here with a player on another worker which will host the match
+    def release(self, fd, key, pair_id):
+
+        with self.lock:
+
+            ticket = self.keys.get(key)
+            if ticket is not None:
+                self._remove(ticket)
+
+        if ticket is None:
+            self.send(('gone', pair_id))
+        else:
+            ticket.future.set_result(Transfer(pair_id, monotonic() - ticket.queued))
+
+    # message - ('adopt', key, state) with the socket of a player on another worker
+    # paired with the session waiting here as key
+    # The socket is wrapped in a new session that joins the match here
+    def adopt(self, fd, key, state):
+
+        session = self.adopt_session(sock.socket(fileno=fd), state)
+
+        ticket = MatchTicket(session, self.rating(session.userprofile['records']))
+        ticket.queued -= state['waited']
+        session.ticket = ticket
+
+        with self.lock:
+
+            self.moved_in += 1
+            host = self.keys.get(key)
+
+            if host is not None:
+                self._remove(host)
+            else:
+                self._add(ticket)
+
+        if host is not None:
+            self.pair(host, ticket)
+        else:
+            self.queue(ticket)
+
+        self.start_session(session)
+
+    # Lock must be held
+    def _add(self, ticket):
+
+        ticket.key = next(self.next_key)
+        self.tickets[ticket.session] = ticket
+        self.keys[ticket.key] = ticket
+
+    # Lock must be held
+    def _remove(self, ticket):
+
+        del self.tickets[ticket.session]
+        del self.keys[ticket.key]
+
+worker_message_map = {
+
+    'pair':    LobbyClient.pair_local,
+    'release': LobbyClient.release,
+    'adopt':   LobbyClient.adopt
+}
@@ -1,4 +1,4 @@
-from queue import Queue
+from collections import deque
 from enum import IntEnum
 
 
@@ -11,26 +11,113 @@ class LogCodes(IntEnum):
     Chance = 4
 
 
+class LogLevels(IntEnum):
+
+    DEBUG = 10
+    INFO = 20
+    WARNING = 30
+    ERROR = 40
+
+
 class Logger:
 
     logging = True
+    level = LogLevels.INFO
     log_interval = 250
     queue_count = 5
 
-    _queues = []
+    # Messages kept per channel - once full the oldest message is dropped
+    buffer_size = 2000
+
+    _debug = False
+    _buffers = []
+    _dropped = []
     for index in range(0, queue_count):
-        _queues.append(Queue())
 
+        _buffers.append(deque(maxlen=buffer_size))
+        _dropped.append(0)
+
+    # Records a message on a channel if its level is enabled
+    # With args the message is a str.format template - formatting is deferred until the message
+    # is retrieved so messages nothing reads are never formatted
+    # Callable args are called at that point, use them for expensive values such as hex dumps
+    # Args must not be mutated after logging
     @staticmethod
-    def log(message, code=LogCodes.Network):
+    def log(message, code=LogCodes.Network, level=LogLevels.INFO, *args):
 
-        if Logger.logging:
-            Logger._queues[code].put(message)
+        if not Logger.logging or level < Logger.level:
+            return
+
+        buffer = Logger._buffers[code]
+        if len(buffer) == Logger.buffer_size:
+            Logger._dropped[code] += 1
+
+        buffer.append((level, message, args))
+
+    # Debug messages sit on hot paths so the level is checked before any call is made
+    @staticmethod
+    def debug(message, code=LogCodes.Network, *args):
+
+        if Logger._debug:
+            Logger.log(message, code, LogLevels.DEBUG, *args)
+
+    @staticmethod
+    def warning(message, code=LogCodes.Network, *args):
+        Logger.log(message, code, LogLevels.WARNING, *args)
+
+    @staticmethod
+    def error(message, code=LogCodes.Network, *args):
+        Logger.log(message, code, LogLevels.ERROR, *args)
+
+    # Returns true if messages at level would be recorded
+    @staticmethod
+    def enabled(level):
+        return Logger.logging and level >= Logger.level
+
+    @staticmethod
+    def set_level(level):
+
+        Logger.level = LogLevels(level)
+        Logger._debug = Logger.level <= LogLevels.DEBUG
 
     @staticmethod
     def log_count(code=LogCodes.Network):
-        return Logger._queues[code].qsize()
+        return len(Logger._buffers[code])
 
+    # Removes and formats the oldest message on a channel
     @staticmethod
     def retrieve(code=LogCodes.Network):
-        return Logger._queues[code].get()
+
+        level, message, args = Logger._buffers[code].popleft()
+
+        if args:
+            message = message.format(*[arg() if callable(arg) else arg for arg in args])
+
+        if level != LogLevels.INFO:
+            message = "[" + level.name + "] " + str(message)
+
+        return message
+
+    # Removes and formats every message currently on a channel
+    @staticmethod
+    def retrieve_all(code=LogCodes.Network):
+
+        messages = []
+        for index in range(Logger.log_count(code)):
+            messages.append(Logger.retrieve(code))
+
+        return messages
+
+    # Number of messages dropped because a channel was full
+    @staticmethod
+    def dropped(code=LogCodes.Network):
+        return Logger._dropped[code]
+
+    @staticmethod
+    def stats():
+
+        stats = {}
+        for code in LogCodes:
+            stats[code.name] = {'buffered': Logger.log_count(code), 'dropped': Logger.dropped(code)}
+
+        return stats
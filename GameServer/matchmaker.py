@@ -0,0 +1,309 @@
+from concurrent.futures import Future
+from threading import Lock, Thread
+from time import monotonic, sleep
+
+from match import Match
+from engine import Player
+from logger import Logger, LogCodes
+
+
+# A session waiting in the lobby - the future resolves to its Match
+# or to None if the session stopped waiting before a match was found
+class MatchTicket:
+
+    def __init__(self, session, rating):
+
+        self.session = session
+        self.rating = rating
+        self.queued = monotonic()
+        self.wait_time = None
+        self.future = Future()
+
+        # Identifies the ticket to the lobby when players are paired across worker processes
+        # and whether the lobby may move the session to another worker to join its match
+        self.key = None
+        self.movable = True
+
+
+# Waiting tickets indexed by rating
+# Ratings are whole numbers from 0 to max_rating so each has a fixed bucket, kept in queue order,
+# and a bitmap marks the ratings with waiting players
+# The nearest occupied rating either side is found with a few word sized bit operations, so adding,
+# removing and finding an opponent take constant time however many players are waiting
+class RatingLobby:
+
+    max_rating = 1000
+
+    def __init__(self):
+
+        self.buckets = [{} for _ in range(self.max_rating + 1)]
+        self.occupied = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, ticket):
+
+        rating = self._clamp(ticket.rating)
+        self.buckets[rating][ticket.session] = ticket
+        self.occupied |= 1 << rating
+        self.count += 1
+
+    def remove(self, ticket):
+
+        rating = self._clamp(ticket.rating)
+        bucket = self.buckets[rating]
+        del bucket[ticket.session]
+        self.count -= 1
+
+        if not bucket:
+            self.occupied &= ~(1 << rating)
+
+    # Returns the longest waiting ticket with the closest rating, ignoring exclude
+    def nearest(self, rating, exclude=None):
+
+        rating = self._clamp(rating)
+
+        # Players with the same rating are the closest possible
+        same = self._oldest(rating, exclude)
+        if same is not None:
+            return same
+
+        lower = self._oldest(self._below(rating), exclude)
+        upper = self._oldest(self._above(rating), exclude)
+
+        if lower is None or upper is None:
+            return lower or upper
+
+        lower_gap = rating - lower.rating
+        upper_gap = upper.rating - rating
+
+        if lower_gap < upper_gap or lower_gap == upper_gap and lower.queued <= upper.queued:
+            return lower
+
+        return upper
+
+    # Closest occupied rating under rating, -1 if none
+    def _below(self, rating):
+        return (self.occupied & ((1 << rating) - 1)).bit_length() - 1
+
+    # Closest occupied rating over rating, -1 if none
+    def _above(self, rating):
+
+        higher = self.occupied >> (rating + 1)
+        if not higher:
+            return -1
+
+        return rating + (higher & -higher).bit_length()
+
+    # Oldest ticket of a rating that is not exclude
+    # Buckets are in queue order so at most one ticket, exclude, is skipped
+    def _oldest(self, rating, exclude):
+
+        if rating < 0:
+            return None
+
+        for ticket in self.buckets[rating].values():
+            if ticket is not exclude:
+                return ticket
+
+        return None
+
+    def _clamp(self, rating):
+        return min(max(rating, 0), self.max_rating)
+
+
+# Pairs sessions with the closest rated opponent the moment one is in range
+# Each waiting session blocks on its own ticket instead of polling a shared event
+# The acceptable rating gap widens the longer a player waits
+class MatchMaker:
+
+    # Rating gap accepted straight away, how fast it widens per second waited and its cap
+    base_window = 50
+    widen_rate = 25
+    max_window = 1000
+
+    # How often waiting players are re-checked against their widened windows
+    sweep_interval = 1
+
+    def __init__(self):
+
+        self.lock = Lock()
+        self.lobby = RatingLobby()
+        self.tickets = {}
+
+        self.matches = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.total_gap = 0
+
+    # Maps a players wins/loss/draw record onto a 0 - 1000 rating
+    # The record is smoothed towards 500 so new players are not placed at the extremes
+    @staticmethod
+    def rating(records):
+
+        points = records['wins'] + records['draw'] / 2
+        games = records['wins'] + records['loss'] + records['draw']
+
+        return round(1000 * (points + 5) / (games + 10))
+
+    # Rating gap a ticket accepts after waiting until now
+    def window(self, ticket, now):
+        return min(self.max_window, self.base_window + self.widen_rate * (now - ticket.queued))
+
+    # Starts the thread that pairs waiting players as their windows widen
+    def start(self):
+
+        sweep_thread = Thread(target=self.run_sweeps)
+        sweep_thread.daemon = True
+        sweep_thread.start()
+
+    def run_sweeps(self):
+
+        while True:
+
+            sleep(self.sweep_interval)
+            self.sweep()
+
+    # Adds a session to the lobby and pairs it if an opponent in range is already waiting
+    # Returns the ticket the session should wait on
+    def enqueue(self, session):
+
+        with self.lock:
+
+            ticket = self.tickets.get(session)
+            if ticket is not None:
+                return ticket
+
+            ticket = MatchTicket(session, self.rating(session.userprofile['records']))
+            opponent = self._find_opponent(ticket, monotonic())
+
+            if opponent is None:
+
+                self.tickets[session] = ticket
+                self.lobby.add(ticket)
+                return ticket
+
+            self._remove(opponent)
+
+        self.pair(opponent, ticket)
+        return ticket
+
+    # Pairs any waiting players whose widened windows now overlap
+    # The longest waiting players are given the first pick
+    def sweep(self):
+
+        pairs = []
+        with self.lock:
+
+            now = monotonic()
+            for ticket in list(self.tickets.values()):
+
+                if ticket.session not in self.tickets:
+                    continue
+
+                opponent = self._find_opponent(ticket, now)
+                if opponent is not None:
+
+                    self._remove(ticket)
+                    self._remove(opponent)
+                    pairs.append((ticket, opponent))
+
+        for ticket, opponent in pairs:
+            self.pair(ticket, opponent)
+
+    # Removes a session from the lobby and wakes it with no match
+    def cancel(self, session):
+
+        with self.lock:
+
+            ticket = self.tickets.get(session)
+            if ticket is not None:
+                self._remove(ticket)
+
+        if ticket is not None:
+            ticket.future.set_result(None)
+
+    def waiting(self):
+
+        with self.lock:
+            return len(self.tickets)
+
+    def stats(self):
+
+        with self.lock:
+
+            return {
+                'waiting': len(self.tickets),
+                'matches': self.matches,
+                'avg_wait': self.total_wait / (self.matches * 2) if self.matches else 0.0,
+                'max_wait': self.max_wait,
+                'avg_rating_gap': self.total_gap / self.matches if self.matches else 0.0
+            }
+
+    # Closest rated waiting ticket either player would accept - lock must be held
+    def _find_opponent(self, ticket, now):
+
+        opponent = self.lobby.nearest(ticket.rating, ticket)
+        if opponent is None:
+            return None
+
+        gap = abs(ticket.rating - opponent.rating)
+        if gap <= max(self.window(ticket, now), self.window(opponent, now)):
+            return opponent
+
+        return None
+
+    # Lock must be held
+    def _remove(self, ticket):
+
+        del self.tickets[ticket.session]
+        self.lobby.remove(ticket)
+
+    # Creates the match and hands it to both waiting sessions
+    def pair(self, ticket1, ticket2):
+
+        now = monotonic()
+        ticket1.wait_time = now - ticket1.queued
+        ticket2.wait_time = now - ticket2.queued
+
+        match = self.create_match(ticket1.session, ticket2.session)
+
+        with self.lock:
+
+            self.matches += 1
+            self.total_wait += ticket1.wait_time + ticket2.wait_time
+            self.max_wait = max(self.max_wait, ticket1.wait_time, ticket2.wait_time)
+            self.total_gap += abs(ticket1.rating - ticket2.rating)
+
+        Logger.log("Ratings " + str(ticket1.rating) + " vs " + str(ticket2.rating) + ", " +
+                   "queue wait for " + ticket1.session.userprofile['username'] + ": " +
+                   "{:.1f}ms".format(ticket1.wait_time * 1000) + ", " +
+                   ticket2.session.userprofile['username'] + ": " +
+                   "{:.1f}ms".format(ticket2.wait_time * 1000), LogCodes.Match)
+
+        ticket1.future.set_result(match)
+        ticket2.future.set_result(match)
+
+    @staticmethod
+    def create_match(session1, session2):
+
+        p1_name = session1.userprofile['username']
+        p1_cats = session1.userprofile['records']['cats']
+        p1_network = session1.network
+        p1_socket = session1.client
+        p1_userid = session1.userprofile.get('userid')
+        player1 = Player(p1_name, p1_cats, p1_network, p1_socket, p1_userid)
+
+        p2_name = session2.userprofile['username']
+        p2_cats = session2.userprofile['records']['cats']
+        p2_network = session2.network
+        p2_socket = session2.client
+        p2_userid = session2.userprofile.get('userid')
+        player2 = Player(p2_name, p2_cats, p2_network, p2_socket, p2_userid)
+
+        Logger.log("Creating match for " + p1_name +
+                   " & " + p2_name)
+
+        return Match(player1, player2)
@@ -0,0 +1,154 @@
+import traceback
+
+from collections import deque
+from threading import Condition, Thread
+from time import perf_counter
+
+from network import Request
+from flags import Flags
+from metrics import Metrics
+from logger import Logger, LogCodes
+
+
+# Runs every match as an actor on a fixed number of threads
+# Sessions post a match's requests to its mailbox instead of running them, a match with mail waits in
+# the ready queue once and a pool thread runs its requests in the order they were posted
+# Only one thread runs a match at a time so matches need no lock, and the thread count stays the
+# same however many matches are running
+class MatchPool:
+
+    def __init__(self, size=4, batch_size=16):
+
+        # size - number of pool threads
+        # batch_size - most requests run for one match before its thread moves on to the next match
+        self.size = size
+        self.batch_size = batch_size
+
+        self.condition = Condition()
+        self.ready = deque()
+        self.running = False
+        self.threads = []
+
+        self.posted = 0
+        self.processed = 0
+        self.failures = 0
+
+        # Requests waiting in every mailbox, the deepest single mailbox seen and
+        # the sum of mailbox depths as requests were posted
+        self.waiting = 0
+        self.peak_depth = 0
+        self.total_depth = 0
+
+    def start(self):
+
+        self.running = True
+        for index in range(self.size):
+
+            thread = Thread(target=self.run, name="match-pool-" + str(index))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    # Stops the pool threads once every mailbox has been drained
+    def close(self):
+
+        with self.condition:
+
+            self.running = False
+            self.condition.notify_all()
+
+        for thread in self.threads:
+            thread.join()
+
+        self.threads = []
+
+    # Queues handler(*args) in a match's mailbox
+    def post(self, match, handler, *args):
+
+        with self.condition:
+
+            match.mailbox.append((perf_counter(), handler, args))
+            depth = len(match.mailbox)
+
+            self.posted += 1
+            self.waiting += 1
+            self.total_depth += depth
+            if depth > self.peak_depth:
+                self.peak_depth = depth
+
+            if not match.scheduled:
+
+                match.scheduled = True
+                self.ready.append(match)
+                self.condition.notify()
+
+    def run(self):
+
+        while True:
+
+            with self.condition:
+
+                while self.running and not self.ready:
+                    self.condition.wait()
+
+                # Only stopped threads with nothing left to run get here empty handed
+                if not self.ready:
+                    return
+
+                match = self.ready.popleft()
+                batch = [match.mailbox.popleft() for _ in range(min(len(match.mailbox), self.batch_size))]
+                self.waiting -= len(batch)
+
+            failures = 0
+            for posted, handler, args in batch:
+
+                Metrics.observe('mailbox_wait', 'match', perf_counter() - posted)
+
+                # A failing request must not take the pool thread down with it
+                # noinspection PyBroadException
+                try:
+                    handler(*args)
+                except:
+
+                    failures += 1
+                    Logger.error("Match request {} failed\n{}", LogCodes.Match,
+                                 self.describe(handler, args), traceback.format_exc())
+
+            # Matches with more mail go to the back of the queue so busy matches take turns
+            with self.condition:
+
+                self.processed += len(batch)
+                self.failures += failures
+
+                if match.mailbox:
+
+                    self.ready.append(match)
+                    self.condition.notify()
+
+                else:
+                    match.scheduled = False
+
+    # Names a failed request for the log - the handler and the flag of the request it was given
+    @staticmethod
+    def describe(handler, args):
+
+        name = getattr(handler, '__qualname__', repr(handler))
+        for arg in args:
+            if isinstance(arg, Request):
+                return name + " (" + Flags.flag_name(arg.flag) + ")"
+
+        return name
+
+    def stats(self):
+
+        with self.condition:
+
+            return {
+                'threads': self.size,
+                'ready_matches': len(self.ready),
+                'waiting': self.waiting,
+                'peak_mailbox': self.peak_depth,
+                'avg_mailbox': self.total_depth / self.posted if self.posted else 0.0,
+                'processed': self.processed,
+                'failures': self.failures
+            }
@@ -0,0 +1,130 @@
+from threading import Lock
+from time import time
+
+
+# Latency histogram with power of two microsecond buckets
+# Bucket i holds samples below 2^i microseconds, the last bucket holds everything slower
+class Histogram:
+
+    bucket_count = 28
+
+    def __init__(self):
+
+        self.lock = Lock()
+        self.buckets = [0] * self.bucket_count
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    # seconds - duration of one sample
+    def observe(self, seconds):
+
+        index = min(int(seconds * 1000000).bit_length(), self.bucket_count - 1)
+        with self.lock:
+
+            self.buckets[index] += 1
+            self.count += 1
+            self.total += seconds
+            if seconds > self.max:
+                self.max = seconds
+
+    # Upper bound in seconds of the bucket holding the given percentile
+    def percentile(self, percent):
+
+        if not self.count:
+            return 0.0
+
+        target = self.count * percent / 100
+        seen = 0
+
+        for index, count in enumerate(self.buckets):
+
+            seen += count
+            if seen >= target:
+                return min(2 ** index / 1000000, self.max)
+
+        return self.max
+
+    def summary(self):
+
+        mean = self.total / self.count if self.count else 0.0
+        return "count={} mean={:.3f}ms p50={:.3f}ms p95={:.3f}ms p99={:.3f}ms max={:.3f}ms".format(
+            self.count, mean * 1000, self.percentile(50) * 1000, self.percentile(95) * 1000,
+            self.percentile(99) * 1000, self.max * 1000)
+
+
+# Server wide instrumentation
+# Latencies are grouped by kind (request, phase, mailbox_wait, db) and a name within the kind
+# Counters track totals such as bytes in and out per protocol
+# Gauges are callables returning the stats of other components, read when a snapshot is taken
+class Metrics:
+
+    enabled = True
+    started = time()
+
+    _lock = Lock()
+    _histograms = {}
+    _counters = {}
+    _gauges = {}
+
+    # Records a latency sample
+    @staticmethod
+    def observe(kind, name, seconds):
+
+        if not Metrics.enabled:
+            return
+
+        histogram = Metrics._histograms.get((kind, name))
+        if histogram is None:
+
+            with Metrics._lock:
+                histogram = Metrics._histograms.setdefault((kind, name), Histogram())
+
+        histogram.observe(seconds)
+
+    # Adds to a counter
+    @staticmethod
+    def count(kind, name, amount=1):
+
+        if not Metrics.enabled:
+            return
+
+        key = (kind, name)
+        with Metrics._lock:
+            Metrics._counters[key] = Metrics._counters.get(key, 0) + amount
+
+    # Registers a callable whose stats are included in every snapshot
+    @staticmethod
+    def register_gauge(name, stats):
+        Metrics._gauges[name] = stats
+
+    @staticmethod
+    def reset():
+
+        with Metrics._lock:
+
+            Metrics._histograms = {}
+            Metrics._counters = {}
+            Metrics.started = time()
+
+    # Returns every metric as plain text, one metric per line
+    @staticmethod
+    def snapshot():
+
+        with Metrics._lock:
+
+            histograms = sorted(Metrics._histograms.items())
+            counters = sorted(Metrics._counters.items())
+
+        lines = ["uptime={:.0f}s".format(time() - Metrics.started)]
+
+        for (kind, name), histogram in histograms:
+            lines.append("{} {} {}".format(kind, name, histogram.summary()))
+
+        for (kind, name), value in counters:
+            lines.append("{} {} {}".format(kind, name, value))
+
+        for name, stats in sorted(Metrics._gauges.items()):
+            lines.append("{} {}".format(name, stats()))
+
+        return "\n".join(lines) + "\n"
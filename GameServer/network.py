@@ -6,63 +6,18 @@ import re
 import binascii
 
 from pymysql.cursors import DictCursor
-from logger import Logger
-from enum import IntEnum
-
-
-# Enum to map flag literals to a name
-class Flags(IntEnum):
-
-    @staticmethod
-    def valid_flag(flag):
-        return flag in list(map(int, Flags))
-
-    FAILURE = 0
-    SUCCESS = 1
-    DRAW = 2
-    ERROR = 3
-    CLOSE = 8
-
-    ZERO_BYTE = 0
-    ONE_BYTE = 1
-    TWO_BYTE = 2
-
-    LOGIN = 0
-    LOGOUT = 1
-    FIND_MATCH = 2
-    USER_PROFILE = 3
-    ALL_CARDS = 4
-    CAT_CARDS = 5
-    BASIC_CARDS = 6
-    CHANCE_CARDS = 7
-    ABILITY_CARDS = 8
-    END_MATCH = 9
-    WEB_LOGIN = 10
-
-    OP_CAT = 49
-    GAIN_HP = 50
-    OP_GAIN_HP = 51
-    DMG_MODIFIED = 52
-    OP_DMG_MODIFIED = 53
-    GAIN_CHANCE = 54
-    OP_GAIN_CHANCE = 55
-    GAIN_ABILITY = 56
-    GAIN_CHANCES = 57
-    REVEAL_MOVE = 58
-    REVEAL_CHANCE = 59
-    SPOTLIGHT = 60
-    OP_SPOTLIGHT = 61
-
-    NEXT_PHASE = 98
-    READY = 99
-    SELECT_CAT = 100
-    USE_ABILITY = 101
-    SELECT_MOVE = 102
-    USE_CHANCE = 103
+from dbpool import ConnectionPool
+from logger import Logger, LogCodes
+from metrics import Metrics
+from buffers import ReceiveBuffer
+from websocket import frame_header, Opcodes
+from time import perf_counter
 
 
 class Request:
 
+    __slots__ = ('flag', 'token', 'size', 'body')
+
     def __init__(self, flag, token, size, body):
 
         self.flag = flag
@@ -74,18 +29,8 @@ class Request:
 # Helper class that contains useful network functions
 class Network:
 
-    # Translates an int to x bytes - returns byte array object
-    # byte_f - byte_format
-    @staticmethod
-    def int_xbyte(num, byte_f):
-
-        _bytes = bytearray()
-        for i in range(0, byte_f):
-
-            _bytes.insert(0, num & 0xFF)
-            num >>= 8
-
-        return _bytes
+    # Name used when recording traffic metrics
+    protocol = 'tcp'
 
     # Determines if the connection is from a WebSocket
     @staticmethod
@@ -94,10 +39,11 @@ class Network:
         is_websocket = False
 
         # Peek to get data without pulling from queue
-        data = (client.recv(1024, sock.MSG_PEEK)).decode('utf-8')
+        # Raw requests are binary so the peeked bytes are not decoded
+        data = client.recv(1024, sock.MSG_PEEK)
 
         # If the request is a HTTP GET flush it from the queue and initiate handshake
-        if re.search('GET', data):
+        if re.search(b'GET', data):
             is_websocket = True
 
         return is_websocket
@@ -105,11 +51,7 @@ class Network:
     # Creates response header with flag and size
     @staticmethod
     def generate_responseh(flag, size):
-
-        response = bytearray()
-        response.append(flag)
-        response += Network.int_xbyte(size, 3)
-        return response
+        return bytearray((flag, (size >> 16) & 0xFF, (size >> 8) & 0xFF, size & 0xFF))
 
     # Creates header with flag and size and attaches response body
     @staticmethod
@@ -119,6 +61,8 @@ class Network:
 
         if isinstance(body, str):
             response += body.encode('utf-8')
+        elif isinstance(body, (bytes, bytearray)):
+            response += body
         else:
             response.append(body)
 
@@ -132,52 +76,53 @@ class Network:
             password='kittywar', db='deisume_kittywar', autocommit=True)
 
     # Alternative to db_connection, executes an sql statement for you
+    # Connections are borrowed from and returned to the shared pool
     @staticmethod
     def sql_query(query):
 
-        db = Network.db_connection()
-
+        start = perf_counter()
         result = None
+        broken = False
+
+        # noinspection PyBroadException
+        try:
+            db = Network.db_pool.acquire()
+        except:
+            Logger.error("Could not get a database connection for query: {}\n", LogCodes.Network, query)
+            return result
+
         # noinspection PyBroadException
         try:
             with db.cursor(DictCursor) as cursor:
 
                 cursor.execute(query)
                 result = cursor.fetchall()
+
+        except (pymysql.OperationalError, pymysql.InterfaceError):
+
+            # The connection itself failed so do not hand it out again
+            broken = True
+            Logger.error("The following query did not properly execute: {}\n", LogCodes.Network, query)
+
         except:
             # print("The following query did not properly execute: " + query)
-            Logger.log("The following query did not properly execute: " + query + "\n")
+            Logger.error("The following query did not properly execute: {}\n", LogCodes.Network, query)
 
         finally:
-            db.close()
+            Network.db_pool.release(db, broken)
 
+        # Timings are grouped by statement type - SELECT, UPDATE...
+        Metrics.observe('db', query.split(' ', 1)[0].upper(), perf_counter() - start)
         return result
 
-    # Receives a fixed amount of data from client or returns none if error receiving
-    @staticmethod
-    def receive_data(client, data_size):
-
-        packet = b''
-        received_data = bytearray()
-        while len(received_data) < data_size:
-
-            try:
-                packet = client.recv(data_size - len(received_data))
-            except ConnectionResetError:
-                pass
-
-            if not packet:
-                return None
-
-            received_data += packet
-
-        return received_data
-
     # Sends a response to client based on previous request
-    @staticmethod
-    def send_data(username, client, data):
+    @classmethod
+    def send_data(cls, username, client, data):
+
+        # Hex dumps are only built if the message is read
+        Logger.debug("{} Response: {}\n", LogCodes.Network, username, lambda: binascii.hexlify(data))
 
-        Logger.log(username + " Response: " + str(binascii.hexlify(data)) + "\n")
+        Metrics.count('bytes_out', cls.protocol, len(data))
 
         # noinspection PyBroadException
         try:
@@ -185,35 +130,109 @@ class Network:
         except:
             pass
 
+    # Turns a message from the connection's decoder into a request
+    # RequestDecoder already produces requests
+    @staticmethod
+    def parse_message(message):
+        return message
+
+    # Converts a decoded message to plain data and back so it can be moved to another worker
+    @staticmethod
+    def save_message(message):
+        return [message.flag, message.token, message.size, message.body]
+
     @staticmethod
-    def parse_request(client, data):
+    def load_message(data):
+        return Request(*data)
 
-        Logger.log("Raw Request: " + str(binascii.hexlify(data)))
+    # Splits a 28 byte request header into its flag, token and body size
+    @staticmethod
+    def parse_header(data):
 
         flag = data[0]
-        token = data[1:25].decode('utf-8')
+        token = str(data[1:25], 'utf-8', 'replace')
         size = int.from_bytes(data[25:28], byteorder='big')
 
+        return flag, token, size
+
+
+# Database connections shared by every session
+Network.db_pool = ConnectionPool(Network.db_connection)
+
+
+# Decodes raw TCP requests - a 28 byte header (flag, token, body size) followed by the body
+# Every complete request in the buffer is parsed so pipelined requests cost one recv
+class RequestDecoder(ReceiveBuffer):
+
+    protocol = 'tcp'
+    header_size = 28
+
+    def __init__(self, buffer_size=16384, max_body=1048576):
+
+        ReceiveBuffer.__init__(self, buffer_size)
+        self.max_body = max_body
+
+    # Returns the next complete request or None if more bytes are needed
+    def decode(self):
+
+        view = self.view
+        start = self.start
+        available = self.end - start
+
+        if available < self.header_size:
+            return None
+
+        header = view[start:start + self.header_size]
+        size = int.from_bytes(header[25:28], byteorder='big')
+
+        if size > self.max_body:
+
+            Logger.warning("Request body of " + str(size) + " bytes is too big", LogCodes.Network)
+            self.closed = True
+            return None
+
+        end = start + self.header_size + size
+        if self.end < end:
+
+            self.needed = end - start
+            return None
+
+        self.needed = 0
+        self.start = end
+
+        # The header is a view of the receive buffer, which is reused before the log is written
+        header = bytes(header)
+        Logger.debug("Raw Request: {}", LogCodes.Network, lambda: binascii.hexlify(header))
+        flag, token, size = Network.parse_header(header)
+
         body = None
         if size > 0:
-            body = Network.receive_data(client, size)
-            Logger.log("Raw Body: " + str(body) + "\n")
 
-        if body:
-            body = body.decode('utf-8')
+            body = str(view[start + self.header_size:end], 'utf-8', 'replace')
+            Logger.debug("Raw Body: {}\n", LogCodes.Network, body)
 
-        request = Request(flag, token, size, body)
-        return request
+        return Request(flag, token, size, body)
 
 
 # Helper class that contains useful WebSocket related network functions
 class WNetwork(Network):
 
+    protocol = 'websocket'
+
     @staticmethod
     def handshake(client):
 
         request = (client.recv(1024)).decode('utf-8')
 
+        response = WNetwork.handshake_response(request)
+        if response:
+            client.sendall(response)
+
+    # Builds the HTTP upgrade response for a WebSocket handshake request
+    # Returns None if the request does not carry a WebSocket key
+    @staticmethod
+    def handshake_response(request):
+
         response = \
             b'HTTP/1.1 101 Switching Protocols\r\n' \
             b'Upgrade: websocket\r\n' \
@@ -229,16 +248,30 @@ class WNetwork(Network):
             accept_key = hashlib.sha1(accept_key).digest()
             accept_key = base64.b64encode(accept_key)
 
-            client.sendall(response % accept_key)
+            return response % accept_key
+
+        return None
+
+    @staticmethod
+    def parse_message(message):
+        return WNetwork.parse_payload(message)
+
+    @staticmethod
+    def save_message(message):
+        return message.hex()
+
+    @staticmethod
+    def load_message(data):
+        return bytes.fromhex(data)
 
+    # Creates a request from a decoded WebSocket payload
     @staticmethod
-    def parse_request(client, data):
+    def parse_payload(payload):
 
-        payload = WNetwork.read_frame(client, data)
         if not payload:
             return None
 
-        Logger.log("Raw Payload: " + str(payload))
+        Logger.debug("Raw Payload: {}", LogCodes.Network, payload)
 
         flag = payload[0]
 
@@ -248,7 +281,7 @@ class WNetwork(Network):
 
         if body:
 
-            Logger.log("Raw Body: " + str(body) + "\n")
+            Logger.debug("Raw Body: {}\n", LogCodes.Network, body)
             body = int.from_bytes(body, byteorder='big')
             body = str(body)
 
@@ -269,80 +302,22 @@ class WNetwork(Network):
     def generate_responseb(flag, size, body):
 
         response = WNetwork.generate_responseh(flag, size)
-        response.append(body)
-
-        return response
-
-    @staticmethod
-    def read_frame(client, data):
-
-        decoded_payload = bytearray()
-        while True:
-
-            fin = (data[0] & 0x80) >> 7
-            opcode = (data[0] & 0x0F)
-            mask = (data[1] & 0x80) >> 7
-            payload_len = (data[1] & 0x7F)
-
-            Logger.log("Raw Frame: " + str(binascii.hexlify(data)) + "\n" +
-                       "Fin: " + str(fin) + "\n" +
-                       "Opcode: " + str(opcode) + "\n" +
-                       "Mask: " + str(mask) + "\n" +
-                       "Payload Length: " + str(payload_len) + "\n")
-
-            if opcode == Flags.CLOSE or payload_len < 25:
-
-                Logger.log("Frame close opcode/Invalid payload length detected" + "\n")
-                return None
 
-            if payload_len == 126:
-                payload_len = WNetwork.receive_data(client, 2)  # or 0
-            elif payload_len == 127:
-                payload_len = WNetwork.receive_data(client, 8)  # or 0
-
-            mask_key = WNetwork.receive_data(client, 4)  # or 0
-            payload = WNetwork.receive_data(client, payload_len)
-
-            for index in range(len(payload)):
-                decoded_payload.append(payload[index] ^ mask_key[index % 4])
-
-            if fin == 1:
-                break
-
-            data = WNetwork.receive_data(client, 2)
+        if isinstance(body, str):
+            response += body.encode('utf-8')
+        elif isinstance(body, (bytes, bytearray)):
+            response += body
+        else:
+            response.append(body)
 
-        return decoded_payload
+        return response
 
     @staticmethod
     def write_frame(flag, size):
 
-        response = bytearray()
-
-        # FIN 1 RSVS 000 OPCODE 0010
-        # 10000010 - 0x82
-        response.append(0x82)
-
         # iOS code never regarded the flag as body but Web Sockets do!
         # Add one to the size to account for the flag
-        size += 1
-
-        # Mask 0
-        # Size under or at 7 bit limit
-        if size <= 125:
-            response.append(size)
-
-        # Size under or at 16 bit limit
-        elif size <= 65535:
-
-            response.append(126)
-            response += WNetwork.int_xbyte(size, 2)
-
-        # Size will be around 64 bit limit
-        else:
-
-            response.append(127)
-            response += WNetwork.int_xbyte(size, 8)
-
+        response = bytearray(frame_header(Opcodes.BINARY, size + 1))
         response.append(flag)
 
         return response
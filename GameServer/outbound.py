@@ -0,0 +1,366 @@
+import selectors
+import socket as sock
+
+from collections import deque
+from threading import Lock, Thread
+from time import monotonic
+
+from logger import Logger, LogCodes
+from metrics import Metrics
+
+
+# Wraps a session socket so sends never block the caller
+# sendall writes what the kernel accepts straight away and queues the rest for the flusher thread,
+# so a match holding its lock is never stalled by a slow receiver
+# A connection whose queue stays over max_buffer bytes for stall_timeout seconds, or grows past
+# hard_limit, is disconnected
+# While corked sends are held and written together by a single sendmsg on uncork
+class OutboundQueue:
+
+    max_buffer = 65536
+    hard_limit = 262144
+    stall_timeout = 5
+
+    # Set by the server to the running OutboundFlusher, without one queued data is sent blocking
+    flusher = None
+
+    # Largest backlog seen on any connection
+    peak_bytes = 0
+
+    def __init__(self, client):
+
+        self.client = client
+        self.lock = Lock()
+
+        self.pending = deque()
+        self.pending_size = 0
+        self.full_since = None
+        self.closed = False
+
+        self.corked = 0
+        self.held = []
+
+    # Holds sends until the matching uncork - corks nest
+    def cork(self):
+
+        with self.lock:
+            self.corked += 1
+
+    def uncork(self):
+
+        with self.lock:
+
+            self.corked -= 1
+            if self.corked or not self.held:
+                return
+
+            chunks = self.held
+            self.held = []
+
+        self.send_chunks(chunks)
+
+    def sendall(self, data):
+
+        with self.lock:
+
+            if self.corked:
+
+                self.held.append(data)
+                return
+
+        self.send_chunks([data])
+
+    def send_chunks(self, chunks):
+
+        with self.lock:
+
+            if self.closed:
+                return
+
+            if not self.pending:
+
+                try:
+                    if len(chunks) == 1:
+                        sent = self.client.send(chunks[0], sock.MSG_DONTWAIT)
+                    else:
+                        sent = self.client.sendmsg(chunks, (), sock.MSG_DONTWAIT)
+                except (BlockingIOError, InterruptedError):
+                    sent = 0
+                except OSError:
+
+                    self.closed = True
+                    return
+
+                # Skip what the kernel took
+                while chunks and sent >= len(chunks[0]):
+
+                    sent -= len(chunks[0])
+                    chunks = chunks[1:]
+
+                if not chunks:
+                    return
+
+                chunks[0] = chunks[0][sent:]
+                Metrics.count('outbound', 'deferred')
+
+            # Copy as callers may reuse their buffer once sendall returns
+            for data in chunks:
+
+                self.pending.append(bytes(data))
+                self.pending_size += len(data)
+
+            self.update_full()
+
+            overflow = self.pending_size > self.hard_limit
+
+        if overflow:
+            self.disconnect("outbound queue overflowed")
+        elif self.flusher is not None:
+            self.flusher.watch(self)
+        else:
+            self.flush(blocking=True)
+
+    # Writes queued data until the socket would block
+    # Returns true once nothing is left queued
+    def flush(self, blocking=False):
+
+        with self.lock:
+
+            while self.pending and not self.closed:
+
+                data = self.pending[0]
+                try:
+                    sent = self.client.send(data, 0 if blocking else sock.MSG_DONTWAIT)
+                except (BlockingIOError, InterruptedError):
+                    break
+                except OSError:
+
+                    self.closed = True
+                    break
+
+                self.pending_size -= sent
+                if sent == len(data):
+                    self.pending.popleft()
+                else:
+                    self.pending[0] = data[sent:]
+
+            if self.closed:
+
+                self.pending.clear()
+                self.pending_size = 0
+
+            self.update_full()
+            return not self.pending
+
+    # Tracks when the queue went over max_buffer - called with the lock held
+    def update_full(self):
+
+        if self.pending_size > OutboundQueue.peak_bytes:
+            OutboundQueue.peak_bytes = self.pending_size
+
+        if self.pending_size <= self.max_buffer:
+            self.full_since = None
+        elif self.full_since is None:
+            self.full_since = monotonic()
+
+    def stalled(self, now):
+
+        full_since = self.full_since
+        return full_since is not None and now - full_since >= self.stall_timeout
+
+    # Drops anything queued and shuts the socket so the session reading it ends
+    def disconnect(self, reason):
+
+        Logger.warning("Disconnecting client, " + reason, LogCodes.Network)
+        Metrics.count('outbound', 'disconnects')
+
+        with self.lock:
+
+            self.closed = True
+            self.pending.clear()
+            self.pending_size = 0
+            self.full_since = None
+
+        self.shutdown(sock.SHUT_RDWR)
+
+    def fileno(self):
+        return self.client.fileno()
+
+    def recv(self, *args):
+        return self.client.recv(*args)
+
+    def recv_into(self, *args):
+        return self.client.recv_into(*args)
+
+    def shutdown(self, how=sock.SHUT_RDWR):
+
+        try:
+            self.client.shutdown(how)
+        except OSError:
+            pass
+
+    def close(self):
+
+        with self.lock:
+
+            self.closed = True
+            self.pending.clear()
+            self.pending_size = 0
+
+        if self.flusher is not None:
+            self.flusher.forget(self)
+
+        self.client.close()
+
+
+# Background thread that writes the queues of connections that could not take a send immediately
+# and disconnects connections that stay stalled
+class OutboundFlusher:
+
+    def __init__(self, check_interval=0.5):
+
+        self.check_interval = check_interval
+
+        self.selector = selectors.DefaultSelector()
+
+        # Queues to register and unregister, and the registered queues - only the flusher thread
+        # changes watched, it takes the lock to do so that stats can read it from other threads
+        self.lock = Lock()
+        self.added = set()
+        self.removed = set()
+        self.watched = set()
+
+        # Wakes the selector when a queue is added
+        self.wakeup_receiver, self.wakeup_sender = sock.socketpair()
+        self.wakeup_receiver.setblocking(False)
+        self.selector.register(self.wakeup_receiver, selectors.EVENT_READ)
+
+        self.running = False
+        self.thread = None
+
+    def start(self):
+
+        self.running = True
+        self.thread = Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+
+        self.running = False
+        self.wake()
+
+        if self.thread is not None:
+            self.thread.join()
+
+    def wake(self):
+
+        try:
+            self.wakeup_sender.send(b'\0', sock.MSG_DONTWAIT)
+        except OSError:
+            pass
+
+    # Flushes queue once its socket is writable
+    # Queues are re-added even if they look registered, the flusher may be about to drop them
+    def watch(self, queue):
+
+        with self.lock:
+
+            if queue in self.added:
+                return
+
+            self.added.add(queue)
+            self.removed.discard(queue)
+
+        self.wake()
+
+    def forget(self, queue):
+
+        with self.lock:
+
+            self.added.discard(queue)
+            self.removed.add(queue)
+
+        self.wake()
+
+    def run(self):
+
+        last_check = monotonic()
+        while self.running:
+
+            self.update_registrations()
+
+            for key, events in self.selector.select(self.check_interval):
+
+                if key.fileobj is self.wakeup_receiver:
+
+                    try:
+                        while self.wakeup_receiver.recv(4096):
+                            pass
+                    except OSError:
+                        pass
+
+                elif key.data.flush():
+                    self.unregister(key.data)
+
+            now = monotonic()
+            if now - last_check >= self.check_interval:
+
+                last_check = now
+                for queue in list(self.watched):
+
+                    if queue.closed:
+                        self.unregister(queue)
+
+                    elif queue.stalled(now):
+
+                        queue.disconnect("outbound queue stalled for " + str(queue.stall_timeout) + "s")
+                        self.unregister(queue)
+
+    def update_registrations(self):
+
+        with self.lock:
+
+            added = self.added
+            removed = self.removed
+            self.added = set()
+            self.removed = set()
+
+        for queue in removed:
+            self.unregister(queue)
+
+        for queue in added:
+
+            if queue in self.watched:
+                continue
+
+            try:
+                self.selector.register(queue.client, selectors.EVENT_WRITE, queue)
+            except (KeyError, ValueError, OSError):
+                continue
+
+            with self.lock:
+                self.watched.add(queue)
+
+    def unregister(self, queue):
+
+        if queue in self.watched:
+
+            with self.lock:
+                self.watched.discard(queue)
+
+            try:
+                self.selector.unregister(queue.client)
+            except (KeyError, ValueError, OSError):
+                pass
+
+    def stats(self):
+
+        with self.lock:
+            watched = list(self.watched)
+
+        return {
+            'backlogged': len(watched),
+            'queued_bytes': sum(queue.pending_size for queue in watched),
+            'peak_bytes': OutboundQueue.peak_bytes
+        }
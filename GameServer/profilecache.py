@@ -0,0 +1,87 @@
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+
+# Least recently used cache of user profile records shared by every session
+# Entries expire after ttl seconds so changes made outside the game server are eventually picked up
+class ProfileCache:
+
+    def __init__(self, max_size=10000, ttl=600):
+
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self.lock = Lock()
+        self.entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    # Returns the cached records for a user or None if they are not cached
+    def get(self, user_id):
+
+        now = monotonic()
+        with self.lock:
+
+            entry = self.entries.get(user_id)
+            if entry is not None and now - entry[0] >= self.ttl:
+
+                del self.entries[user_id]
+                self.expirations += 1
+                entry = None
+
+            if entry is None:
+
+                self.misses += 1
+                return None
+
+            self.entries.move_to_end(user_id)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, user_id, records):
+
+        with self.lock:
+
+            self.entries[user_id] = (monotonic(), records)
+            self.entries.move_to_end(user_id)
+
+            while len(self.entries) > self.max_size:
+
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, user_id):
+
+        with self.lock:
+            self.entries.pop(user_id, None)
+
+    # Applies a finished match to a cached record in place
+    # result - 'wins', 'loss' or 'draw'
+    def record_result(self, user_id, result):
+
+        with self.lock:
+
+            entry = self.entries.get(user_id)
+            if entry is not None:
+
+                records = entry[1]
+                records[result] += 1
+                records['matches'] += 1
+
+    def stats(self):
+
+        with self.lock:
+
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations
+            }
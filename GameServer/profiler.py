@@ -0,0 +1,131 @@
+import cProfile
+import os
+import pstats
+import random
+
+from threading import Lock, Timer
+from time import strftime
+
+from logger import Logger, LogCodes
+
+
+# Admin triggered cProfile sampling of session handlers and match phases
+# While a window is open a fraction of the calls made through run are profiled and aggregated
+# per target, when the window closes the aggregate is written to the profile directory as a
+# .prof file for pstats/snakeviz and a .txt summary sorted by cumulative time
+# Callers check Profiler.active before calling run so nothing is done while profiling is off
+class Profiler:
+
+    targets = ('sessions', 'matches')
+
+    active = False
+    directory = 'profiles'
+
+    sample_rate = 0.1
+    enabled_targets = ()
+
+    _lock = Lock()
+    _busy = Lock()
+    _timer = None
+    _stats = {}
+    _samples = {}
+
+    # Opens a profiling window
+    # duration - seconds before the profiles are written
+    # sample_rate - fraction of calls profiled
+    # targets - any of 'sessions' and 'matches'
+    @staticmethod
+    def start(duration, sample_rate=0.1, targets=targets):
+
+        with Profiler._lock:
+
+            if Profiler.active:
+                return False
+
+            Profiler.sample_rate = sample_rate
+            Profiler.enabled_targets = tuple(targets)
+            Profiler._stats = {}
+            Profiler._samples = dict.fromkeys(targets, 0)
+
+            Profiler._timer = Timer(duration, Profiler.stop)
+            Profiler._timer.daemon = True
+            Profiler._timer.start()
+            Profiler.active = True
+
+        Logger.log("Profiling " + ', '.join(targets) + " for " + str(duration) +
+                   "s at a sample rate of " + str(sample_rate), LogCodes.Network)
+        return True
+
+    # Closes the window and writes the profiles, returns the paths written
+    @staticmethod
+    def stop():
+
+        with Profiler._lock:
+
+            if not Profiler.active:
+                return []
+
+            Profiler.active = False
+            Profiler._timer.cancel()
+
+            # Wait for a sample still running to be added
+            with Profiler._busy:
+                stats = Profiler._stats
+                samples = Profiler._samples
+
+        paths = []
+        for target in sorted(stats):
+            paths.extend(Profiler.write(target, stats[target], samples[target]))
+
+        Logger.log("Profiling stopped, samples: " + str(samples), LogCodes.Network)
+        return paths
+
+    # Calls function and profiles the call if it is sampled
+    # Only one call is profiled at a time, calls made while another is profiled are not sampled
+    @staticmethod
+    def run(target, function, *args):
+
+        if (target not in Profiler.enabled_targets or random.random() >= Profiler.sample_rate or
+                not Profiler._busy.acquire(blocking=False)):
+            return function(*args)
+
+        try:
+
+            if not Profiler.active:
+                return function(*args)
+
+            profile = cProfile.Profile()
+            try:
+                return profile.runcall(function, *args)
+            finally:
+
+                if Profiler._stats.get(target) is None:
+                    Profiler._stats[target] = pstats.Stats(profile)
+                else:
+                    Profiler._stats[target].add(profile)
+
+                Profiler._samples[target] += 1
+
+        finally:
+            Profiler._busy.release()
+
+    @staticmethod
+    def write(target, stats, samples):
+
+        os.makedirs(Profiler.directory, exist_ok=True)
+        name = os.path.join(Profiler.directory, strftime('%Y%m%d-%H%M%S') + '-' + target)
+
+        stats.dump_stats(name + '.prof')
+        with open(name + '.txt', 'w') as summary:
+
+            summary.write(target + " - " + str(samples) + " sampled calls\n")
+            stats.stream = summary
+            stats.sort_stats('cumulative').print_stats(50)
+
+        Logger.log("Wrote profile " + name + ".prof", LogCodes.Network)
+        return [name + '.prof', name + '.txt']
+
+    @staticmethod
+    def status():
+        return {'active': Profiler.active, 'targets': Profiler.enabled_targets,
+                'sample_rate': Profiler.sample_rate, 'samples': dict(Profiler._samples)}
@@ -0,0 +1,222 @@
+import pymysql
+
+from threading import Event, Lock, Thread
+from time import perf_counter
+
+from network import Network
+from logger import Logger, LogCodes
+from metrics import Metrics
+
+
+# Collects finished match results and writes them to the database in the background
+# Results are summed per user and applied with one multi-row UPDATE per batch so ending
+# a match never waits on the database
+class ResultWriter:
+
+    columns = ('wins', 'loss', 'draw', 'matches')
+
+    def __init__(self, interval=5, batch_size=500):
+
+        # interval - seconds between flushes
+        # batch_size - most users updated by a single statement, reaching it triggers an early flush
+        self.interval = interval
+        self.batch_size = batch_size
+
+        self.lock = Lock()
+        self.pending = {}
+        self.in_flight = {}
+
+        self.wakeup = Event()
+        self.running = False
+        self.thread = None
+
+        self.results = 0
+        self.batches = 0
+        self.rows = 0
+        self.failures = 0
+        self.uncertain = 0
+
+    def start(self):
+
+        self.running = True
+        self.thread = Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+
+        while self.running:
+
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            self.flush()
+
+    # Stops the writer thread and writes anything still pending
+    def close(self):
+
+        self.running = False
+        self.wakeup.set()
+
+        if self.thread is not None:
+            self.thread.join()
+
+        self.flush()
+
+    # Queues one players result - result is 'wins', 'loss' or 'draw'
+    def submit(self, user_id, result):
+
+        with self.lock:
+
+            delta = self.pending.get(user_id)
+            if delta is None:
+                delta = self.pending[user_id] = dict.fromkeys(self.columns, 0)
+
+            delta[result] += 1
+            delta['matches'] += 1
+            self.results += 1
+
+            full = len(self.pending) >= self.batch_size
+
+        if full:
+            self.wakeup.set()
+
+    # Adds results that are not in the database yet to freshly loaded records
+    def apply_pending(self, user_id, records):
+
+        with self.lock:
+
+            for deltas in (self.pending, self.in_flight):
+
+                delta = deltas.get(user_id)
+                if delta is not None:
+                    for column in self.columns:
+                        records[column] += delta[column]
+
+    # Writes all pending results
+    # A batch the database certainly did not apply is merged back into pending and retried on the
+    # next flush - one whose connection dropped after it was sent is logged instead, as retrying
+    # it could count the same matches twice
+    def flush(self):
+
+        while True:
+
+            with self.lock:
+
+                if not self.pending:
+                    return
+
+                user_ids = list(self.pending)[:self.batch_size]
+                for user_id in user_ids:
+                    self.in_flight[user_id] = self.pending.pop(user_id)
+
+                batch = dict(self.in_flight)
+
+            written = self.write(self.update_statement(batch))
+
+            with self.lock:
+
+                self.in_flight.clear()
+
+                if written:
+
+                    self.batches += 1
+                    self.rows += len(batch)
+
+                elif written is None:
+                    self.uncertain += 1
+
+                else:
+
+                    self.failures += 1
+                    for user_id, delta in batch.items():
+
+                        pending = self.pending.setdefault(user_id, dict.fromkeys(self.columns, 0))
+                        for column in self.columns:
+                            pending[column] += delta[column]
+
+            if written is None:
+
+                Logger.error("Lost the connection writing match results, they may not have been recorded: " +
+                             str(batch), LogCodes.Match)
+                return
+
+            if not written:
+
+                Logger.error("Could not write " + str(len(batch)) + " match results, retrying later", LogCodes.Match)
+                return
+
+    # Runs a batch's UPDATE
+    # Returns True once written and False if it was certainly not applied - no connection, the
+    # statement could not be sent or the server rejected it
+    # Returns None if the connection failed after the statement was sent, it may have been applied
+    @staticmethod
+    def write(statement):
+
+        start = perf_counter()
+
+        # noinspection PyBroadException
+        try:
+            db = Network.db_pool.acquire()
+        except:
+            return False
+
+        broken = False
+        try:
+            with db.cursor() as cursor:
+                cursor.execute(statement)
+
+            return True
+
+        # Raised on a closed connection before anything is sent
+        except pymysql.InterfaceError:
+
+            broken = True
+            return False
+
+        # Codes under 2000 come from the server, which rejected the statement as a whole
+        # 2006 (server gone) is raised when the statement could not be written to the connection
+        except pymysql.OperationalError as error:
+
+            code = error.args[0] if error.args else None
+            if code is not None and code < 2000:
+                return False
+
+            broken = True
+            return False if code == 2006 else None
+
+        except pymysql.Error:
+            return False
+
+        finally:
+
+            Network.db_pool.release(db, broken)
+            Metrics.observe('db', 'UPDATE', perf_counter() - start)
+
+    # Builds an UPDATE that adds each users deltas to their record
+    @staticmethod
+    def update_statement(batch):
+
+        user_ids = [int(user_id) for user_id in batch]
+
+        assignments = []
+        for column in ResultWriter.columns:
+
+            cases = ' '.join("WHEN '{}' THEN {}".format(user_id, int(delta[column]))
+                             for user_id, delta in zip(user_ids, batch.values()))
+            assignments.append('{0} = {0} + CASE user_id {1} ELSE 0 END'.format(column, cases))
+
+        return 'UPDATE KittyWar_userprofile SET {} WHERE user_id IN ({});'.format(
+            ', '.join(assignments), ', '.join("'{}'".format(user_id) for user_id in user_ids))
+
+    def stats(self):
+
+        with self.lock:
+
+            return {
+                'pending': len(self.pending),
+                'results': self.results,
+                'batches': self.batches,
+                'rows': self.rows,
+                'failures': self.failures,
+                'uncertain': self.uncertain
+            }
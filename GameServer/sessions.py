@@ -1,9 +1,18 @@
 import socket as sock
 
-from network import Network, WNetwork, Flags
+from collections import deque
+from network import Network, WNetwork, RequestDecoder
+from flags import Flags
+from websocket import FrameDecoder
+from buffers import SocketReader
+from outbound import OutboundQueue
+from encoding import Encoder, Encodings
+from lobby import Transfer
 from threading import Thread
-from time import sleep
 from logger import Logger, LogCodes
+from metrics import Metrics
+from profiler import Profiler
+from time import perf_counter
 
 
 class Session(Thread):
@@ -12,8 +21,11 @@ class Session(Thread):
     server_running = True
 
     card_information = None
-    lobby = None
-    match_event = None
+    card_catalogue = None
+    matchmaker = None
+    profile_cache = None
+    result_writer = None
+    admin_token = None
 
     def __init__(self, client_info):
 
@@ -22,48 +34,89 @@ class Session(Thread):
         self.daemon = False
 
         self.network = Network
-        self.recv_size = 28
+        self.reader = None
+
+        # Requests decoded but not processed yet
+        self.pending = deque()
 
         self.authenticated = False
+        self.encoding = Encodings.REPR
         self.userprofile = {'username': 'Anonymous'}
-        self.client = client_info[0]
+        self.client = OutboundQueue(client_info[0])
         self.client_address = client_info[1]
         self.match = None
 
+        # Set when the session was moved here from another worker still waiting for its match,
+        # and once it has been moved to another worker itself
+        self.ticket = None
+        self.moved = False
+
+    # Builds a session for a socket moved from another worker
+    # state - the moved session's transfer_state
+    @staticmethod
+    def adopt(client, state):
+
+        client.setblocking(True)
+
+        session = Session((client, state['address']))
+        session.reader = SocketReader(session.client, session.restore(state))
+        return session
+
     # Session Thread loop - runs until server is being shutdown or client disconnects
     def run(self):
 
         Logger.log("New session started", LogCodes.Session)
 
-        if Network.check_wconnection(self.client):
+        # Moved sessions already know their protocol and still owe the client its FIND_MATCH response
+        if self.ticket is not None:
+            self.await_match(self.ticket)
+
+        elif Network.check_wconnection(self.client):
 
             self.network = WNetwork
             self.network.handshake(self.client)
-            self.recv_size = 2
+            self.reader = SocketReader(self.client, FrameDecoder())
+
+        else:
+            self.reader = SocketReader(self.client, RequestDecoder())
 
         while self.server_running:
 
-            # Receive flag and incoming data size
-            data = self.network.receive_data(self.client, self.recv_size)
-            if data is None:
-                break
+            # Receive every complete request - clients may pipeline several in one segment
+            # Requests moved here with the session are processed before anything new is read
+            if not self.pending:
 
-            # Process clients request and check if successful
-            request = self.network.parse_request(self.client, data)
+                messages = self.reader.read()
+                if messages is None:
+                    break
 
-            if request:
-                self.process_request(request)
+                self.pending.extend(messages)
 
-            else:
+            while self.pending and self.server_running:
+
+                # Process clients request and check if successful
+                request = self.network.parse_message(self.pending.popleft())
+
+                if request:
+                    self.process_request(request)
+
+                else:
 
-                Logger.log(self.userprofile['username'] +
-                           " request could not be parsed, closing connection", LogCodes.Session)
-                self.kill()
+                    Logger.warning(self.userprofile['username'] +
+                                   " request could not be parsed, closing connection", LogCodes.Session)
+                    self.kill()
+
+        # The connection lives on in another worker so it is only closed here
+        if self.moved:
+
+            self.client.close()
+            Logger.log(self.userprofile['username'] + " moved to another worker", LogCodes.Session)
+            return
 
         # Start shutting down session thread
         # If the user has disconnected during a match they incur a loss
         if self.match:
-            self.match.disconnect(self.userprofile['username'])
+            self.match.post(self.match.disconnect, self.userprofile['username'])
 
         self.logout()
         self.shutdown()
@@ -83,15 +136,15 @@ class Session(Thread):
     def kill(self):
 
         self.server_running = False
+        self.matchmaker.cancel(self)
         self.shutdown()
 
     def process_request(self, request):
 
         flag = request.flag
 
-        Logger.log("Request: " + str(flag) + " " + str(request.token) +
-                   " " + str(request.size), LogCodes.Session)
-        Logger.log("Body: " + str(request.body), LogCodes.Session)
+        Logger.debug("Request: {} {} {}", LogCodes.Session, flag, request.token, request.size)
+        Logger.debug("Body: {}", LogCodes.Session, request.body)
 
         # Check if the flag is valid
         if Flags.valid_flag(flag):
@@ -107,24 +160,30 @@ class Session(Thread):
             #        self.kill()
             #        return
 
+            start = perf_counter()
+
             # Check if the flag pertains to the session
             if flag in request_map:
-                request_map[flag](self, request)
+
+                if Profiler.active:
+                    Profiler.run('sessions', request_map[flag], self, request)
+                else:
+                    request_map[flag](self, request)
 
             # Check if the flag pertains to a match
+            # The request is run by the match pool, which lets the session know once the match has ended
+            # The match times the request once it has run
             elif self.match:
 
-                self.match.lock.acquire()
-                self.match.process_request(self.userprofile['username'], request)
-                self.match.lock.release()
+                self.match.post(self.match.process_request, self.userprofile['username'], request,
+                                self.match_ended)
+                return
 
-                # If problem with match end
-                if not self.match.match_valid:
-                    self.match = None
+            Metrics.observe('request', Flags.flag_name(flag), perf_counter() - start)
 
         else:
 
-            Logger.log(
+            Logger.warning(
                 "Server does not support flag " + str(flag)
                 + ", closing connection", LogCodes.Session)
             self.kill()
@@ -182,7 +241,7 @@ class Session(Thread):
 
         else:
             # Username is verified through django server so force close connection
-            Logger.log(
+            Logger.warning(
                 "No username/id found for " + username + ", force closing connection", LogCodes.Session)
             self.shutdown()
 
@@ -212,14 +271,25 @@ class Session(Thread):
 
             sql_stmt = "UPDATE KittyWar_userprofile SET token='' WHERE user_id=\'{}\';"
             self.network.sql_query(sql_stmt.format(self.userprofile['userid']))
+            self.profile_cache.invalidate(self.userprofile['userid'])
             self.authenticated = False
 
             Logger.log(self.userprofile['username'] + " has logged out", LogCodes.Session)
 
         self.shutdown()
 
+    # Loads the users records from the shared profile cache, falling back to the database
     def _user_profile(self):
 
+        records = self.profile_cache.get(self.userprofile['userid'])
+        if records is None:
+            records = self._load_profile()
+
+        self.userprofile['records'] = records
+
+    # Queries the users records and caches them
+    def _load_profile(self):
+
         sql_stmts = [
             'SELECT draw,loss,wins,matches FROM KittyWar_userprofile WHERE user_id=\'{}\';',
             'SELECT catcard_id FROM KittyWar_userprofile_cats WHERE userprofile_id=\'{}\';'
@@ -236,7 +306,91 @@ class Session(Thread):
         for cat in cats:
             records['cats'].append(cat['catcard_id'])
 
-        self.userprofile['records'] = records
+        # Results still waiting to be written are not in the database yet
+        self.result_writer.apply_pending(self.userprofile['userid'], records)
+
+        self.profile_cache.put(self.userprofile['userid'], records)
+        return records
+
+    # Switches the encoding used for profile and card responses
+    # Body - the Encodings value, repr is used until a client asks otherwise
+    def set_encoding(self, request):
+
+        encoding = -1
+        if request.body:
+
+            try:
+                encoding = int(request.body)
+            except ValueError:
+                Logger.warning("Invalid encoding request: " + str(request.body), LogCodes.Session)
+
+        valid = Encodings.valid_encoding(encoding)
+        if valid:
+
+            self.encoding = Encodings(encoding)
+            Logger.log(self.userprofile['username'] + " is using encoding " + self.encoding.name, LogCodes.Session)
+
+        response = self.network.generate_responseb(request.flag, Flags.ONE_BYTE, int(valid))
+        self.network.send_data(self.userprofile['username'], self.client, response)
+
+    # Admin requests are only available when an admin token is configured and the request carries it
+    def admin_authorized(self, request):
+
+        token = request.token
+        if isinstance(token, (bytes, bytearray)):
+            token = token.decode('utf-8', 'replace')
+
+        if not self.admin_token or token != self.admin_token:
+
+            Logger.warning(self.userprofile['username'] + " is not authorized to use flag " +
+                           str(request.flag), LogCodes.Session)
+            return False
+
+        return True
+
+    # Sends a text snapshot of the server metrics
+    def admin_metrics(self, request):
+
+        if not self.admin_authorized(request):
+            response = self.network.generate_responseb(request.flag, Flags.ONE_BYTE, Flags.FAILURE)
+
+        else:
+
+            body = Metrics.snapshot()
+            response = self.network.generate_responseb(request.flag, len(body.encode('utf-8')), body)
+
+        self.network.send_data(self.userprofile['username'], self.client, response)
+
+    # Starts or stops a profiling window
+    # Body is "start <seconds> [sample rate] [sessions,matches]" or "stop"
+    def admin_profile(self, request):
+
+        success = Flags.FAILURE
+        if self.admin_authorized(request):
+
+            args = (request.body or '').split()
+            try:
+
+                if args and args[0] == 'start':
+
+                    duration = float(args[1])
+                    sample_rate = float(args[2]) if len(args) > 2 else Profiler.sample_rate
+                    targets = args[3].split(',') if len(args) > 3 else Profiler.targets
+
+                    if 0 < duration and 0 < sample_rate <= 1 and set(targets) <= set(Profiler.targets):
+                        if Profiler.start(duration, sample_rate, targets):
+                            success = Flags.SUCCESS
+
+                elif args == ['stop']:
+
+                    if Profiler.stop():
+                        success = Flags.SUCCESS
+
+            except (IndexError, ValueError):
+                Logger.warning("Invalid profile request: " + str(request.body), LogCodes.Session)
+
+        response = self.network.generate_responseb(request.flag, Flags.ONE_BYTE, success)
+        self.network.send_data(self.userprofile['username'], self.client, response)
 
     # Grab user profile information from database
     # then save it and send it back to the client
@@ -244,72 +398,129 @@ class Session(Thread):
 
         self._user_profile()
 
-        body = str(self.userprofile['records'])
+        body = Encoder.encode_profile(self.userprofile['records'], self.encoding)
         response = self.network.generate_responseb(request.flag, len(body), body)
         self.network.send_data(self.userprofile['username'], self.client, response)
 
-    # Sends all card data to the client
-    def all_cards(self, request):
+    # Sends a pre-encoded card catalogue to the client
+    # If the request body holds the catalogue version the client already has, an empty response is sent
+    def send_catalogue(self, request):
 
-        body = str(self.card_information)
-        response = self.network.generate_responseb(request.flag, len(body), body)
+        response = self.card_catalogue.response(request.flag, self.network, request.body, self.encoding)
         self.network.send_data(self.userprofile['username'], self.client, response)
 
+    # Sends all card data to the client
+    def all_cards(self, request):
+        self.send_catalogue(request)
+
     # Sends all cat card data to the client
     def cat_cards(self, request):
-
-        body = str(self.card_information['cats'])
-        response = self.network.generate_responseb(request.flag, len(body), body)
-        self.network.send_data(self.userprofile['username'], self.client, response)
+        self.send_catalogue(request)
 
     # Sends all moveset card data to the client
     def basic_cards(self, request):
-
-        body = str(self.card_information['moves'])
-        response = self.network.generate_responseb(request.flag, len(body), body)
-        self.network.send_data(self.userprofile['username'], self.client, response)
+        self.send_catalogue(request)
 
     # Sends all chance card data to the client
     def chance_cards(self, request):
-
-        body = str(self.card_information['chances'])
-        response = self.network.generate_responseb(request.flag, len(body), body)
-        self.network.send_data(self.userprofile['username'], self.client, response)
+        self.send_catalogue(request)
 
     # Sends all ability card data to the client
     def ability_cards(self, request):
-
-        body = str(self.card_information['abilities'])
-        response = self.network.generate_responseb(request.flag, len(body), body)
-        self.network.send_data(self.userprofile['username'], self.client, response)
+        self.send_catalogue(request)
 
     # Finds a match and records match results once match is finished
     def find_match(self, request):
 
-        # Before finding a match ensure the user has their profile loaded
-        if 'records' not in self.userprofile:
-            self._user_profile()
+        # Before finding a match ensure the user has their latest profile loaded
+        self._user_profile()
 
         Logger.log(self.userprofile['username'] + " is finding a match", LogCodes.Match)
-        self.lobby.put(self)
+        self.await_match(self.matchmaker.enqueue(self))
 
-        # Periodically notify matchmaker and wait until match is found
-        while self.match is None:
+    # Waits until the matchmaker pairs this session or it is cancelled
+    def await_match(self, ticket):
 
-            self.match_event.set()
-            self.match_event.clear()
-            sleep(1)
+        match = ticket.future.result()
+        if isinstance(match, Transfer):
 
-        Logger.log("Match starting for " + self.userprofile['username'], LogCodes.Match)
+            self.transfer(match)
+            return
+
+        self.match = match
+        if self.match is None:
+            return
+
+        Logger.log("Match starting for " + self.userprofile['username'] +
+                   " after waiting {:.1f}ms".format(ticket.wait_time * 1000), LogCodes.Match)
 
         # At this point a match has been found so notify client
-        response = self.network.generate_responseb(request.flag, Flags.ONE_BYTE, Flags.SUCCESS)
+        response = self.network.generate_responseb(Flags.FIND_MATCH, Flags.ONE_BYTE, Flags.SUCCESS)
         self.network.send_data(self.userprofile['username'], self.client, response)
 
+    # Called by the match once a request finds it over, the session stops sending it requests
+    def match_ended(self, match):
+
+        if self.match is match:
+            self.match = None
+
+    # The match is hosted by another worker - the socket is handed over and the session ends
+    # without logging out
+    # A session that could not be moved waits here for another match
+    def transfer(self, transfer):
+
+        ticket = self.matchmaker.transfer(self, transfer)
+        if ticket is not None:
+
+            self.await_match(ticket)
+            return
+
+        self.moved = True
+        self.server_running = False
+
+    # Everything another worker needs to carry on this session
+    def transfer_state(self):
+
+        return {
+            'address': self.client_address,
+            'userprofile': self.userprofile,
+            'authenticated': self.authenticated,
+            'encoding': int(self.encoding),
+            'protocol': self.network.protocol,
+            'pending': [self.network.save_message(message) for message in self.pending],
+            'unread': self.unread().hex()
+        }
+
+    # Restores a moved session's state, returns the decoder to read it with
+    def restore(self, state):
+
+        self.userprofile = state['userprofile']
+        self.authenticated = state['authenticated']
+        self.encoding = Encodings(state['encoding'])
+
+        if state['protocol'] == WNetwork.protocol:
+
+            self.network = WNetwork
+            decoder = FrameDecoder()
+
+        else:
+            decoder = RequestDecoder()
+
+        self.pending.extend(self.network.load_message(data) for data in state['pending'])
+        decoder.feed(bytes.fromhex(state['unread']))
+        return decoder
+
+    # Requests received but not read yet
+    def unread(self):
+        return self.reader.decoder.unread()
+
 request_map = {
 
     Flags.LOGIN:         Session.login,
     Flags.WEB_LOGIN:     Session.web_login,
+    Flags.SET_ENCODING:  Session.set_encoding,
+    Flags.ADMIN_METRICS: Session.admin_metrics,
+    Flags.ADMIN_PROFILE: Session.admin_profile,
     Flags.LOGOUT:        Session.logout,
     Flags.FIND_MATCH:    Session.find_match,
     Flags.USER_PROFILE:  Session.user_profile,
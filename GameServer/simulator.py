@@ -0,0 +1,608 @@
+#!/usr/bin/python3
+# Kitty War balance simulator
+# Plays many independent matches at once with the match rules applied to NumPy arrays, one
+# element per match and player, and reports win rates by cat, random ability and strategy
+# Requires NumPy, the server does not
+# Usage: python3 simulator.py [--matches 100000] [--hp Persian=9] [--verify 20]
+
+import argparse
+import random
+
+from time import perf_counter
+
+import numpy as np
+
+from flags import Flags
+from cat import Moves, Cats
+from chance import Chances
+from ability import Abilities
+from engine import MatchEngine, Player
+
+# Cats a player can select
+cats = (Cats.Persian, Cats.Ragdoll, Cats.Maine)
+cat_abilities = np.array([cat.ability_id for cat in cats])
+
+# Chance of picking purr, guard and scratch each round
+# Every strategy plays a chance card matching its move when it holds one and uses active abilities
+strategies = {
+    'balanced': (1 / 3, 1 / 3, 1 / 3),
+    'aggressive': (0.2, 0.2, 0.6),
+    'defensive': (0.3, 0.5, 0.2),
+    'healer': (0.6, 0.2, 0.2)
+}
+
+ability_count = len(Abilities)
+chance_count = len(Chances)
+
+# Random numbers drawn each round - the engine draws use the first columns in the order the
+# engine makes them, the last two pick each player's move
+round_draws = 7
+round_columns = round_draws + 2
+
+# Random abilities and chance cards dealt during setup, three per player
+setup_columns = 6
+
+UNFINISHED = 0
+P1_WINS = 1
+P2_WINS = 2
+DRAW = 3
+
+
+# Picks a move for a uniform random number u from a strategy's move chances
+def choose_move(u, thresholds):
+    return (u[..., None] >= thresholds).sum(-1)
+
+
+# Highest chance card held that suits the move, -1 if none
+def choose_chance(hand, move):
+
+    chance = np.full(move.shape, -1)
+    for card in reversed(range(chance_count)):
+
+        suits = np.where(card <= Chances.PURR_DRAW, Moves.PURR,
+                         np.where(card <= Chances.GUARD_DRAW, Moves.GUARD, Moves.SCRATCH))
+        chance = np.where((chance < 0) & (hand[..., card] > 0) & (move == suits), card, chance)
+
+    return chance
+
+
+# State of a batch of matches, every array has one row per match still being played
+class MatchBatch:
+
+    def __init__(self, ids, cat, strategy, health):
+
+        self.ids = ids
+        self.cat = cat
+        self.strategy = strategy
+        self.health = health
+
+        size = ids.shape + (2,)
+        self.rability = np.zeros(size, dtype=np.int64)
+        self.hand = np.zeros(size + (chance_count,), dtype=np.int64)
+        self.cooldown = np.zeros(size + (ability_count,), dtype=np.int64)
+
+        self.healed = np.zeros(size, dtype=np.int64)
+        self.dmg_dealt = np.zeros(size, dtype=np.int64)
+        self.dmg_taken = np.zeros(size, dtype=np.int64)
+        self.dmg_dodged = np.zeros(size, dtype=np.int64)
+        self.modifier = np.ones(size, dtype=np.int64)
+        self.pierce = np.zeros(size, dtype=bool)
+        self.reverse = np.zeros(size, dtype=bool)
+        self.irreversible = np.zeros(size, dtype=bool)
+        self.invulnerable = np.zeros(size, dtype=bool)
+        self.move = np.zeros(size, dtype=np.int64)
+        self.chance = np.full(size, -1)
+
+        # Random numbers of the current round and how many of them each match has used
+        self.draws = None
+        self.cursor = np.zeros(ids.shape, dtype=np.int64)
+
+    # Keeps only the matches in index
+    def take(self, index):
+
+        for name, value in vars(self).items():
+            if isinstance(value, np.ndarray):
+                setattr(self, name, value[index])
+
+    # Next random number of each selected match scaled to range(low, high), like random.randrange
+    def draw(self, selected, low, high):
+
+        rows = np.flatnonzero(selected)
+        values = self.draws[rows, self.cursor[rows]]
+        self.cursor[rows] += 1
+
+        result = np.zeros(selected.shape, dtype=np.int64)
+        result[rows] = (np.broadcast_to(low, selected.shape)[rows] +
+                        (values * (np.broadcast_to(high, selected.shape)[rows] -
+                                   np.broadcast_to(low, selected.shape)[rows])).astype(np.int64))
+        return result
+
+    def use_draws(self, draws):
+
+        self.draws = draws
+        self.cursor[:] = 0
+
+    # Adds a card to the hand of player in the selected matches
+    def gain_card(self, selected, player, card):
+
+        rows = np.flatnonzero(selected)
+        self.hand[rows, player, card[rows]] += 1
+
+
+# Plays every match in the batch to the end, or for max_rounds
+# Returns each match's result and rounds played, final health and random abilities by match id
+# draws - callable returning the random numbers for a round, rows by match id
+class Simulation:
+
+    def __init__(self, batch, draws, max_rounds):
+
+        self.batch = batch
+        self.draws = draws
+        self.max_rounds = max_rounds
+
+        count = len(batch.ids)
+        self.result = np.zeros(count, dtype=np.int64)
+        self.rounds = np.zeros(count, dtype=np.int64)
+        self.health = np.zeros((count, 2), dtype=np.int64)
+        self.rability = np.zeros((count, 2), dtype=np.int64)
+        self.rounds_played = 0
+
+        self.thresholds = np.array([np.cumsum(chances)[:2] for chances in strategies.values()])
+
+    def run(self):
+
+        self.setup()
+
+        for current in range(1, self.max_rounds + 1):
+
+            if not len(self.batch.ids):
+                break
+
+            self.batch.use_draws(self.draws(current)[self.batch.ids])
+            self.play_round(current)
+
+        # Matches still going are left unfinished
+        self.finish(np.ones(len(self.batch.ids), dtype=bool), self.max_rounds)
+        return self.result, self.rounds, self.health, self.rability
+
+    # Each player is dealt a random ability and two chance cards, player one first
+    def setup(self):
+
+        batch = self.batch
+        batch.use_draws(self.draws(0)[batch.ids])
+        everyone = np.ones(len(batch.ids), dtype=bool)
+
+        for player in (0, 1):
+
+            batch.rability[:, player] = batch.draw(everyone, 6, 8)
+            batch.gain_card(everyone, player, batch.draw(everyone, 0, chance_count))
+            batch.gain_card(everyone, player, batch.draw(everyone, 0, chance_count))
+
+        self.rability[batch.ids] = batch.rability
+
+    def play_round(self, current):
+
+        batch = self.batch
+        self.rounds_played += len(batch.ids)
+
+        self.prelude()
+        self.enact_strats(batch.draws[:, round_draws:])
+        self.settle_strats()
+
+        if not self.check_winner(current):
+            return
+
+        self.postlude()
+        self.check_winner(current)
+
+    # Resets the per round stats, lowers cooldowns and applies Critical Hit
+    def prelude(self):
+
+        batch = self.batch
+
+        for name in ('healed', 'dmg_dealt', 'dmg_taken', 'dmg_dodged'):
+            getattr(batch, name)[:] = 0
+
+        batch.modifier[:] = 1
+        for name in ('pierce', 'reverse', 'irreversible', 'invulnerable'):
+            getattr(batch, name)[:] = False
+
+        batch.chance[:] = -1
+        np.maximum(batch.cooldown - 1, 0, out=batch.cooldown)
+
+        critical = (batch.rability == Abilities.Critical) & (batch.cooldown[..., Abilities.Critical] == 0)
+        batch.modifier[critical] *= 2
+        batch.cooldown[..., Abilities.Critical][critical] = 3
+
+    # Picks each player's move and a chance card to go with it
+    def enact_strats(self, move_draws):
+
+        batch = self.batch
+        batch.move = choose_move(move_draws, self.thresholds[batch.strategy])
+        batch.chance = choose_chance(batch.hand, batch.move)
+
+        for player in (0, 1):
+
+            rows = np.flatnonzero(batch.chance[:, player] >= 0)
+            batch.hand[rows, player, batch.chance[rows, player]] -= 1
+
+    # Applies the chances played before and after combat and the combat itself
+    def settle_strats(self):
+
+        batch = self.batch
+        chance = batch.chance
+
+        # Chances played before combat
+        guaranteed = chance == Chances.GUARANTEED_PURR
+        batch.health += guaranteed
+        batch.healed += guaranteed
+        batch.invulnerable |= guaranteed
+
+        batch.reverse |= chance == Chances.REVERSE_SCRATCH
+        batch.irreversible |= chance == Chances.NO_REVERSE
+        batch.pierce |= chance == Chances.NO_GUARD
+        batch.modifier[chance == Chances.DOUBLE_SCRATCH] *= 2
+
+        # Who strikes first does not change the outcome but the engine still draws for it
+        batch.draw(np.ones(len(batch.ids), dtype=bool), 0, 2)
+
+        self.combat()
+
+        # Chances played after combat, player one first as their draws come first
+        for player in (0, 1):
+
+            card = chance[:, player]
+
+            double_purr = (card == Chances.DOUBLE_PURR) & (batch.dmg_taken[:, player] == 0)
+            batch.health[:, player] += 2 * double_purr
+            batch.healed[:, player] += 2 * double_purr
+
+            guard_heal = (card == Chances.GUARD_HEAL) & (batch.dmg_dodged[:, player] > 0)
+            batch.health[:, player] += guard_heal
+            batch.healed[:, player] += guard_heal
+
+            drawing = (((card == Chances.PURR_DRAW) & (batch.healed[:, player] > 0)) |
+                       ((card == Chances.GUARD_DRAW) & (batch.dmg_dodged[:, player] > 0)))
+            batch.gain_card(drawing, player, batch.draw(drawing, 0, chance_count))
+
+    # MatchEngine.handle_combat for both players at once
+    # Neither player's attack depends on what the other's did so both are resolved together
+    def combat(self):
+
+        batch = self.batch
+
+        move = batch.move
+        opponent_move = move[:, ::-1]
+        damage = batch.modifier
+
+        scratch = move == Moves.SCRATCH
+        guarded = scratch & (opponent_move == Moves.GUARD)
+        opponent_reverse = batch.reverse[:, ::-1]
+
+        dodged = guarded & ((opponent_reverse & batch.irreversible) | ~batch.pierce)
+        reversed_ = guarded & ~dodged & opponent_reverse
+        pierced = guarded & ~dodged & ~opponent_reverse & batch.pierce
+
+        purred = scratch & (opponent_move == Moves.PURR) & ~batch.invulnerable[:, ::-1]
+        struck = scratch & (opponent_move != Moves.GUARD) & (opponent_move != Moves.PURR)
+
+        # Damage each player deals to their opponent and to themselves
+        dealt = damage * (pierced | struck) + purred
+        reflected = damage * reversed_
+
+        purring = move == Moves.PURR
+        heal = purring & ((opponent_move != Moves.SCRATCH) | batch.invulnerable)
+
+        batch.health += heal - dealt[:, ::-1] - reflected
+        batch.healed += heal
+        batch.dmg_taken += dealt[:, ::-1] + reflected
+        batch.dmg_dealt += dealt + reflected
+        batch.dmg_dodged += (damage * dodged)[:, ::-1]
+
+    # Passive abilities in the order the engine checks them, then Rejuvenation
+    def postlude(self):
+
+        batch = self.batch
+
+        for player in (0, 1):
+
+            for ability in (cat_abilities[batch.cat[:, player]], batch.rability[:, player]):
+
+                cooling = np.take_along_axis(batch.cooldown[:, player], ability[:, None], 1)[:, 0] > 0
+
+                gentleman = (ability == Abilities.Gentleman) & (batch.dmg_dodged[:, player] >= 2)
+                attacker = (ability == Abilities.Attacker) & (batch.dmg_dealt[:, player] >= 2)
+                hunting = ((ability == Abilities.Hunting) & (batch.hand[:, player, Chances.NO_REVERSE] == 0) &
+                           (batch.hand[:, player, Chances.NO_GUARD] == 0))
+
+                drawing = (gentleman | attacker | hunting) & ~cooling
+                low = np.where(hunting, Chances.NO_REVERSE, 0)
+                high = np.where(hunting, Chances.NO_GUARD + 1, chance_count)
+
+                batch.gain_card(drawing, player, batch.draw(drawing, low, high))
+                batch.cooldown[:, player, Abilities.Hunting][hunting & ~cooling] = 3
+
+        rejuvenation = ((cat_abilities[batch.cat] == Abilities.Rejuvenation) &
+                        (batch.cooldown[..., Abilities.Rejuvenation] == 0))
+        batch.health += rejuvenation
+        batch.healed += rejuvenation
+        batch.cooldown[..., Abilities.Rejuvenation][rejuvenation] = 3
+
+    # Records and drops the matches a player has won, returns whether any are left
+    def check_winner(self, current):
+
+        health = self.batch.health
+        p1 = (health[:, 0] >= 20) | (health[:, 1] <= 0)
+        p2 = (health[:, 1] >= 20) | (health[:, 0] <= 0)
+
+        ended = p1 | p2
+        if ended.any():
+            self.finish(ended, current, np.where(p1 & p2, DRAW, np.where(p1, P1_WINS, P2_WINS)))
+
+        return len(self.batch.ids) > 0
+
+    def finish(self, ended, current, result=UNFINISHED):
+
+        batch = self.batch
+        ids = batch.ids[ended]
+
+        self.result[ids] = np.broadcast_to(result, ended.shape)[ended]
+        self.rounds[ids] = current
+        self.health[ids] = batch.health[ended]
+
+        batch.take(~ended)
+
+
+# Random numbers for every match of a run, generated a round at a time
+# Round 0 holds the setup draws
+class RoundDraws:
+
+    def __init__(self, count, seed):
+
+        self.count = count
+        self.generator = np.random.default_rng(seed)
+        self.current = -1
+        self.values = None
+
+        # Rounds kept for the matches replayed through the engine
+        self.kept = {}
+        self.keep_ids = ()
+
+    def __call__(self, current):
+
+        if current != self.current:
+
+            self.current = current
+            self.values = self.generator.random((self.count, setup_columns if current == 0 else round_columns))
+
+            for match_id in self.keep_ids:
+                self.kept.setdefault(match_id, []).append(self.values[match_id].tolist())
+
+        return self.values
+
+
+# random.Random stand-in handing the engine the numbers the simulation drew for a match
+class ReplayRandom(random.Random):
+
+    def __init__(self):
+
+        random.Random.__init__(self)
+        self.values = []
+        self.position = 0
+
+    def use(self, values):
+
+        self.values = values
+        self.position = 0
+
+    def randrange(self, start, stop=None, step=1):
+
+        value = self.values[self.position]
+        self.position += 1
+        return start + int(value * (stop - start))
+
+
+# Plays one simulated match through MatchEngine with the same draws, moves and cards
+# Returns the result, rounds played and final health like Simulation
+def replay(cat, strategy, health, rounds, thresholds):
+
+    players = (Player('p1', [cat.id for cat in cats]), Player('p2', [cat.id for cat in cats]))
+    rng = ReplayRandom()
+    game = MatchEngine(players[0], players[1], rng)
+
+    for player, cat_index, hp in zip(players, cat, health):
+
+        game.handle(player, Flags.SELECT_CAT, str(cats[cat_index].id))
+        player.health = hp
+
+    rng.use(rounds[0])
+    for player in players:
+        game.handle(player, Flags.READY, None)
+
+    current = 0
+    while game.valid and current < len(rounds) - 1:
+
+        current += 1
+        rng.use(rounds[current])
+
+        # Prelude
+        for player in players:
+
+            if player.rability == Abilities.Critical:
+                game.handle(player, Flags.USE_ABILITY, str(int(Abilities.Critical)))
+
+            game.handle(player, Flags.READY, None)
+
+        # Enact strategies
+        for index, player in enumerate(players):
+
+            move = int((rounds[current][round_draws + index] >= thresholds[strategy[index]]).sum())
+            game.handle(player, Flags.SELECT_MOVE, str(move))
+
+            hand = np.array(player.hand, dtype=np.int64)
+            chance = int(choose_chance(hand, np.array(move)))
+            if chance >= 0:
+                game.handle(player, Flags.USE_CHANCE, str(chance))
+
+            game.handle(player, Flags.READY, None)
+
+        # Show cards, settle strategies
+        for _ in range(2):
+            for player in players:
+                game.handle(player, Flags.READY, None)
+
+        # Postlude
+        for player in players:
+
+            if player.cat.ability_id == Abilities.Rejuvenation:
+                game.handle(player, Flags.USE_ABILITY, str(int(Abilities.Rejuvenation)))
+
+            game.handle(player, Flags.READY, None)
+
+    if game.valid:
+        result = UNFINISHED
+    elif game.result == Flags.DRAW:
+        result = DRAW
+    else:
+        result = P1_WINS if game.winner is players[0] else P2_WINS
+
+    return result, current, [player.health for player in players]
+
+
+# Runs matches in batches of batch_size, returns the per match inputs and outcomes
+def simulate(matches, batch_size, max_rounds, seed, hp, verify):
+
+    generator = np.random.default_rng(seed)
+    cat = generator.integers(0, len(cats), (matches, 2))
+    strategy = generator.integers(0, len(strategies), (matches, 2))
+    health = np.array([hp[cats[index].name] for index in range(len(cats))])[cat]
+
+    result = np.zeros(matches, dtype=np.int64)
+    rounds = np.zeros(matches, dtype=np.int64)
+    final_health = np.zeros((matches, 2), dtype=np.int64)
+    rability = np.zeros((matches, 2), dtype=np.int64)
+
+    mismatches = []
+    rounds_played = 0
+
+    for start in range(0, matches, batch_size):
+
+        end = min(start + batch_size, matches)
+        ids = np.arange(end - start)
+
+        draws = RoundDraws(end - start, generator.integers(1 << 63))
+        if start == 0:
+            draws.keep_ids = [int(match_id) for match_id in
+                              np.random.default_rng(seed).choice(end - start, min(verify, end - start), False)]
+
+        batch = MatchBatch(ids, cat[start:end], strategy[start:end], health[start:end].copy())
+        simulation = Simulation(batch, draws, max_rounds)
+
+        outcome = simulation.run()
+        result[start:end], rounds[start:end], final_health[start:end], rability[start:end] = outcome
+        rounds_played += simulation.rounds_played
+
+        for match_id in draws.keep_ids:
+
+            expected = (int(outcome[0][match_id]), int(outcome[1][match_id]), outcome[2][match_id].tolist())
+            replayed = replay(cat[match_id], strategy[match_id], health[match_id].tolist(), draws.kept[match_id],
+                              simulation.thresholds)
+
+            if tuple(replayed) != expected:
+                mismatches.append((match_id, expected, replayed))
+
+    return cat, strategy, rability, result, rounds, rounds_played, mismatches
+
+
+# Prints the win rate of players grouped by one of their properties
+def report_rates(title, names, values, result):
+
+    wins = np.stack((result == P1_WINS, result == P2_WINS), 1)
+    draws = np.stack((result == DRAW, result == DRAW), 1)
+
+    print("{:<16}{:>10}{:>9}{:>9}".format(title, "players", "win", "draw"))
+    for index, name in enumerate(names):
+
+        selected = values == index
+        played = selected.sum()
+        if played:
+            print("{:<16}{:>10}{:>8.1%}{:>9.1%}".format(name, played, wins[selected].mean(), draws[selected].mean()))
+
+    print()
+
+
+# Prints how often the cat of each row beats the cat of each column
+def report_matchups(cat, result):
+
+    names = [cat.name for cat in cats]
+    print("{:<16}".format("matchup") + "".join("{:>10}".format(name) for name in names))
+
+    for index, name in enumerate(names):
+
+        row = "{:<16}".format(name)
+        for opponent in range(len(names)):
+
+            wins = (((cat[:, 0] == index) & (cat[:, 1] == opponent) & (result == P1_WINS)).sum() +
+                    ((cat[:, 1] == index) & (cat[:, 0] == opponent) & (result == P2_WINS)).sum())
+            played = (((cat[:, 0] == index) & (cat[:, 1] == opponent)).sum() +
+                      ((cat[:, 1] == index) & (cat[:, 0] == opponent)).sum())
+
+            row += "{:>10.1%}".format(wins / played) if played else "{:>10}".format("-")
+
+        print(row)
+
+    print()
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="KittyWar balance simulator")
+    parser.add_argument('--matches', type=int, default=100000)
+    parser.add_argument('--batch-size', type=int, default=100000, help="matches held in memory at once")
+    parser.add_argument('--max-rounds', type=int, default=500, help="matches still going after this are unfinished")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--hp', action='append', default=[], metavar='CAT=HP',
+                        help="try a different starting health, e.g. Persian=9")
+    parser.add_argument('--verify', type=int, default=20,
+                        help="matches replayed through MatchEngine to check the simulation agrees")
+    args = parser.parse_args()
+
+    hp = {cat.name: cat.hp for cat in cats}
+    for change in args.hp:
+
+        name, value = change.split('=')
+        if name not in hp:
+            parser.error("unknown cat " + name)
+
+        hp[name] = int(value)
+
+    start = perf_counter()
+    cat, strategy, rability, result, rounds, rounds_played, mismatches = simulate(
+        args.matches, args.batch_size, args.max_rounds, args.seed, hp, args.verify)
+    elapsed = perf_counter() - start
+
+    print("{} matches, {} rounds in {:.2f}s ({:.0f} rounds/s)".format(
+        args.matches, rounds_played, elapsed, rounds_played / elapsed))
+    print("mean rounds {:.1f}, unfinished {:.2%}, draws {:.2%}".format(
+        rounds[result != UNFINISHED].mean() if (result != UNFINISHED).any() else 0.0,
+        (result == UNFINISHED).mean(), (result == DRAW).mean()))
+    print("hp " + ", ".join("{}={}".format(name, value) for name, value in hp.items()))
+    print()
+
+    report_rates("cat", [cat.name for cat in cats], cat, result)
+    report_rates("random ability", [ability.name for ability in Abilities], rability, result)
+    report_rates("strategy", list(strategies), strategy, result)
+    report_matchups(cat, result)
+
+    # Only matches from the first batch are replayed
+    replayed = min(args.verify, args.matches, args.batch_size)
+    print("replayed {} matches through MatchEngine, {} differed".format(replayed, len(mismatches)))
+    for match_id, expected, replayed in mismatches:
+        print("  match {}: simulated {} engine {}".format(match_id, expected, replayed))
+
+    if mismatches:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
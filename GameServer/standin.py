@@ -0,0 +1,169 @@
+import re
+
+from threading import Lock
+
+from cat import Moves, Cats
+from chance import Chances
+from ability import Abilities
+
+
+class StandinError(Exception):
+    pass
+
+
+# In memory replacement for the KittyWar database used for load testing
+# Answers the statements the server issues for logins, profiles, card data and match results
+# Players are named <prefix><id> for ids 1 to users, own every cat and never lose their token
+# so the same simulated player can log in again after logging out
+class StandinDatabase:
+
+    prefix = 'player'
+
+    def __init__(self, users):
+
+        self.users = users
+        self.lock = Lock()
+        self.records = {}
+
+        self.cards = {
+            'KittyWar_catcard': [{'id': cat.id, 'name': cat.name, 'hp': cat.hp, 'ability_id': cat.ability_id,
+                                  'description': cat.name} for cat in Cats],
+            'KittyWar_basiccards': [{'id': int(move), 'name': move.name, 'description': move.name}
+                                    for move in Moves],
+            'KittyWar_chancecards': [{'id': int(chance), 'name': chance.name, 'description': chance.name}
+                                     for chance in Chances],
+            'KittyWar_abilitycards': [{'id': int(ability), 'name': ability.name, 'description': ability.name}
+                                      for ability in Abilities]
+        }
+
+        self.statements = [
+
+            (re.compile(r"SELECT id FROM auth_user WHERE username='(.*)';"), self.user_id),
+            (re.compile(r"SELECT username FROM auth_user WHERE id='(\d+)';"), self.username),
+            (re.compile(r"SELECT token FROM KittyWar_userprofile WHERE user_id='(\d+)';"), self.user_token),
+            (re.compile(r"SELECT draw,loss,wins,matches FROM KittyWar_userprofile WHERE user_id='(\d+)';"),
+             self.user_records),
+            (re.compile(r"SELECT catcard_id FROM KittyWar_userprofile_cats WHERE userprofile_id='(\d+)';"),
+             self.user_cats),
+            (re.compile(r"SELECT \* FROM (\w+);"), self.card_rows),
+            (re.compile(r"UPDATE KittyWar_userprofile SET token='' WHERE user_id='(\d+)';"), self.clear_token),
+            (re.compile(r"UPDATE KittyWar_userprofile SET (.*) WHERE user_id IN"), self.add_results)
+        ]
+
+    # Token each simulated player logs in with
+    @staticmethod
+    def token(user_id):
+        return 'standin' + str(user_id).rjust(17, '0')
+
+    @staticmethod
+    def player_name(user_id):
+        return StandinDatabase.prefix + str(user_id)
+
+    # Opens a connection, passed to ConnectionPool in place of Network.db_connection
+    def connect(self):
+        return StandinConnection(self)
+
+    # Runs a statement and returns its rows
+    def execute(self, query):
+
+        for pattern, handler in self.statements:
+
+            match = pattern.match(query)
+            if match:
+                return handler(*match.groups())
+
+        raise StandinError("Unsupported statement: " + query)
+
+    def valid_id(self, user_id):
+        return 1 <= int(user_id) <= self.users
+
+    def user_id(self, username):
+
+        if username.startswith(self.prefix) and username[len(self.prefix):].isdigit():
+
+            user_id = int(username[len(self.prefix):])
+            if self.valid_id(user_id):
+                return ({'id': user_id},)
+
+        return ()
+
+    def username(self, user_id):
+        return ({'username': self.player_name(int(user_id))},) if self.valid_id(user_id) else ()
+
+    def user_token(self, user_id):
+        return ({'token': self.token(int(user_id))},) if self.valid_id(user_id) else ()
+
+    def user_records(self, user_id):
+
+        if not self.valid_id(user_id):
+            return ()
+
+        with self.lock:
+            return (dict(self.player_records(user_id)),)
+
+    def user_cats(self, user_id):
+        return tuple({'catcard_id': cat} for cat in (Cats.Persian.id, Cats.Ragdoll.id, Cats.Maine.id))
+
+    def card_rows(self, table):
+        return tuple(dict(row) for row in self.cards.get(table, ()))
+
+    def clear_token(self, user_id):
+        return ()
+
+    # Applies the column = column + CASE user_id WHEN ... END assignments built by ResultWriter
+    def add_results(self, assignments):
+
+        with self.lock:
+
+            for column, cases in re.findall(r"(\w+) = \w+ \+ CASE user_id (.*?) ELSE 0 END", assignments):
+                for user_id, delta in re.findall(r"WHEN '(\d+)' THEN (\d+)", cases):
+
+                    self.player_records(user_id)[column] += int(delta)
+
+        return ()
+
+    # Records of a player, created on first use - called with the lock held
+    def player_records(self, user_id):
+        return self.records.setdefault(int(user_id), {'draw': 0, 'loss': 0, 'wins': 0, 'matches': 0})
+
+
+# The parts of a pymysql connection the server uses
+class StandinConnection:
+
+    def __init__(self, database):
+
+        self.database = database
+        self.open = True
+
+    def cursor(self, cursor_class=None):
+        return StandinCursor(self.database)
+
+    def ping(self, reconnect=False):
+
+        if not self.open:
+            raise StandinError("Connection is closed")
+
+    def close(self):
+        self.open = False
+
+
+class StandinCursor:
+
+    def __init__(self, database):
+
+        self.database = database
+        self.rows = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def execute(self, query):
+
+        self.rows = self.database.execute(query)
+        return len(self.rows)
+
+    def fetchall(self):
+        return self.rows
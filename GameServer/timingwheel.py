@@ -0,0 +1,172 @@
+from math import ceil
+from threading import Event, Lock, Thread
+from time import monotonic
+
+from logger import Logger, LogCodes
+
+
+# A callback waiting on a TimingWheel, keep it to cancel the callback
+class Timer:
+
+    __slots__ = ('callback', 'args', 'slot', 'rounds')
+
+    def __init__(self, callback, args):
+
+        self.callback = callback
+        self.args = args
+
+        # Slot of the wheel the timer is in, None once it has fired or been cancelled
+        # and the full turns of the wheel left before it is due
+        self.slot = None
+        self.rounds = 0
+
+
+# Hashed timing wheel running the deadlines of every match on one thread
+# The wheel is a ring of slots, one per tick - a timer goes in the slot its deadline falls in
+# (counting full turns of the wheel for long delays) and each tick only looks at the next slot
+# Scheduling and cancelling take constant time however many timers are waiting
+class TimingWheel:
+
+    def __init__(self, tick=0.25, size=512):
+
+        # tick - seconds per slot, timers fire up to one tick after their deadline
+        # size - number of slots, delays under tick * size never need a second turn
+        self.tick = tick
+        self.size = size
+
+        # Timers in each slot in the order they were scheduled
+        # Tick n of the wheel runs slot n % size no sooner than origin + (n + 1) * tick,
+        # position is the next tick to run
+        self.slots = [{} for _ in range(size)]
+        self.origin = monotonic()
+        self.position = 0
+
+        # Expired callbacks are called on the wheel's thread unless dispatch is set, then they are
+        # passed to dispatch(callback, *args), e.g. an event loop's call_soon_threadsafe
+        self.dispatch = None
+
+        self.lock = Lock()
+        self.wakeup = Event()
+        self.running = False
+        self.thread = None
+
+        self.pending = 0
+        self.scheduled = 0
+        self.cancelled = 0
+        self.expired = 0
+        self.late_ticks = 0
+
+    def start(self):
+
+        self.running = True
+        self.thread = Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    # Stops the wheel, timers still waiting never fire
+    def close(self):
+
+        self.running = False
+        self.wakeup.set()
+
+        if self.thread is not None:
+            self.thread.join()
+
+    # Calls callback(*args) once delay seconds have passed, returns the timer to cancel it with
+    def schedule(self, delay, callback, *args):
+
+        timer = Timer(callback, args)
+
+        # The first tick that runs after the deadline - counted from the origin rather than the
+        # position so a wheel that is catching up never runs a timer early
+        due = ceil((monotonic() + delay - self.origin) / self.tick) - 1
+
+        with self.lock:
+
+            due = max(due, self.position)
+            timer.rounds = (due - self.position) // self.size
+            timer.slot = due % self.size
+            self.slots[timer.slot][timer] = None
+
+            self.pending += 1
+            self.scheduled += 1
+
+        return timer
+
+    # Stops a timer from firing, a timer that already fired is left alone
+    def cancel(self, timer):
+
+        with self.lock:
+
+            if timer.slot is None:
+                return
+
+            del self.slots[timer.slot][timer]
+            timer.slot = None
+
+            self.pending -= 1
+            self.cancelled += 1
+
+    def run(self):
+
+        while self.running:
+
+            delay = self.origin + (self.position + 1) * self.tick - monotonic()
+            if delay > 0:
+
+                self.wakeup.wait(delay)
+                if not self.running:
+                    break
+
+            # A tick that is late (the thread was held up) is caught up straight away
+            elif delay < -self.tick:
+                self.late_ticks += 1
+
+            self.advance()
+
+    # Moves the wheel on by one tick and runs the timers that are due
+    def advance(self):
+
+        expired = []
+        with self.lock:
+
+            slot = self.slots[self.position % self.size]
+            for timer in list(slot):
+
+                if timer.rounds:
+                    timer.rounds -= 1
+                    continue
+
+                del slot[timer]
+                timer.slot = None
+                expired.append(timer)
+
+            self.position += 1
+            self.pending -= len(expired)
+            self.expired += len(expired)
+
+        for timer in expired:
+
+            # A failing callback must not stop the wheel
+            # noinspection PyBroadException
+            try:
+
+                if self.dispatch is None:
+                    timer.callback(*timer.args)
+                else:
+                    self.dispatch(timer.callback, *timer.args)
+
+            except:
+                Logger.error("Timer callback failed", LogCodes.Match)
+
+    def stats(self):
+
+        with self.lock:
+
+            return {
+                'pending': self.pending,
+                'scheduled': self.scheduled,
+                'cancelled': self.cancelled,
+                'expired': self.expired,
+                'late_ticks': self.late_ticks
+            }
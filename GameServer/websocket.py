@@ -0,0 +1,209 @@
+import struct
+
+from enum import IntEnum
+
+from buffers import ReceiveBuffer
+from logger import Logger, LogCodes
+
+
+class Opcodes(IntEnum):
+
+    CONTINUATION = 0
+    TEXT = 1
+    BINARY = 2
+    CLOSE = 8
+    PING = 9
+    PONG = 10
+
+
+class CloseCodes(IntEnum):
+
+    NORMAL = 1000
+    PROTOCOL_ERROR = 1002
+    TOO_BIG = 1009
+
+
+class FrameError(Exception):
+
+    def __init__(self, message, code=CloseCodes.PROTOCOL_ERROR):
+
+        Exception.__init__(self, message)
+        self.code = code
+
+
+# Builds the header of an unmasked server frame
+def frame_header(opcode, size, fin=True):
+
+    first = (0x80 if fin else 0) | opcode
+    if size <= 125:
+        return struct.pack('!BB', first, size)
+    elif size <= 65535:
+        return struct.pack('!BBH', first, 126, size)
+
+    return struct.pack('!BBQ', first, 127, size)
+
+
+def encode_frame(opcode, payload=b''):
+    return frame_header(opcode, len(payload)) + payload
+
+
+# Unmasks a client payload by XORing it against the repeated masking key as one integer
+# instead of byte by byte
+def unmask(payload, mask_key):
+
+    length = len(payload)
+    if not length:
+        return b''
+
+    key = (bytes(mask_key) * ((length >> 2) + 1))[:length]
+    return (int.from_bytes(payload, 'big') ^ int.from_bytes(key, 'big')).to_bytes(length, 'big')
+
+
+# Decodes client WebSocket frames without doing any I/O
+# Payloads are only copied when they are unmasked
+# Pings are answered and closes echoed through outgoing
+class FrameDecoder(ReceiveBuffer):
+
+    protocol = 'websocket'
+
+    def __init__(self, buffer_size=65536, max_message=1048576):
+
+        ReceiveBuffer.__init__(self, buffer_size)
+        self.max_message = max_message
+
+        self.fragments = None
+        self.fragments_size = 0
+
+    # Parses the next complete frame in the buffer
+    # Returns fin, opcode and the unmasked payload or None if the frame is incomplete
+    def next_frame(self):
+
+        view = self.view
+        start = self.start
+        available = self.end - start
+
+        if available < 2:
+            return None
+
+        first = view[start]
+        second = view[start + 1]
+        length = second & 0x7F
+        offset = start + 2
+
+        if length == 126:
+
+            if available < 4:
+                return None
+
+            length = (view[offset] << 8) | view[offset + 1]
+            offset += 2
+
+        elif length == 127:
+
+            if available < 10:
+                return None
+
+            length = int.from_bytes(view[offset:offset + 8], 'big')
+            offset += 8
+
+        if not second & 0x80:
+            raise FrameError("Client frame is not masked")
+
+        if first & 0x70:
+            raise FrameError("Reserved bits set without an extension")
+
+        if length > self.max_message:
+            raise FrameError("Frame of " + str(length) + " bytes is too big", CloseCodes.TOO_BIG)
+
+        payload_start = offset + 4
+        if self.end - payload_start < length:
+
+            self.needed = payload_start + length - start
+            return None
+
+        self.needed = 0
+        self.start = payload_start + length
+
+        payload = unmask(view[payload_start:self.start], view[offset:payload_start])
+        return first & 0x80, first & 0x0F, payload
+
+    # Returns the next complete data message, or None if more bytes are needed or the connection closed
+    def decode(self):
+
+        try:
+            return self._decode()
+        except FrameError as error:
+
+            Logger.warning("WebSocket protocol error: " + str(error), LogCodes.Network)
+            self.close(error.code)
+            return None
+
+    def _decode(self):
+
+        while not self.closed:
+
+            frame = self.next_frame()
+            if frame is None:
+                return None
+
+            fin, opcode, payload = frame
+
+            # Control frames may arrive between the fragments of a message
+            if opcode >= Opcodes.CLOSE:
+
+                if not fin or len(payload) > 125:
+                    raise FrameError("Control frames must be final and at most 125 bytes")
+
+                if opcode == Opcodes.PING:
+                    self.outgoing += encode_frame(Opcodes.PONG, payload)
+
+                elif opcode == Opcodes.CLOSE:
+                    self.close(CloseCodes.NORMAL, payload[:2])
+
+                elif opcode != Opcodes.PONG:
+                    raise FrameError("Unknown control opcode " + str(opcode))
+
+                continue
+
+            if opcode == Opcodes.CONTINUATION:
+
+                if self.fragments is None:
+                    raise FrameError("Continuation frame without a message to continue")
+
+            elif opcode not in (Opcodes.TEXT, Opcodes.BINARY):
+                raise FrameError("Unknown data opcode " + str(opcode))
+
+            elif self.fragments is not None:
+                raise FrameError("New message before the last one finished")
+
+            # Unfragmented messages skip reassembly entirely
+            elif fin:
+                return payload
+
+            else:
+
+                self.fragments = []
+                self.fragments_size = 0
+
+            self.fragments.append(payload)
+            self.fragments_size += len(payload)
+
+            if self.fragments_size > self.max_message:
+                raise FrameError("Message is too big", CloseCodes.TOO_BIG)
+
+            if fin:
+
+                message = b''.join(self.fragments)
+                self.fragments = None
+                return message
+
+        return None
+
+    # Queues a close frame, status is echoed when replying to a client close
+    def close(self, code=CloseCodes.NORMAL, status=None):
+
+        if not self.closed:
+
+            self.closed = True
+            self.outgoing += encode_frame(Opcodes.CLOSE, bytes(status) if status is not None else
+                                          struct.pack('!H', code))